@@ -163,6 +163,7 @@ class StableDiffusionUI_img2img(StableDiffusionUI):
              'num_return_images',
              'num_inference_steps',
              'guidance_scale',
+             'guidance_end',
              'seed',
              'output_dir',
              'sampler',
@@ -230,6 +231,7 @@ class StableDiffusionUI_img2img(StableDiffusionUI):
                 widget_opt['seed'],
                 widget_opt['num_inference_steps'],
                 widget_opt['guidance_scale'],
+                widget_opt['guidance_end'],
                 widget_opt['sampler'],
                 widget_opt['model_name'],
             ),
@@ -64,9 +64,11 @@ class StableDiffusionUI_txt2img(StableDiffusionUI):
         for key in (
              'standard_size',
              'num_return_images',
+             'batch_size',
              'enable_parsing',
              'num_inference_steps',
              'guidance_scale',
+             'guidance_end',
              'max_embeddings_multiples',
              'fp16',
              'seed',
@@ -128,8 +130,10 @@ class StableDiffusionUI_txt2img(StableDiffusionUI):
                     widget_opt['superres_model_name'],
                     widget_opt['num_inference_steps'],
                     widget_opt['guidance_scale'],
+                    widget_opt['guidance_end'],
                     widget_opt['sampler'],
                     widget_opt['num_return_images'],
+                    widget_opt['batch_size'],
                     widget_opt['seed'],
                     widget_opt['enable_parsing'],
                     widget_opt['max_embeddings_multiples'],
@@ -0,0 +1,135 @@
+"""
+Cold start of a model with `lazy_load`: the time and peak RSS of a fresh process loading the unet and the vae from
+their model_state.pdparams, as `from_pretrained` does, against memory mapping the flat copies of the weights cache.
+
+Every load runs in its own process, on a warm page cache. The peak RSS of a process is inherited across exec on
+Linux, so the parent never loads any weights itself. "init" only builds the model from its config, the floor of both
+loads. The flat copies are written once beforehand, which is what the first load with `lazy_load` does in the
+background, and that time is reported too.
+
+    python benchmarks/bench_lazy_load.py --model_path model_weights/MoososCap/NOVEL-MODEL
+    python benchmarks/bench_lazy_load.py --scale 0.5    # a randomly initialized model, SD 1.x with half the channels
+"""
+import argparse
+import importlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPONENTS = ("unet", "vae")
+
+
+def import_utils():
+    # the package __init__ builds the whole UI, only utils.py and its relative imports are needed
+    package = types.ModuleType("ppdiffusers_sd")
+    package.__path__ = [REPO_DIR]
+    sys.modules.setdefault("ppdiffusers_sd", package)
+    return importlib.import_module("ppdiffusers_sd.utils")
+
+
+def build_random_model(path, scale):
+    """Save a randomly initialized unet and vae with the architecture of SD 1.x, their channels multiplied by `scale`."""
+    from ppdiffusers import AutoencoderKL, UNet2DConditionModel
+
+    def channels(values):
+        return tuple(max(32, int(value * scale) // 32 * 32) for value in values)
+
+    unet = UNet2DConditionModel(
+        sample_size=64,
+        block_out_channels=channels((320, 640, 1280, 1280)),
+        attention_head_dim=8,
+        cross_attention_dim=768,
+    )
+    unet.save_pretrained(os.path.join(path, "unet"))
+    del unet
+    vae = AutoencoderKL(
+        block_out_channels=channels((128, 256, 512, 512)),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=2,
+        sample_size=512,
+    )
+    vae.save_pretrained(os.path.join(path, "vae"))
+
+
+def write_flat_copies(model_path):
+    """Return the time taken by the first load with `lazy_load` to write the flat copies in the background."""
+    utils = import_utils()
+    tic = time.perf_counter()
+    utils.cache_flat_weights(model_path, background=False)
+    return time.perf_counter() - tic
+
+
+def load(method, model_path, name):
+    """Return the time, the number of parameters and the peak RSS increase of loading the component `name`."""
+    utils = import_utils()
+    from ppdiffusers import AutoencoderKL, UNet2DConditionModel
+
+    model_class = UNet2DConditionModel if name == "unet" else AutoencoderKL
+    baseline_rss = utils.compute_peak_rss()
+    tic = time.perf_counter()
+    if method == "init":
+        model = model_class.from_config(model_class.load_config(os.path.join(model_path, name)))
+    elif method == "pdparams":
+        model = model_class.from_pretrained(os.path.join(model_path, name))
+    else:
+        weights_path = utils.get_flat_weights_cache_path(os.path.join(model_path, name, "model_state.pdparams"))
+        model = utils.load_flat_component(model_path, name, weights_path)
+    elapsed = time.perf_counter() - tic
+    num_parameters = sum(int(parameter.numel()) for parameter in model.parameters())
+    return elapsed, num_parameters, utils.compute_peak_rss() - baseline_rss
+
+
+def _target(queue, function, args):
+    queue.put(function(*args))
+
+
+def run_in_process(function, *args):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_target, args=(queue, function, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_path", type=str, default=None, help="A local model with model_state.pdparams files.")
+    parser.add_argument("--scale", type=float, default=0.5, help="Channel scale of the random model.")
+    parser.add_argument("--repeats", type=int, default=3, help="Loads of each kind, the fastest one is reported.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_lazy_load_")
+    # an empty weights cache, inherited by the processes
+    os.environ["PPDIFFUSERS_SD_CACHE"] = os.path.join(work_dir, "cache")
+    try:
+        model_path = args.model_path
+        if model_path is None:
+            model_path = os.path.join(work_dir, "model")
+            run_in_process(build_random_model, model_path, args.scale)
+
+        elapsed = run_in_process(write_flat_copies, model_path)
+        print(f"flat copies written in {elapsed:.2f}s (in the background of the first load)")
+
+        print(f"{'component':<10}{'parameters':>12}{'load':>10}{'time (s)':>10}{'peak RSS (GB)':>16}")
+        for name in COMPONENTS:
+            for method in ("init", "pdparams", "flat"):
+                elapsed, num_parameters, peak_rss = min(
+                    (run_in_process(load, method, model_path, name) for _ in range(args.repeats)),
+                    key=lambda result: result[0],
+                )
+                print(f"{name:<10}{num_parameters:>12}{method:>10}{elapsed:>10.2f}{peak_rss / 1024 ** 3:>16.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Time-to-state-dict of `load_torch` on a synthetic multi-GB torch-format checkpoint.
+
+The checkpoint is written with zipfile and pickle only, laid out like `torch.save` does (an `archive/data.pkl`
+pickle referencing `archive/data/{key}` storages, whose data are aligned to 64 bytes with an "FB" extra field), so
+torch is not needed. Three loaders are compared, each in its own process so that its peak RSS is measured alone:
+
+- legacy: the former byte-by-byte scan for `data/{key}` and `FB` markers (kept here as the baseline)
+- index: `load_torch`, which locates every entry through the zip central directory
+- index+mmap: `load_torch(use_mmap=True)`, then every tensor is summed so that all the pages are actually read
+
+The file is read once before the measurements so that every loader runs on a warm page cache.
+
+    python benchmarks/bench_load_torch.py --size_gb 2
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import time
+import types
+import zipfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch_loader  # noqa: E402
+
+
+# --------------------------------------------------
+# synthetic checkpoint
+# --------------------------------------------------
+
+
+def _fake_torch_modules():
+    """Modules and classes named like the torch ones, so that pickle writes the same globals as torch.save."""
+    torch = types.ModuleType("torch")
+    torch_utils = types.ModuleType("torch._utils")
+
+    class FloatStorage:
+        pass
+
+    def _rebuild_tensor_v2(*args):
+        pass
+
+    FloatStorage.__module__, FloatStorage.__qualname__ = "torch", "FloatStorage"
+    _rebuild_tensor_v2.__module__, _rebuild_tensor_v2.__qualname__ = "torch._utils", "_rebuild_tensor_v2"
+    torch.FloatStorage = FloatStorage
+    torch_utils._rebuild_tensor_v2 = _rebuild_tensor_v2
+    return torch, torch_utils
+
+
+class _Storage:
+    def __init__(self, key, numel):
+        self.key = key
+        self.numel = numel
+
+
+class _Tensor:
+    rebuild = None
+
+    def __init__(self, storage, shape):
+        self.storage = storage
+        self.shape = shape
+
+    def __reduce__(self):
+        stride = tuple(int(np.prod(self.shape[i + 1 :])) for i in range(len(self.shape)))
+        # through the class, `self.rebuild` would be a bound method
+        return (type(self).rebuild, (self.storage, 0, self.shape, stride, False, {}))
+
+
+class _Pickler(pickle.Pickler):
+    storage_class = None
+
+    def persistent_id(self, obj):
+        if isinstance(obj, _Storage):
+            return ("storage", self.storage_class, obj.key, "cpu", obj.numel)
+        return None
+
+
+def _aligned_info(name, offset):
+    """A ZipInfo whose data starts on a 64 bytes boundary, padded with an "FB" extra field like torch."""
+    info = zipfile.ZipInfo(name, date_time=(2022, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    header_size = 30 + len(name.encode()) + 4
+    padding = (-(offset + header_size)) % 64
+    info.extra = b"FB" + struct.pack("<H", padding) + b"Z" * padding
+    return info
+
+
+def write_checkpoint(path, size_gb, num_tensors):
+    """Write a checkpoint of about `size_gb` GB of float32 tensors, return their total size in bytes."""
+    torch, torch_utils = _fake_torch_modules()
+    saved = {name: sys.modules.get(name) for name in ("torch", "torch._utils")}
+    sys.modules["torch"], sys.modules["torch._utils"] = torch, torch_utils
+    try:
+        numel = max(1, int(size_gb * 1024**3 / 4 / num_tensors))
+        keys = sorted(str(i) for i in range(num_tensors))
+        state_dict = {
+            f"model.diffusion_model.layer{key}.weight": _Tensor(_Storage(key, numel), (numel,)) for key in keys
+        }
+        _Tensor.rebuild = torch_utils._rebuild_tensor_v2
+        _Pickler.storage_class = torch.FloatStorage
+        buffer = io.BytesIO()
+        _Pickler(buffer, protocol=2).dump({"state_dict": state_dict})
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name)
+            else:
+                sys.modules[name] = module
+
+    block = np.random.default_rng(0).standard_normal(numel, dtype=np.float32).tobytes()
+    with open(path, "wb") as f, zipfile.ZipFile(f, "w") as zip_file:
+        # torch.save writes the pickle first and the storages sorted by key
+        zip_file.writestr(_aligned_info("archive/data.pkl", f.tell()), buffer.getvalue())
+        for key in keys:
+            zip_file.writestr(_aligned_info(f"archive/data/{key}", f.tell()), block)
+    return numel * 4 * num_tensors
+
+
+# --------------------------------------------------
+# former loader, the baseline
+# --------------------------------------------------
+
+
+def _legacy_get_data_iostream(file, file_name="data.pkl"):
+    FILENAME = f"archive/{file_name}".encode("latin")
+    padding_size_plus_fbxx = 4 + 14
+    data_iostream = []
+    offset = torch_loader.MZ_ZIP_LOCAL_DIR_HEADER_SIZE + len(FILENAME) + padding_size_plus_fbxx
+    with open(file, "rb") as r:
+        r.seek(offset)
+        for bytes_data in io.BytesIO(r.read()):
+            if b".PK" in bytes_data:
+                data_iostream.append(bytes_data.split(b".PK")[0])
+                data_iostream.append(b".")
+                break
+            data_iostream.append(bytes_data)
+    out = b"".join(data_iostream)
+    return out, offset + len(out)
+
+
+def _legacy_seek_by_string(file_handler, string, file_size):
+    word_index = 0
+    word_bytes = string.encode("latin")
+    empty_byte = "".encode("latin")
+
+    while word_index < len(string) and file_handler.tell() < file_size:
+        content = file_handler.read(1)
+        if content == empty_byte:
+            break
+
+        if word_bytes[word_index] == content[0]:
+            word_index += 1
+        else:
+            word_index = 0
+
+    if file_handler.tell() >= file_size - 1:
+        raise torch_loader.SerializationError(f"can't find the find the target string<{string}> in the file")
+    return file_handler.tell()
+
+
+def legacy_load_torch(path):
+    def persistent_load_stage1(saved_id):
+        storage_type, key, _, numel = saved_id[1:]
+        return torch_loader.TensorMeta(key, numel * torch_loader._element_size(storage_type.dtype), storage_type.dtype)
+
+    data_iostream, pre_offset = _legacy_get_data_iostream(path, file_name="data.pkl")
+    unpickler_stage1 = torch_loader.UnpicklerWrapperStage(io.BytesIO(data_iostream), encoding="utf-8")
+    unpickler_stage1.persistent_load = persistent_load_stage1
+    result_stage1 = unpickler_stage1.load()
+
+    metadata = {}
+
+    def extract_maybe_dict(result):
+        if isinstance(result, dict):
+            for v in result.values():
+                extract_maybe_dict(v)
+        elif isinstance(result, (list, tuple)):
+            for res in result:
+                extract_maybe_dict(res)
+        elif isinstance(result, torch_loader.TensorMeta):
+            metadata[result.key] = result
+
+    extract_maybe_dict(result_stage1)
+    metadata = sorted(metadata.values(), key=lambda x: x.key)
+    stage1_key_to_tensor = {}
+    content_size = os.stat(path).st_size
+    with open(path, "rb") as file_handler:
+        file_handler.seek(pre_offset)
+        for tensor_meta in metadata:
+            key = tensor_meta.key
+            _legacy_seek_by_string(file_handler, f"data/{key}", content_size)
+            _legacy_seek_by_string(file_handler, "FB", content_size)
+            padding_offset = np.frombuffer(file_handler.read(2)[:1], dtype=np.uint8)[0]
+            file_handler.seek(padding_offset, 1)
+            stage1_key_to_tensor[key] = np.frombuffer(
+                file_handler.read(tensor_meta.nbytes), dtype=tensor_meta.dtype
+            ).reshape(tensor_meta.size)
+
+    def persistent_load_stage2(saved_id):
+        return stage1_key_to_tensor[saved_id[2]]
+
+    unpickler_stage2 = torch_loader.UnpicklerWrapperStage(io.BytesIO(data_iostream), encoding="utf-8")
+    unpickler_stage2.persistent_load = persistent_load_stage2
+    return unpickler_stage2.load()
+
+
+# --------------------------------------------------
+# measurements
+# --------------------------------------------------
+
+
+def _peak_rss():
+    import resource
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _run(method, path, queue):
+    baseline_rss = _peak_rss()
+    tic = time.perf_counter()
+    if method == "legacy":
+        state_dict = legacy_load_torch(path)
+    elif method == "index":
+        state_dict = torch_loader.load_torch(path)
+    else:
+        state_dict = torch_loader.load_torch(path, use_mmap=True)
+        # a view costs nothing until it is read
+        for value in state_dict["state_dict"].values():
+            value.sum()
+    elapsed = time.perf_counter() - tic
+    queue.put((elapsed, len(state_dict["state_dict"]), _peak_rss() - baseline_rss))
+
+
+def measure(method, path):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run, args=(method, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size_gb", type=float, default=2.0, help="Size of the synthetic checkpoint.")
+    parser.add_argument("--num_tensors", type=int, default=1100, help="Number of tensors, about as many as SD 1.x.")
+    parser.add_argument("--path", type=str, default=None, help="Where to write the checkpoint, a temp file by default.")
+    parser.add_argument("--methods", type=str, default="legacy,index,index+mmap")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.gettempdir(), f"bench_load_torch_{args.size_gb:g}gb.ckpt")
+    tic = time.perf_counter()
+    nbytes = write_checkpoint(path, args.size_gb, args.num_tensors)
+    print(f"wrote {nbytes / 1024 ** 3:.2f} GB in {args.num_tensors} tensors to {path} ({time.perf_counter() - tic:.1f}s)")
+    try:
+        # warm the page cache so that every loader reads from memory
+        with open(path, "rb") as f:
+            while f.read(64 * 1024 * 1024):
+                pass
+        print(f"{'method':<12}{'time (s)':>10}{'tensors':>10}{'peak RSS (GB)':>16}")
+        for method in args.methods.split(","):
+            elapsed, num_tensors, peak_rss = measure(method, path)
+            print(f"{method:<12}{elapsed:>10.2f}{num_tensors:>10}{peak_rss / 1024 ** 3:>16.2f}")
+    finally:
+        if args.path is None:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Prompt weighting cost: parsing the attention brackets and tokenizing the weighted fragments.
+
+- parse: the former parser, kept here as the baseline, against `_parse_prompt_attention` without its cache and with
+  it, the UI parsing the same prompts at every run
+- tokenize: one tokenizer call per fragment, as before, against `get_prompts_with_weights`, which tokenizes the
+  fragments of all the prompts in one call and memoizes them per tokenizer, first with an empty memo and then warm
+
+The parsers are also checked to give the same fragments and bit-identical weights.
+
+    python benchmarks/bench_prompt_parsing.py --tokenizer model_weights/MoososCap/NOVEL-MODEL/tokenizer
+
+Without `--tokenizer`, a CLIP tokenizer with a byte-level vocabulary and no merges is used, which has the same
+per-call overhead but splits the words into more tokens.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline_stable_diffusion_all_in_one as pipeline  # noqa: E402
+
+PROMPTS = [
+    "The ancient Chinese city has a very dense array of buildings arranged in an orderly fashion from left to right. "
+    "From near to far, layer by layer\n, sunny day,(Blue sky with white clouds),(wide angle establishing shot),"
+    "(perspective),detailed render, (pixel art),2d game art,Studio Ghibli,",
+    "(Isometric),(Top down),lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, "
+    "cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry",
+    "masterpiece, best quality, ((1girl)), (solo:1.2), [[smile]], (long hair:1.1), ((school uniform)), "
+    "(cherry blossoms:0.8), [depth of field], (((highly detailed))), \\(cosplay\\)",
+    "a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).",
+]
+WORDS = ["red", "dress", "cat", "city", "night", "detailed", "sky", "girl", "light", "forest", "river", "snow"]
+
+
+def legacy_parse_prompt_attention(text):
+    res = []
+    round_brackets = []
+    square_brackets = []
+
+    round_bracket_multiplier = 1.1
+    square_bracket_multiplier = 1 / 1.1
+
+    def multiply_range(start_position, multiplier):
+        for p in range(start_position, len(res)):
+            res[p][1] *= multiplier
+
+    for m in pipeline.re_attention.finditer(text):
+        text = m.group(0)
+        weight = m.group(1)
+
+        if text.startswith("\\"):
+            res.append([text[1:], 1.0])
+        elif text == "(":
+            round_brackets.append(len(res))
+        elif text == "[":
+            square_brackets.append(len(res))
+        elif weight is not None and len(round_brackets) > 0:
+            multiply_range(round_brackets.pop(), float(weight))
+        elif text == ")" and len(round_brackets) > 0:
+            multiply_range(round_brackets.pop(), round_bracket_multiplier)
+        elif text == "]" and len(square_brackets) > 0:
+            multiply_range(square_brackets.pop(), square_bracket_multiplier)
+        else:
+            res.append([text, 1.0])
+
+    for pos in round_brackets:
+        multiply_range(pos, round_bracket_multiplier)
+
+    for pos in square_brackets:
+        multiply_range(pos, square_bracket_multiplier)
+
+    if len(res) == 0:
+        res = [["", 1.0]]
+
+    # merge runs of identical weights
+    i = 0
+    while i + 1 < len(res):
+        if res[i][1] == res[i + 1][1]:
+            res[i][0] += res[i + 1][0]
+            res.pop(i + 1)
+        else:
+            i += 1
+
+    return res
+
+
+def legacy_get_prompts_with_weights(pipe, prompt, max_length):
+    tokens = []
+    weights = []
+    for text in prompt:
+        texts_and_weights = legacy_parse_prompt_attention(text)
+        text_token = []
+        text_weight = []
+        for word, weight in texts_and_weights:
+            # tokenize and discard the starting and the ending token
+            token = pipe.tokenizer(word).input_ids[1:-1]
+            text_token += token
+
+            # copy the weight by length of token
+            text_weight += [weight] * len(token)
+
+            # stop if the text is too long (longer than truncation limit)
+            if len(text_token) > max_length:
+                break
+
+        # truncate
+        if len(text_token) > max_length:
+            text_token = text_token[:max_length]
+            text_weight = text_weight[:max_length]
+
+        tokens.append(text_token)
+        weights.append(text_weight)
+    return tokens, weights
+
+
+def random_prompt(rng, num_words=40):
+    """A prompt with nested, weighted and unbalanced brackets."""
+    parts = []
+    for _ in range(num_words):
+        word = rng.choice(WORDS)
+        kind = rng.random()
+        if kind < 0.2:
+            word = "(" * rng.randint(1, 3) + word + ")" * rng.randint(0, 3)
+        elif kind < 0.3:
+            word = f"({word}:{rng.uniform(0.5, 1.5):.2f})"
+        elif kind < 0.4:
+            word = "[" * rng.randint(1, 2) + word + "]" * rng.randint(0, 2)
+        parts.append(word)
+    return ", ".join(parts)
+
+
+def byte_level_tokenizer(directory):
+    from paddlenlp.transformers import CLIPTokenizer
+    from paddlenlp.transformers.clip.tokenizer import bytes_to_unicode
+
+    characters = list(bytes_to_unicode().values())
+    vocab = characters + [character + "</w>" for character in characters] + ["<|startoftext|>", "<|endoftext|>"]
+    with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(os.path.join(directory, "merges.txt"), "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(os.path.join(directory, "vocab.json"), os.path.join(directory, "merges.txt"))
+
+
+def best_time(function, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", type=str, default=None, help="A CLIP tokenizer directory.")
+    parser.add_argument("--num_prompts", type=int, default=1000, help="Random prompts added to the sample ones.")
+    parser.add_argument("--repeats", type=int, default=5, help="Runs of each kind, the fastest one is reported.")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    prompts = PROMPTS + [random_prompt(rng) for _ in range(args.num_prompts)]
+    num_fragments = sum(len(legacy_parse_prompt_attention(prompt)) for prompt in prompts)
+    print(f"{len(prompts)} prompts, {num_fragments} weighted fragments")
+
+    for prompt in prompts:
+        expected = [tuple(pair) for pair in legacy_parse_prompt_attention(prompt)]
+        assert list(pipeline._parse_prompt_attention(prompt)) == expected, prompt
+
+    uncached_parse = pipeline._parse_prompt_attention.__wrapped__
+    results = [
+        ("parse", "legacy", best_time(lambda: [legacy_parse_prompt_attention(p) for p in prompts], args.repeats)),
+        ("parse", "uncached", best_time(lambda: [uncached_parse(p) for p in prompts], args.repeats)),
+        ("parse", "cached", best_time(lambda: [pipeline._parse_prompt_attention(p) for p in prompts], args.repeats)),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.tokenizer is not None:
+            from paddlenlp.transformers import CLIPTokenizer
+
+            tokenizer = CLIPTokenizer.from_pretrained(args.tokenizer)
+        else:
+            tokenizer = byte_level_tokenizer(directory)
+        pipe = types.SimpleNamespace(tokenizer=tokenizer)
+        max_length = tokenizer.model_max_length * 3 - 2
+
+        expected = legacy_get_prompts_with_weights(pipe, prompts, max_length)
+        assert pipeline.get_prompts_with_weights(pipe, prompts, max_length) == expected
+
+        def cold():
+            pipeline._fragment_token_cache.pop(tokenizer, None)
+            pipeline.get_prompts_with_weights(pipe, prompts, max_length)
+
+        results += [
+            ("tokenize", "legacy", best_time(lambda: legacy_get_prompts_with_weights(pipe, prompts, max_length), 1)),
+            ("tokenize", "cold", best_time(cold, args.repeats)),
+            ("tokenize", "warm", best_time(lambda: pipeline.get_prompts_with_weights(pipe, prompts, max_length), 1)),
+        ]
+
+    print(f"{'stage':<10}{'method':<10}{'time (ms)':>12}{'per prompt (us)':>18}")
+    for stage, method, elapsed in results:
+        print(f"{stage:<10}{method:<10}{elapsed * 1e3:>12.2f}{elapsed / len(prompts) * 1e6:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Latency and peak memory of the VAE of SD 1.x with and without tiling (`enable_vae_tiling`), at 1024 and 2048 pixels.
+
+Every measurement runs in its own process, the peak RSS on CPU or the peak allocated memory on GPU is the increase
+over the process with the VAE loaded. A measurement which runs out of memory is reported as failed. The weights are
+random unless `--model_path` is given, which does not change the cost.
+
+    python benchmarks/bench_vae_tiling.py --sizes 1024 2048
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _peak_memory():
+    import paddle
+
+    if paddle.device.get_device() != "cpu":
+        return paddle.device.cuda.max_memory_allocated()
+    import resource
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _load_vae(model_path):
+    from ppdiffusers import AutoencoderKL
+
+    if model_path is not None:
+        return AutoencoderKL.from_pretrained(model_path, subfolder="vae")
+    return AutoencoderKL(
+        block_out_channels=(128, 256, 512, 512),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=2,
+        sample_size=512,
+    )
+
+
+def measure(model_path, stage, size, tiling, tile_size, overlap, queue):
+    import paddle
+
+    sys.path.insert(0, REPO_DIR)
+    from pipeline_stable_diffusion_all_in_one import StableDiffusionPipelineAllinOne
+
+    vae = _load_vae(model_path)
+    vae.eval()
+    # `vae_encode` and `vae_decode` only use these attributes of the pipeline
+    pipe = types.SimpleNamespace(vae=vae, vae_tiling=(tile_size, overlap) if tiling else None)
+    if stage == "encode":
+        x = paddle.randn([1, 3, size, size])
+        run = lambda: StableDiffusionPipelineAllinOne.vae_encode(pipe, x).sample()  # noqa: E731
+    else:
+        x = paddle.randn([1, 4, size // 8, size // 8])
+        run = lambda: StableDiffusionPipelineAllinOne.vae_decode(pipe, x)  # noqa: E731
+    baseline = _peak_memory()
+    with paddle.no_grad():
+        tic = time.perf_counter()
+        output = run()
+        float(output.mean())  # wait for the device
+        elapsed = time.perf_counter() - tic
+    queue.put((elapsed, _peak_memory() - baseline))
+
+
+def run_in_process(*args):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=measure, args=args + (queue,))
+    process.start()
+    process.join()
+    if process.exitcode != 0 or queue.empty():
+        return None
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model_path", type=str, default=None, help="A local model whose vae is used.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048], help="Image sizes in pixels.")
+    parser.add_argument("--stages", type=str, nargs="+", default=["decode", "encode"], choices=["decode", "encode"])
+    parser.add_argument("--tile_size", type=int, default=64, help="Tile size in latent pixels.")
+    parser.add_argument("--overlap", type=int, default=8, help="Tile overlap in latent pixels.")
+    args = parser.parse_args()
+
+    print(f"{'stage':<8}{'size':>6}{'tiling':>8}{'time (s)':>10}{'peak memory (GB)':>19}")
+    for stage in args.stages:
+        for size in args.sizes:
+            for tiling in (False, True):
+                result = run_in_process(args.model_path, stage, size, tiling, args.tile_size, args.overlap)
+                row = f"{stage:<8}{size:>6}{'on' if tiling else 'off':>8}"
+                if result is None:
+                    print(f"{row}{'failed (out of memory)':>29}")
+                else:
+                    elapsed, peak_memory = result
+                    print(f"{row}{elapsed:>10.2f}{peak_memory / 1024 ** 3:>19.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -79,6 +79,12 @@ config = {
         "checkpoint_path": '',
         'dump_path': 'outputs/convert'
     },
+    "pipeline": {
+        # load local models from memory mapped copies of their weights, written in the background on first load
+        "lazy_load": False,
+        # disk space for these copies in bytes
+        "max_weights_cache_bytes": 20 * 1024 ** 3,
+    },
 }
 
 try:
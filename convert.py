@@ -14,19 +14,15 @@
 
 from __future__ import annotations
 
-import io
 import os
-import pickle
-from functools import lru_cache
-
-import numpy as np
-from _io import BufferedReader
-
-MZ_ZIP_LOCAL_DIR_HEADER_SIZE = 30
 import argparse
+import copy
+import hashlib
+import json
+import sys
+import time
 import numpy as np
 import paddle
-import pickle
 from functools import lru_cache
 from paddlenlp.utils.downloader import get_path_from_url
 try:
@@ -36,6 +32,21 @@ except ImportError:
         "OmegaConf is required to convert the LDM checkpoints. Please install it with `pip install OmegaConf`."
     )
 from paddlenlp.transformers import CLIPTextModel, CLIPTokenizer
+try:
+    from .torch_loader import load_torch
+except ImportError:
+    # run as a script
+    from torch_loader import load_torch
+try:
+    from .flat_weights import FLAT_WEIGHTS_NAME, save_flat_weights
+except ImportError:
+    # run as a script
+    from flat_weights import FLAT_WEIGHTS_NAME, save_flat_weights
+try:
+    from .env import CACHE_DIR, compute_peak_rss
+except ImportError:
+    # run as a script
+    from env import CACHE_DIR, compute_peak_rss
 from ppdiffusers import (
     AutoencoderKL,
     DDIMScheduler,
@@ -49,246 +60,6 @@ from ppdiffusers import (
     DPMSolverMultistepScheduler
 )
 
-import io
-import os
-import pickle
-from functools import lru_cache
-
-import numpy as np
-from _io import BufferedReader
-
-MZ_ZIP_LOCAL_DIR_HEADER_SIZE = 30
-
-
-class TensorMeta:
-    """
-    metadata of tensor
-    """
-
-    def __init__(self, key: str, n_bytes: int, dtype: str):
-        self.key = key
-        self.nbytes = n_bytes
-        self.dtype = dtype
-        self.size = None
-
-    def __repr__(self):
-        return f"size: {self.size} key: {self.key}, nbytes: {self.nbytes}, dtype: {self.dtype}"
-
-
-class SerializationError(Exception):
-    """Exception for serialization"""
-
-    pass
-
-
-@lru_cache(maxsize=None)
-def _storage_type_to_dtype_to_map():
-    """convert storage type to numpy dtype"""
-    return {
-        "DoubleStorage": np.double,
-        "FloatStorage": np.float32,
-        "HalfStorage": np.half,
-        "LongStorage": np.int64,
-        "IntStorage": np.int32,
-        "ShortStorage": np.int16,
-        "CharStorage": np.int8,
-        "ByteStorage": np.uint8,
-        "BoolStorage": np.bool8,
-        "ComplexDoubleStorage": np.cdouble,
-        "ComplexFloatStorage": np.cfloat,
-    }
-
-
-class StorageType:
-    """Temp Class for Storage Type"""
-
-    def __init__(self, name):
-        self.dtype = _storage_type_to_dtype_to_map()[name]
-
-    def __str__(self):
-        return f"StorageType(dtype={self.dtype})"
-
-
-def _element_size(dtype: str) -> int:
-    """
-    Returns the element size for a dtype, in bytes
-    """
-    if dtype in [np.float16, np.float32, np.float64]:
-        return np.finfo(dtype).bits >> 3
-    elif dtype == np.bool8:
-        return 1
-    else:
-        return np.iinfo(dtype).bits >> 3
-
-
-class UnpicklerWrapperStage(pickle.Unpickler):
-    def find_class(self, mod_name, name):
-        if type(name) is str and "Storage" in name:
-            try:
-                return StorageType(name)
-            except KeyError:
-                pass
-
-        # pure torch tensor builder
-        if mod_name == "torch._utils":
-            return _rebuild_tensor_stage
-
-        # pytorch_lightning tensor builder
-        if "pytorch_lightning" in mod_name:
-            return dumpy
-        return super().find_class(mod_name, name)
-
-
-def get_data_iostream(file: str, file_name="data.pkl"):
-    FILENAME = f"archive/{file_name}".encode("latin")
-    padding_size_plus_fbxx = 4 + 14
-    data_iostream = []
-    offset = MZ_ZIP_LOCAL_DIR_HEADER_SIZE + len(FILENAME) + padding_size_plus_fbxx
-    with open(file, "rb") as r:
-        r.seek(offset)
-        for bytes_data in io.BytesIO(r.read()):
-            if b".PK" in bytes_data:
-                data_iostream.append(bytes_data.split(b".PK")[0])
-                data_iostream.append(b".")
-                break
-            data_iostream.append(bytes_data)
-    out = b"".join(data_iostream)
-    return out, offset + len(out)
-
-
-def _rebuild_tensor_stage(storage, storage_offset, size, stride, requires_grad, backward_hooks):
-    if isinstance(storage, TensorMeta):
-        storage.size = size
-    return storage
-
-
-def dumpy(*args, **kwarsg):
-    return None
-
-
-def seek_by_string(file_handler: BufferedReader, string: str, file_size: int) -> int:
-    """seek the index of file-handler with target words
-
-    Args:
-        file_handler (BufferedReader): file handler
-        string (str): the specific string in the file
-        file_size (int): size of file
-
-    Returns:
-        int: end index of target string
-    """
-    word_index = 0
-    word_bytes = string.encode("latin")
-    empty_byte = "".encode("latin")
-
-    while word_index < len(string) and file_handler.tell() < file_size:
-        content = file_handler.read(1)
-        if content == empty_byte:
-            break
-
-        if word_bytes[word_index] == content[0]:
-            word_index += 1
-        else:
-            word_index = 0
-
-    if file_handler.tell() >= file_size - 1:
-        raise SerializationError(f"can't find the find the target string<{string}> in the file")
-    return file_handler.tell()
-
-
-def read_prefix_key(file_handler: BufferedReader, file_size: int):
-    """read the prefix key in model weight file, eg: archive/pytorch_model
-
-    Args:
-        file_handler (BufferedReader): file handler
-        fiel_size (_type_): size of file
-
-    Returns:
-        _type_: _description_
-    """
-    end_index = seek_by_string(file_handler, "data.pkl", file_size)
-    file_handler.seek(MZ_ZIP_LOCAL_DIR_HEADER_SIZE)
-    prefix_key = file_handler.read(end_index - MZ_ZIP_LOCAL_DIR_HEADER_SIZE - len("/data.pkl"))
-    return prefix_key
-
-
-def load_torch(path: str, **pickle_load_args):
-    """
-    load torch weight file with the following steps:
-
-    1. load the structure of pytorch weight file
-    2. read the tensor data and re-construct the state-dict
-
-    Args:
-        path: the path of pytorch weight file
-        **pickle_load_args: args of pickle module
-
-    Returns:
-
-    """
-    pickle_load_args.update({"encoding": "utf-8"})
-
-    # 1. load the structure of pytorch weight file
-    def persistent_load_stage1(saved_id):
-        assert isinstance(saved_id, tuple)
-        data = saved_id[1:]
-        storage_type, key, _, numel = data
-        dtype = storage_type.dtype
-        n_bytes = numel * _element_size(dtype)
-        return TensorMeta(key, n_bytes, dtype)
-
-    data_iostream, pre_offset = get_data_iostream(path, file_name="data.pkl")
-    # 1. read the structure of storage
-    unpickler_stage1 = UnpicklerWrapperStage(io.BytesIO(data_iostream), **pickle_load_args)
-    unpickler_stage1.persistent_load = persistent_load_stage1
-    result_stage1 = unpickler_stage1.load()
-
-    # 2. get the metadata of weight file
-    metadata = {}
-
-    def extract_maybe_dict(result):
-        if isinstance(result, dict):
-            for k, v in result.items():
-                extract_maybe_dict(v)
-        elif isinstance(result, (list, tuple)):
-            for res in result:
-                extract_maybe_dict(res)
-        elif isinstance(result, TensorMeta):
-            metadata[result.key] = result
-
-    extract_maybe_dict(result_stage1)
-    metadata = list(metadata.values())
-    metadata = sorted(metadata, key=lambda x: x.key)
-    # 3. parse the tensor of pytorch weight file
-    stage1_key_to_tensor = {}
-    content_size = os.stat(path).st_size
-    with open(path, "rb") as file_handler:
-        file_handler.seek(pre_offset)
-        for tensor_meta in metadata:
-            key = tensor_meta.key            
-            seek_by_string(file_handler, f"data/{key}", content_size)
-            seek_by_string(file_handler, "FB", content_size)
-
-            padding_offset = np.frombuffer(file_handler.read(2)[:1], dtype=np.uint8)[0]
-            file_handler.seek(padding_offset, 1)
-
-            # save the tensor info in result to re-use memory
-            stage1_key_to_tensor[key] = np.frombuffer(
-                file_handler.read(tensor_meta.nbytes), dtype=tensor_meta.dtype
-            ).reshape(tensor_meta.size)
-
-    def persistent_load_stage2(saved_id):
-        assert isinstance(saved_id, tuple)
-        key = saved_id[2]
-        return stage1_key_to_tensor[key]
-
-    # 4. read the structure of storage
-    unpickler_stage2 = UnpicklerWrapperStage(io.BytesIO(data_iostream), **pickle_load_args)
-    unpickler_stage2.persistent_load = persistent_load_stage2
-    result_stage2 = unpickler_stage2.load()
-
-    return result_stage2
-
 
 def shave_segments(path, n_shave_prefix_segments=1):
     """
@@ -528,6 +299,89 @@ def create_diffusers_schedular(original_config):
     )
     return schedular
 
+KEY_TABLE_CACHE_DIR = os.path.join(CACHE_DIR, "key_tables")
+
+
+class KeyTracer:
+    """
+    Stands for a tensor of the checkpoint while compiling a key table, and records the slicing applied to it.
+    """
+
+    def __init__(self, key, ndim, ops=()):
+        self.key = key
+        self.ndim = ndim
+        self.ops = ops
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        # the mappings only drop the trailing dimensions of the 1x1 convolutions, e.g. `[:, :, 0]`
+        op = []
+        for i in index:
+            if isinstance(i, int):
+                op.append(i)
+            elif isinstance(i, slice) and i == slice(None):
+                op.append(None)
+            else:
+                raise TypeError(f"Unsupported index {index} of {self.key} in a key table!")
+        ndim = self.ndim - sum(isinstance(i, int) for i in op)
+        return KeyTracer(self.key, ndim, self.ops + (tuple(op),))
+
+
+def compute_key_table_hash(component, config, state_dict):
+    """hash of everything the key mapping depends on: the config, the keys and the number of dimensions"""
+    sha256 = hashlib.sha256(component.encode())
+    sha256.update(json.dumps(config, sort_keys=True, default=list).encode())
+    for key in sorted(state_dict):
+        sha256.update(f"{key}:{state_dict[key].ndim};".encode())
+    return sha256.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _read_key_table(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [(new_key, old_key, tuple(tuple(op) for op in ops)) for new_key, old_key, ops in json.load(f)]
+
+
+def get_key_table(component, config, state_dict, map_keys):
+    """
+    Returns the list of `(new_key, old_key, ops)` converting `state_dict` of the given component.
+
+    The table is compiled once by running `map_keys` on tracers of the tensors, and cached on the disk under
+    `KEY_TABLE_CACHE_DIR`.
+    """
+    table_hash = compute_key_table_hash(component, config, state_dict)
+    path = os.path.join(KEY_TABLE_CACHE_DIR, f"{component}-{table_hash[:32]}.json")
+    if os.path.exists(path):
+        try:
+            return _read_key_table(path)
+        except (OSError, ValueError):
+            pass
+
+    tracers = {key: KeyTracer(key, value.ndim) for key, value in state_dict.items()}
+    table = [(new_key, tracer.key, tracer.ops) for new_key, tracer in map_keys(tracers, config).items()]
+    try:
+        os.makedirs(KEY_TABLE_CACHE_DIR, exist_ok=True)
+        # written atomically, the conversion workers may compile the same table concurrently
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(table, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+    return table
+
+
+def apply_key_table(state_dict, table):
+    """converts a state dict with a key table in a single pass"""
+    new_state_dict = {}
+    for new_key, old_key, ops in table:
+        value = state_dict[old_key]
+        for op in ops:
+            value = value[tuple(slice(None) if i is None else i for i in op)]
+        new_state_dict[new_key] = value
+    return new_state_dict
+
+
 def convert_ldm_unet_checkpoint(checkpoint, config, path=None, extract_ema=False):
     """
     Takes a state dict and a config, and returns a converted checkpoint.
@@ -568,6 +422,13 @@ def convert_ldm_unet_checkpoint(checkpoint, config, path=None, extract_ema=False
             
     if len(unet_state_dict) == 0:
         return None
+    return apply_key_table(unet_state_dict, get_key_table("unet", config, unet_state_dict, map_ldm_unet_keys))
+
+
+def map_ldm_unet_keys(unet_state_dict, config):
+    """
+    Maps the LDM UNet state dict to the diffusers naming, used to compile the key table of `get_key_table`.
+    """
     new_checkpoint = {}
 
     new_checkpoint["time_embedding.linear_1.weight"] = unet_state_dict["time_embed.0.weight"]
@@ -735,6 +596,13 @@ def convert_ldm_vae_checkpoint(checkpoint, config, only_vae=False):
     
     if len(vae_state_dict) == 0:
         return None
+    return apply_key_table(vae_state_dict, get_key_table("vae", config, vae_state_dict, map_ldm_vae_keys))
+
+
+def map_ldm_vae_keys(vae_state_dict, config):
+    """
+    Maps the LDM VAE state dict to the diffusers naming, used to compile the key table of `get_key_table`.
+    """
     new_checkpoint = {}
 
     new_checkpoint["encoder.conv_in.weight"] = vae_state_dict["encoder.conv_in.weight"]
@@ -834,10 +702,15 @@ def convert_ldm_vae_checkpoint(checkpoint, config, only_vae=False):
 
 
 def convert_diffusers_vae_unet_to_ppdiffusers(vae_or_unet, diffusers_vae_unet_checkpoint, dtype="float32"):
-    need_transpose = []
-    for k, v in vae_or_unet.named_sublayers(include_self=True):
-        if isinstance(v, paddle.nn.Linear):
-            need_transpose.append(k + ".weight")
+    if vae_or_unet is not None:
+        need_transpose = []
+        for k, v in vae_or_unet.named_sublayers(include_self=True):
+            if isinstance(v, paddle.nn.Linear):
+                need_transpose.append(k + ".weight")
+    else:
+        # without the model, rely on the fact that only the nn.Linear weights are 2-D in the unet and the vae
+        need_transpose = [k for k, v in diffusers_vae_unet_checkpoint.items() if v.ndim == 2]
+    need_transpose = set(need_transpose)
     new_vae_or_unet = {}
     for k, v in diffusers_vae_unet_checkpoint.items():
         if k not in need_transpose:
@@ -927,6 +800,245 @@ def convert_hf_clip_to_ppnlp_clip(checkpoint, dtype="float32"):
     }
     return new_model_state, new_config
 
+def save_converted_component(
+    state_dict, config, save_dir, config_name="config.json", output_format="pdparams", dtype="float32"
+):
+    """write the converted numpy weights and the config of a component as `save_pretrained` would"""
+    os.makedirs(save_dir, exist_ok=True)
+    with open(os.path.join(save_dir, config_name), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    if output_format == "flat":
+        save_flat_weights(state_dict, os.path.join(save_dir, FLAT_WEIGHTS_NAME), dtype=dtype)
+    else:
+        paddle.save(state_dict, os.path.join(save_dir, "model_state.pdparams"))
+
+
+def convert_component_streaming(component, args, original_config, image_size=512, use_mmap=True, checkpoint=None):
+    """
+    convert one of the `unet`, `vae` or `text_encoder` components and write it to `args.dump_path` directly from the
+    converted numpy arrays, without building the paddle model
+
+    Returns:
+        bool: whether the weights of the component were found in the checkpoint
+    """
+    import ppdiffusers
+
+    if checkpoint is None:
+        # in a worker process, the memory mapped checkpoint is shared with the other workers through the page cache
+        checkpoint = load_torch(args.checkpoint_path, use_mmap=use_mmap)
+        checkpoint = checkpoint.get("state_dict", checkpoint)
+
+    dtype = getattr(args, "dtype", None) or "float32"
+    output_format = getattr(args, "output_format", None) or "pdparams"
+    # numpy has no bfloat16, the weights are rounded when written
+    array_dtype = "float32" if dtype == "bfloat16" else dtype
+    save_kwargs = dict(output_format=output_format, dtype=dtype)
+
+    if component == "unet":
+        config = create_unet_diffusers_config(original_config, image_size=image_size)
+        state_dict = convert_ldm_unet_checkpoint(
+            checkpoint, config, path=args.checkpoint_path, extract_ema=args.extract_ema
+        )
+        if state_dict is None:
+            return False
+        state_dict = convert_diffusers_vae_unet_to_ppdiffusers(None, state_dict, dtype=array_dtype)
+        config = dict(config, _class_name="UNet2DConditionModel", _diffusers_version=ppdiffusers.__version__)
+        save_converted_component(state_dict, config, os.path.join(args.dump_path, "unet"), **save_kwargs)
+    elif component == "vae":
+        config = create_vae_diffusers_config(original_config, image_size=image_size)
+        if args.vae_checkpoint_path is not None:
+            checkpoint = load_torch(args.vae_checkpoint_path, use_mmap=use_mmap)
+        state_dict = convert_ldm_vae_checkpoint(checkpoint, config, only_vae=args.vae_checkpoint_path is not None)
+        if state_dict is None:
+            return False
+        state_dict = convert_diffusers_vae_unet_to_ppdiffusers(None, state_dict, dtype=array_dtype)
+        config = dict(config, _class_name="AutoencoderKL", _diffusers_version=ppdiffusers.__version__)
+        save_converted_component(state_dict, config, os.path.join(args.dump_path, "vae"), **save_kwargs)
+    elif component == "text_encoder":
+        state_dict, config = convert_hf_clip_to_ppnlp_clip(checkpoint, dtype=array_dtype)
+        if state_dict is None:
+            return False
+        config = dict(config, init_class="CLIPTextModel")
+        save_converted_component(
+            state_dict, config, os.path.join(args.dump_path, "text_encoder"), "model_config.json", **save_kwargs
+        )
+    else:
+        raise ValueError(f"Unknown component {component}!")
+    return True
+
+
+def convert_streaming(args, checkpoint, original_config, scheduler, image_size=512, use_mmap=True, num_workers=1):
+    """
+    convert the components one after another, so that a single component is held in memory at once, or concurrently
+    in `num_workers` processes which share the memory mapped checkpoint
+    """
+    import ppdiffusers
+
+    components = ["unet", "vae", "text_encoder"]
+    component_names = {"unet": "Unet", "vae": "Vae", "text_encoder": "text_encoder"}
+    not_found_names = {"unet": "Unet", "vae": "Vae", "text_encoder": "TextModel"}
+    found = {}
+    if args.vae_checkpoint_path is not None:
+        print(f"发现 {args.vae_checkpoint_path}，我们将转换该文件的vae权重！")
+    if num_workers > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        print(f"1-3. 开始使用 {min(num_workers, len(components))} 个进程同时转换Unet、Vae和text_encoder！")
+        # fork is unsafe once paddle is initialized
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(components)), mp_context=context) as executor:
+            futures = {
+                component: executor.submit(
+                    convert_component_streaming, component, args, original_config, image_size, use_mmap
+                )
+                for component in components
+            }
+            for component in components:
+                found[component] = futures[component].result()
+                if found[component]:
+                    print(f">>> {component_names[component]}转换成功！")
+                else:
+                    print(f"在CKPT中，未发现{not_found_names[component]}权重，请确认是否存在！")
+    else:
+        for i, component in enumerate(components):
+            print(f"{i + 1}. 开始转换{component_names[component]}！")
+            found[component] = convert_component_streaming(
+                component, args, original_config, image_size, use_mmap, checkpoint=checkpoint
+            )
+            if found[component]:
+                print(f">>> {component_names[component]}转换成功！")
+            else:
+                print(f"在CKPT中，未发现{not_found_names[component]}权重，请确认是否存在！")
+
+    print("4. 开始转换CLIPTokenizer！")
+    tokenizer = load_clip_tokenizer()
+    tokenizer.save_pretrained(os.path.join(args.dump_path, "tokenizer"))
+    scheduler.save_pretrained(os.path.join(args.dump_path, "scheduler"))
+    print(">>> CLIPTokenizer 转换成功！")
+
+    if all(found.values()):
+        model_index = {
+            "_class_name": "StableDiffusionPipeline",
+            "_diffusers_version": ppdiffusers.__version__,
+            "feature_extractor": [None, None],
+            "requires_safety_checker": False,
+            "safety_checker": [None, None],
+            "scheduler": ["ppdiffusers", scheduler.__class__.__name__],
+            "text_encoder": ["paddlenlp.transformers", "CLIPTextModel"],
+            "tokenizer": ["paddlenlp.transformers", "CLIPTokenizer"],
+            "unet": ["ppdiffusers", "UNet2DConditionModel"],
+            "vae": ["ppdiffusers", "AutoencoderKL"],
+        }
+        with open(os.path.join(args.dump_path, "model_index.json"), "w", encoding="utf-8") as f:
+            json.dump(model_index, f, indent=2, sort_keys=True)
+        print(">>> 所有权重转换完成啦，请前往"+str(args.dump_path)+"查看转换好的模型！")
+    else:
+        print(">>> 部分权重转换完成啦，请前往"+str(args.dump_path)+"查看转换好的部分模型！")
+
+
+@lru_cache(maxsize=None)
+def _load_original_config(path, mtime):
+    return OmegaConf.load(path)
+
+
+def load_original_config(path):
+    """load the LDM yaml config once per process, the caller must not modify it"""
+    return _load_original_config(os.path.abspath(path), os.stat(path).st_mtime)
+
+
+@lru_cache(maxsize=None)
+def load_clip_tokenizer():
+    """load the tokenizer saved with every converted model once per process"""
+    return CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14", pad_token="!", model_max_length=77)
+
+
+def compute_file_hash(path, chunk_size=16 * 1024 * 1024):
+    """sha256 of the content of a file"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def compute_available_ram():
+    """available memory of the host in bytes, or None if it is unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def estimate_conversion_memory(path):
+    """upper bound of the memory of a streaming conversion: the float32 unet of a float16 checkpoint is twice as large"""
+    return 2 * os.path.getsize(path)
+
+
+class ConversionCache:
+    """
+    results of the batch conversions, stored as json in the output directory
+
+    The content hash of every checkpoint is kept with its size and mtime, so unchanged files are not hashed again,
+    and every conversion (the hashes of the checkpoints and the options changing the output) is mapped to the
+    directory of its converted model.
+    """
+
+    # the arguments of `main` which change the converted model
+    OUTPUT_OPTIONS = ("original_config_file", "num_in_channels", "scheduler_type", "extract_ema", "dtype", "output_format")
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.outputs = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.files = data.get("files", {})
+                self.outputs = data.get("outputs", {})
+            except (OSError, ValueError):
+                print(f"{path} 已损坏，我们将重新建立转换记录！")
+
+    def get_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.files.get(path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["sha256"]
+        sha256 = compute_file_hash(path)
+        self.files[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+        return sha256
+
+    @classmethod
+    def make_output_key(cls, args, sha256, vae_sha256=None):
+        options = {name: getattr(args, name, None) for name in cls.OUTPUT_OPTIONS}
+        key = json.dumps({"sha256": sha256, "vae_sha256": vae_sha256, "options": options}, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_output(self, key):
+        output = self.outputs.get(key)
+        # the converted model may have been deleted since
+        if output is not None and os.path.exists(os.path.join(output, "model_index.json")):
+            return output
+        return None
+
+    def set_output(self, key, output):
+        output = os.path.abspath(output)
+        # the conversions previously written there were overwritten
+        self.outputs = {k: v for k, v in self.outputs.items() if v != output}
+        self.outputs[key] = output
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.files, "outputs": self.outputs}, f, indent=2, sort_keys=True)
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
@@ -964,7 +1076,77 @@ def parse_args():
             " higher quality images for inference. Non-EMA weights are usually better to continue fine-tuning."
         ),
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Convert the components one after another and write their weights directly, without building the"
+            " paddle models. The peak memory is about the size of the largest component."
+        ),
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=1,
+        type=int,
+        help=(
+            "Number of processes converting the unet, the vae and the text_encoder concurrently. Values above 1 imply"
+            " `--streaming` and can't be combined with `--no_mmap`."
+        ),
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        type=str,
+        choices=["float32", "float16", "bfloat16"],
+        help="Precision of the converted weights. float16 and bfloat16 imply `--output_format flat`.",
+    )
+    parser.add_argument(
+        "--output_format",
+        default="pdparams",
+        type=str,
+        choices=["pdparams", "flat"],
+        help=(
+            "`pdparams` saves the weights as pickled model_state.pdparams, `flat` as a single header-indexed"
+            " model_state.flat file which `StableDiffusionFriendlyPipeline` memory-maps. Implies `--streaming`."
+        ),
+    )
+    parser.add_argument(
+        "--no_mmap",
+        action="store_true",
+        help=(
+            "Read every tensor of the checkpoints into memory instead of memory-mapping them. By default only the"
+            " weights actually converted (e.g. the EMA ones) are loaded."
+        ),
+    )
     parser.add_argument("--dump_path", default=None, type=str, help="Path to the output model.")
+    parser.add_argument(
+        "--checkpoint_dir",
+        default=None,
+        type=str,
+        help="Convert every .ckpt file of this directory into a sub-directory of `--dump_path` named after the file.",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        type=str,
+        help=(
+            "Text file listing one checkpoint per line, or json list of checkpoint paths or of objects with"
+            " `checkpoint_path` and optional `vae_checkpoint_path` and `dump_path`, to convert in a batch."
+        ),
+    )
+    parser.add_argument("--batch_jobs", default=1, type=int, help="Number of checkpoints converted concurrently.")
+    parser.add_argument(
+        "--memory_budget",
+        default=None,
+        type=float,
+        help="Memory in GB the concurrent conversions may use. Defaults to the memory available at start.",
+    )
+    parser.add_argument(
+        "--summary_path",
+        default=None,
+        type=str,
+        help="Where to write the json summary of a batch. Defaults to `convert_summary.json` in `--dump_path`.",
+    )
     args = parser.parse_known_args()[0]
     return args
 
@@ -985,14 +1167,25 @@ def main(args): #主函数
             args.vae_checkpoint_path = None
     print("正在开始转换，请耐心等待！！！")
     image_size = 512
-    checkpoint = load_torch(args.checkpoint_path)
-    checkpoint = checkpoint.get("state_dict", checkpoint)
+    use_mmap = not getattr(args, "no_mmap", False)
+    num_workers = getattr(args, "num_workers", None) or 1
+    if num_workers > 1 and not use_mmap:
+        # every worker would read the whole checkpoint into its own memory
+        raise ValueError("`--no_mmap` can't be used with `--num_workers` greater than 1.")
+    if num_workers > 1:
+        # the workers load the checkpoint themselves
+        checkpoint = None
+    else:
+        checkpoint = load_torch(args.checkpoint_path, use_mmap=use_mmap)
+        checkpoint = checkpoint.get("state_dict", checkpoint)
     if args.original_config_file is None:
-        get_path_from_url("https://paddlenlp.bj.bcebos.com/models/community/CompVis/stable-diffusion-v1-4/v1-inference.yaml", root_dir="./")
+        if not os.path.exists("./v1-inference.yaml"):
+            get_path_from_url("https://paddlenlp.bj.bcebos.com/models/community/CompVis/stable-diffusion-v1-4/v1-inference.yaml", root_dir="./")
 
         args.original_config_file = "./v1-inference.yaml"
 
-    original_config = OmegaConf.load(args.original_config_file)
+    # the cached config is shared by the conversions of a batch
+    original_config = copy.deepcopy(load_original_config(args.original_config_file))
 
     if args.num_in_channels is not None:
         original_config["model"]["params"]["unet_config"]["params"]["in_channels"] = args.num_in_channels
@@ -1032,6 +1225,20 @@ def main(args): #主函数
     else:
         raise ValueError(f"Scheduler of type {args.scheduler_type} doesn't exist!")
 
+    if (getattr(args, "dtype", None) or "float32") != "float32" and getattr(args, "output_format", None) != "flat":
+        print(f"{args.dtype} 权重将以 {FLAT_WEIGHTS_NAME} 格式保存！")
+        args.output_format = "flat"
+    if getattr(args, "streaming", False) or num_workers > 1 or getattr(args, "output_format", None) == "flat":
+        convert_streaming(
+            args, checkpoint, original_config, scheduler, image_size=image_size, use_mmap=use_mmap, num_workers=num_workers
+        )
+        peak_rss = compute_peak_rss()
+        if peak_rss is not None:
+            print(f"转换过程的内存峰值为 {peak_rss / 1024 ** 3:.2f} GB")
+        if num_workers > 1 and compute_peak_rss(children=True) is not None:
+            print(f"转换进程的内存峰值为 {compute_peak_rss(children=True) / 1024 ** 3:.2f} GB")
+        return
+
     print("1. 开始转换Unet！")
     # 1. Convert the UNet2DConditionModel model.
     diffusers_unet_config = create_unet_diffusers_config(original_config, image_size=image_size)
@@ -1052,7 +1259,7 @@ def main(args): #主函数
     # 2. Convert the VAE model.
     vae_config = create_vae_diffusers_config(original_config, image_size=image_size)
     if args.vae_checkpoint_path is not None:
-        vae_checkpoint = load_torch(args.vae_checkpoint_path)
+        vae_checkpoint = load_torch(args.vae_checkpoint_path, use_mmap=use_mmap)
         print(f"发现 {args.vae_checkpoint_path}，我们将转换该文件的vae权重！")
         only_vae = True
     else:
@@ -1084,7 +1291,7 @@ def main(args): #主函数
 
     print("4. 开始转换CLIPTokenizer！")
     # 4. Convert the tokenizer.
-    tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14", pad_token="!", model_max_length=77)
+    tokenizer = load_clip_tokenizer()
     print(">>> CLIPTokenizer 转换成功！")
     
     if text_model is not None and vae is not None and unet is not None:
@@ -1110,4 +1317,156 @@ def main(args): #主函数
         scheduler.save_pretrained(os.path.join(args.dump_path, "scheduler"))
         tokenizer.save_pretrained(os.path.join(args.dump_path, "tokenizer"))
         print(">>> 部分权重转换完成啦，请前往"+str(args.dump_path)+"查看转换好的部分模型！")
-        
+
+    peak_rss = compute_peak_rss()
+    if peak_rss is not None:
+        print(f"转换过程的内存峰值为 {peak_rss / 1024 ** 3:.2f} GB")
+
+
+def collect_batch_jobs(args):
+    """list the conversions of a batch from `--checkpoint_dir` and `--manifest`"""
+    jobs = []
+    if args.checkpoint_dir is not None:
+        for name in sorted(os.listdir(args.checkpoint_dir)):
+            if name.endswith(".ckpt"):
+                jobs.append({"checkpoint_path": os.path.join(args.checkpoint_dir, name)})
+    if args.manifest is not None:
+        with open(args.manifest, "r", encoding="utf-8") as f:
+            if args.manifest.endswith(".json"):
+                entries = json.load(f)
+            else:
+                entries = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        for entry in entries:
+            jobs.append({"checkpoint_path": entry} if isinstance(entry, str) else dict(entry))
+    for job in jobs:
+        if job.get("dump_path") is None:
+            name = os.path.splitext(os.path.basename(job["checkpoint_path"]))[0]
+            job["dump_path"] = os.path.join(args.dump_path, name)
+    return jobs
+
+
+def run_conversion_job(args, job):
+    """convert a checkpoint of a batch, in the current process or in a worker"""
+    job_args = copy.copy(args)
+    job_args.checkpoint_path = job["checkpoint_path"]
+    job_args.vae_checkpoint_path = job.get("vae_checkpoint_path")
+    job_args.dump_path = job["dump_path"]
+    job_args.checkpoint_dir = job_args.manifest = None
+    # the conversions of a batch never build the paddle models
+    job_args.streaming = True
+    tic = time.perf_counter()
+    try:
+        main(job_args)
+    except Exception as e:
+        return {"status": "failed", "error": f"{type(e).__name__}: {e}", "seconds": time.perf_counter() - tic}
+    status = "converted" if os.path.exists(os.path.join(job["dump_path"], "model_index.json")) else "partial"
+    return {"status": status, "seconds": time.perf_counter() - tic}
+
+
+def copy_converted_model(src, dst):
+    """copy a converted model; not hard links, a later conversion into either directory rewrites the files in place"""
+    import shutil
+
+    shutil.copytree(src, dst, dirs_exist_ok=True)
+
+
+def main_batch(args):
+    """convert all the checkpoints of `--checkpoint_dir` and `--manifest`, skipping the ones already converted"""
+    if args.dump_path is None:
+        print("批量转换必须给出 --dump_path！")
+        return None
+    jobs = collect_batch_jobs(args)
+    if len(jobs) == 0:
+        print("没有发现需要转换的ckpt文件！")
+        return None
+
+    cache = ConversionCache(os.path.join(args.dump_path, "convert_cache.json"))
+    summary = []
+    pending = []
+    for job in jobs:
+        record = {"checkpoint_path": job["checkpoint_path"], "dump_path": job["dump_path"]}
+        summary.append(record)
+        if not os.path.exists(job["checkpoint_path"]):
+            record.update(status="failed", error="file not found", seconds=0.0)
+            continue
+        vae_checkpoint_path = job.get("vae_checkpoint_path")
+        if vae_checkpoint_path is not None and not os.path.exists(vae_checkpoint_path):
+            record.update(status="failed", error="vae file not found", seconds=0.0)
+            continue
+        tic = time.perf_counter()
+        record["sha256"] = cache.get_hash(job["checkpoint_path"])
+        vae_sha256 = cache.get_hash(vae_checkpoint_path) if vae_checkpoint_path is not None else None
+        record["hash_seconds"] = time.perf_counter() - tic
+        job["output_key"] = cache.make_output_key(args, record["sha256"], vae_sha256)
+        output = cache.get_output(job["output_key"])
+        if output is not None:
+            tic = time.perf_counter()
+            if os.path.abspath(output) != os.path.abspath(job["dump_path"]):
+                copy_converted_model(output, job["dump_path"])
+                cache.set_output(job["output_key"], job["dump_path"])
+            print(f"{job['checkpoint_path']} 已转换过，跳过！转换结果位于 {job['dump_path']}")
+            record.update(status="cached", cached_from=output, seconds=time.perf_counter() - tic)
+            continue
+        pending.append((job, record))
+    cache.save()
+
+    def on_done(job, record, result):
+        record.update(result)
+        if result["status"] == "converted":
+            cache.set_output(job["output_key"], job["dump_path"])
+            cache.save()
+        print(f"{job['checkpoint_path']}: {result['status']}, 用时 {result['seconds']:.1f}s")
+
+    batch_jobs = max(1, args.batch_jobs or 1)
+    if batch_jobs == 1:
+        # the config and the tokenizer are loaded once for the whole batch
+        for job, record in pending:
+            on_done(job, record, run_conversion_job(args, job))
+    else:
+        import multiprocessing
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        if args.memory_budget is not None:
+            memory_budget = args.memory_budget * 1024 ** 3
+        else:
+            memory_budget = compute_available_ram()
+        # a job never spawns its own workers inside the pool
+        args = copy.copy(args)
+        args.num_workers = 1
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=batch_jobs, mp_context=context) as executor:
+            running = {}
+            while pending or running:
+                # start the next jobs while they fit in the memory budget, at least one job runs at once
+                while pending and len(running) < batch_jobs:
+                    job, record = pending[0]
+                    memory = estimate_conversion_memory(job["checkpoint_path"])
+                    used = sum(memory for _, _, memory in running.values())
+                    if running and memory_budget is not None and used + memory > memory_budget:
+                        break
+                    pending.pop(0)
+                    running[executor.submit(run_conversion_job, args, job)] = (job, record, memory)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, record, _ = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. the worker was killed when running out of memory
+                        result = {"status": "failed", "error": f"{type(e).__name__}: {e}", "seconds": 0.0}
+                    on_done(job, record, result)
+
+    summary_path = args.summary_path or os.path.join(args.dump_path, "convert_summary.json")
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    print(f">>> 批量转换完成，转换记录已保存至 {summary_path}")
+    return summary
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.checkpoint_dir is not None or args.manifest is not None:
+        main_batch(args)
+    else:
+        main(args)
@@ -1,3 +1,17 @@
+import os
+import sys
 
 DEBUG_UI = False
 
+# the model catalog, the weights, the key tables and the latents are cached under it
+CACHE_DIR = os.environ.get('PPDIFFUSERS_SD_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ppdiffusers_sd'))
+
+def compute_peak_rss(children = False):
+    """Return the peak resident memory of the process (or of its largest child process) in bytes, or None if it is unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
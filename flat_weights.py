@@ -0,0 +1,211 @@
+"""
+A flat single-file weight format which can be memory mapped:
+
+- 8 bytes: little-endian uint64 size N of the header
+- N bytes: json header {key: {"dtype", "shape", "offsets": [begin, end]}, "__metadata__": {...}}, padded with
+  spaces so that the data is aligned
+- the raw little-endian buffers, each aligned to 64 bytes, offsets being relative to the end of the header
+
+bfloat16 is stored as the upper half of float32 in uint16, since numpy has no bfloat16.
+"""
+import json
+import os
+import pickle
+import shutil
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+
+FLAT_WEIGHTS_NAME = "model_state.flat"
+FLAT_WEIGHTS_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + FLAT_WEIGHTS_ALIGNMENT - 1) // FLAT_WEIGHTS_ALIGNMENT * FLAT_WEIGHTS_ALIGNMENT
+
+
+def _to_bfloat16_bits(array):
+    """float32 -> bits of bfloat16 stored in uint16, rounded to the nearest even"""
+    bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def _stored_dtype(value, dtype):
+    return dtype if value.dtype.kind == "f" else str(value.dtype)
+
+
+def _stored_nbytes(value, stored_dtype):
+    return value.size * np.dtype("uint16" if stored_dtype == "bfloat16" else stored_dtype).itemsize
+
+
+def _write_tensor(f, value, stored_dtype):
+    if stored_dtype == "bfloat16":
+        data = _to_bfloat16_bits(value)
+    else:
+        data = np.ascontiguousarray(value, dtype=np.dtype(stored_dtype).newbyteorder("<"))
+    f.write(memoryview(data).cast("B"))
+
+
+def _write_header(f, header):
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_size = _align(8 + len(header_bytes)) - 8
+    header_bytes += b" " * (header_size - len(header_bytes))
+    f.write(struct.pack("<Q", header_size))
+    f.write(header_bytes)
+
+
+def save_flat_weights(state_dict, path, dtype="float16", metadata=None):
+    """
+    write the numpy weights of `state_dict` to `path`, the floating point ones in `dtype` (float32, float16 or
+    bfloat16) and the others as they are
+    """
+    header = {"__metadata__": dict(metadata or {}, format="flat")}
+    entries = []
+    offset = 0
+    for key, value in state_dict.items():
+        value = np.asarray(value)
+        stored_dtype = _stored_dtype(value, dtype)
+        nbytes = _stored_nbytes(value, stored_dtype)
+        offset = _align(offset)
+        header[key] = {"dtype": stored_dtype, "shape": list(value.shape), "offsets": [offset, offset + nbytes]}
+        entries.append((value, stored_dtype, offset))
+        offset += nbytes
+
+    with open(path, "wb") as f:
+        _write_header(f, header)
+        data_start = f.tell()
+        # one tensor is cast at a time
+        for value, stored_dtype, offset in entries:
+            f.write(b"\0" * (data_start + offset - f.tell()))
+            _write_tensor(f, value, stored_dtype)
+
+
+class _StreamedArray:
+    """A numpy array of the pickle, written out by `write` as soon as it is unpickled and then dropped."""
+
+    def __init__(self, write):
+        self.write = write
+        self.info = None
+
+    def __setstate__(self, state):
+        _, shape, dtype, is_fortran, rawdata = state
+        array = np.ndarray(shape, dtype=dtype, buffer=rawdata, order="F" if is_fortran else "C")
+        self.info = self.write(array)
+
+
+def _holds_buffer(value):
+    if isinstance(value, tuple):
+        return any(_holds_buffer(item) for item in value)
+    # the shared short constants such as the b"b" of every array must stay
+    return isinstance(value, (bytes, bytearray)) and len(value) > 1024
+
+
+class _StreamingMemo(dict):
+    """
+    The raw buffers of the arrays are not kept by the memo, nor the state tuples holding them, they are never
+    referenced twice by `paddle.save`.
+    """
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, None if _holds_buffer(value) else value)
+
+
+class _StreamingUnpickler(pickle._Unpickler):
+    # the pure python unpickler, the memo of the C one can't be replaced. The opcodes are few, one or a few per
+    # tensor, so that the time goes to reading the buffers anyway.
+    def __init__(self, file, write):
+        super().__init__(file)
+        self.memo = _StreamingMemo()
+        self.write = write
+
+    def find_class(self, mod_name, name):
+        if name == "_reconstruct" and mod_name in ("numpy.core.multiarray", "numpy._core.multiarray"):
+            return lambda *args: _StreamedArray(self.write)
+        return super().find_class(mod_name, name)
+
+
+def convert_pdparams_to_flat(pdparams_path, path, dtype="float32", metadata=None):
+    """
+    write the numpy weights of the model_state.pdparams `pdparams_path` to `path` like `save_flat_weights`, one
+    tensor at a time as they are unpickled, instead of loading the whole state dict. The data goes to a temporary
+    `path + '.data.tmp'` first, since the header comes before it. Raises ValueError for a pdparams which isn't a plain
+    pickle of numpy arrays (e.g. the big parameters split by the older versions of `paddle.save`).
+    """
+    data_path = f"{path}.data.tmp"
+    offset = 0
+
+    def write(value):
+        nonlocal offset
+        stored_dtype = _stored_dtype(value, dtype)
+        nbytes = _stored_nbytes(value, stored_dtype)
+        offset = _align(offset)
+        data_file.write(b"\0" * (offset - data_file.tell()))
+        _write_tensor(data_file, value, stored_dtype)
+        info = {"dtype": stored_dtype, "shape": list(value.shape), "offsets": [offset, offset + nbytes]}
+        offset += nbytes
+        return info
+
+    try:
+        with open(data_path, "wb") as data_file, open(pdparams_path, "rb") as f:
+            try:
+                state_dict = _StreamingUnpickler(f, write).load()
+            except (pickle.UnpicklingError, EOFError, AttributeError, KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"{pdparams_path} can't be streamed: {e!r}") from e
+        if not isinstance(state_dict, dict) or "UnpackBigParamInfor@@" in state_dict:
+            raise ValueError(f"{pdparams_path} can't be streamed: not a plain state dict")
+
+        header = {"__metadata__": dict(metadata or {}, format="flat")}
+        for key, value in state_dict.items():
+            # older versions of paddle.save pickle (name, array) tuples
+            if isinstance(value, tuple) and len(value) == 2 and isinstance(value[1], _StreamedArray):
+                value = value[1]
+            if isinstance(value, _StreamedArray):
+                header[key] = value.info
+        with open(path, "wb") as f, open(data_path, "rb") as data_file:
+            _write_header(f, header)
+            shutil.copyfileobj(data_file, f, 16 * 1024 * 1024)
+    finally:
+        if os.path.exists(data_path):
+            os.remove(data_path)
+
+
+class FlatWeights(Mapping):
+    """
+    The weights of a flat file, memory mapped. Every access returns a view into the mapping, or a converted copy for
+    bfloat16 weights or when `dtype` is given, so that a single tensor is converted at a time.
+    """
+
+    def __init__(self, path, dtype=None):
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            self.header = json.loads(f.read(header_size))
+        self.metadata = self.header.pop("__metadata__", {})
+        self.mapping = np.memmap(path, dtype=np.uint8, mode="r")
+        self.data_start = 8 + header_size
+        self.dtype = dtype
+
+    def __getitem__(self, key):
+        info = self.header[key]
+        begin, end = info["offsets"]
+        buffer = self.mapping[self.data_start + begin : self.data_start + end]
+        if info["dtype"] == "bfloat16":
+            array = (buffer.view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+        else:
+            array = buffer.view(np.dtype(info["dtype"]).newbyteorder("<"))
+        array = array.reshape(info["shape"])
+        if self.dtype is not None and array.dtype.kind == "f" and array.dtype != np.dtype(self.dtype):
+            array = array.astype(self.dtype)
+        return array
+
+    def __iter__(self):
+        return iter(self.header)
+
+    def __len__(self):
+        return len(self.header)
+
+
+def load_flat_weights(path, dtype=None):
+    """memory map the weights written by `save_flat_weights`"""
+    return FlatWeights(path, dtype=dtype)
@@ -13,11 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import inspect
+import json
 import os
 import random
 import re
 import time
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Callable, List, Optional, Union
 
 import numpy as np
@@ -44,6 +49,12 @@ from ppdiffusers.utils.testing_utils import load_image
 from ppdiffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 from ppdiffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
 
+try:
+    from .env import CACHE_DIR
+except ImportError:
+    # imported as a module of its own, e.g. by the tests
+    from env import CACHE_DIR
+
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
@@ -128,6 +139,11 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
+    return [[text, weight] for text, weight in _parse_prompt_attention(text)]
+
+
+@lru_cache(maxsize=4096)
+def _parse_prompt_attention(text):
     res = []
     round_brackets = []
     square_brackets = []
@@ -135,6 +151,8 @@ def parse_prompt_attention(text):
     round_bracket_multiplier = 1.1
     square_bracket_multiplier = 1 / 1.1
 
+    # the multipliers are applied when the brackets are closed, so that the weights are bit-identical to the former
+    # parser and equal weights are merged the same way
     def multiply_range(start_position, multiplier):
         for p in range(start_position, len(res)):
             res[p][1] *= multiplier
@@ -165,18 +183,39 @@ def parse_prompt_attention(text):
         multiply_range(pos, square_bracket_multiplier)
 
     if len(res) == 0:
-        res = [["", 1.0]]
+        return (("", 1.0),)
 
     # merge runs of identical weights
-    i = 0
-    while i + 1 < len(res):
-        if res[i][1] == res[i + 1][1]:
-            res[i][0] += res[i + 1][0]
-            res.pop(i + 1)
+    merged = [res[0]]
+    for text, weight in res[1:]:
+        if merged[-1][1] == weight:
+            merged[-1][0] += text
         else:
-            i += 1
+            merged.append([text, weight])
+
+    return tuple((text, weight) for text, weight in merged)
+
 
-    return res
+# fragment -> token ids, per tokenizer; reset when tokens are added to the tokenizer
+_fragment_token_cache = weakref.WeakKeyDictionary()
+
+
+def tokenize_fragments(tokenizer, fragments):
+    r"""
+    Tokenize text fragments without the starting and the ending token, memoizing the result per tokenizer.
+
+    All the fragments not seen before are tokenized with a single tokenizer call.
+    """
+    vocab_size, cache = _fragment_token_cache.get(tokenizer, (None, None))
+    if vocab_size != len(tokenizer):
+        cache = {}
+        _fragment_token_cache[tokenizer] = (len(tokenizer), cache)
+
+    missing = list(dict.fromkeys(fragment for fragment in fragments if fragment not in cache))
+    if len(missing) > 0:
+        for fragment, input_ids in zip(missing, tokenizer(missing).input_ids):
+            cache[fragment] = input_ids[1:-1]
+    return [cache[fragment] for fragment in fragments]
 
 
 def get_prompts_with_weights(pipe: DiffusionPipeline, prompt: List[str], max_length: int):
@@ -185,24 +224,27 @@ def get_prompts_with_weights(pipe: DiffusionPipeline, prompt: List[str], max_len
 
     No padding, starting or ending token is included.
     """
+    texts_and_weights = [_parse_prompt_attention(text) for text in prompt]
+    # tokenize the fragments of all the prompts at once
+    fragment_tokens = tokenize_fragments(pipe.tokenizer, [word for pairs in texts_and_weights for word, _ in pairs])
+
     tokens = []
     weights = []
-    for text in prompt:
-        texts_and_weights = parse_prompt_attention(text)
+    k = 0
+    for pairs in texts_and_weights:
         text_token = []
         text_weight = []
-        for word, weight in texts_and_weights:
-            # tokenize and discard the starting and the ending token
-            token = pipe.tokenizer(word).input_ids[1:-1]
+        for _, weight in pairs:
+            token = fragment_tokens[k]
+            k += 1
+            if len(text_token) > max_length:
+                # the text is already longer than the truncation limit
+                continue
             text_token += token
 
             # copy the weight by length of token
             text_weight += [weight] * len(token)
 
-            # stop if the text is too long (longer than truncation limit)
-            if len(text_token) > max_length:
-                break
-
         # truncate
         if len(text_token) > max_length:
             text_token = text_token[:max_length]
@@ -243,11 +285,11 @@ def get_unweighted_text_embeddings(
 ):
     """
     When the length of tokens is a multiple of the capacity of the text encoder,
-    it should be split into chunks and sent to the text encoder individually.
+    it should be split into chunks, which are sent to the text encoder together as one batch.
     """
     max_embeddings_multiples = (text_input.shape[1] - 2) // (chunk_length - 2)
     if max_embeddings_multiples > 1:
-        text_embeddings = []
+        text_input_chunks = []
         for i in range(max_embeddings_multiples):
             # extract the i-th chunk
             text_input_chunk = text_input[:, i * (chunk_length - 2) : (i + 1) * (chunk_length - 2) + 2].clone()
@@ -255,27 +297,135 @@ def get_unweighted_text_embeddings(
             # cover the head and the tail by the starting and the ending tokens
             text_input_chunk[:, 0] = text_input[0, 0]
             text_input_chunk[:, -1] = text_input[0, -1]
+            text_input_chunks.append(text_input_chunk)
 
-            text_embedding = pipe.text_encoder(text_input_chunk)[0]
+        # stack the chunks along the batch axis and encode them in a single forward
+        text_embeddings = pipe.text_encoder(paddle.concat(text_input_chunks))[0]
+        text_embeddings = paddle.split(text_embeddings, max_embeddings_multiples)
 
-            if no_boseos_middle:
+        if no_boseos_middle:
+            for i in range(max_embeddings_multiples):
                 if i == 0:
                     # discard the ending token
-                    text_embedding = text_embedding[:, :-1]
+                    text_embeddings[i] = text_embeddings[i][:, :-1]
                 elif i == max_embeddings_multiples - 1:
                     # discard the starting token
-                    text_embedding = text_embedding[:, 1:]
+                    text_embeddings[i] = text_embeddings[i][:, 1:]
                 else:
                     # discard both starting and ending tokens
-                    text_embedding = text_embedding[:, 1:-1]
+                    text_embeddings[i] = text_embeddings[i][:, 1:-1]
 
-            text_embeddings.append(text_embedding)
         text_embeddings = paddle.concat(text_embeddings, axis=1)
     else:
         text_embeddings = pipe.text_encoder(text_input)[0]
     return text_embeddings
 
 
+def _amp_level():
+    # the embeddings computed under `paddle.amp.auto_cast` differ from the float32 ones
+    try:
+        return str(paddle.fluid.framework._dygraph_tracer()._amp_level)
+    except AttributeError:
+        return None
+
+
+def _tensor_nbytes(tensor: paddle.Tensor):
+    element_size = 2 if tensor.dtype in (paddle.float16, paddle.bfloat16) else 4
+    return int(np.prod(tensor.shape)) * element_size
+
+
+class TextEmbeddingCache:
+    r"""
+    A least-recently-used cache of weighted prompt embeddings, bounded by the total size of the cached tensors.
+
+    Every prompt is cached on its own, keyed on the text encoder, the version of its token embeddings and all the
+    arguments that change its embedding, so a negative prompt shared by many requests is encoded only once.
+    Call `invalidate` after modifying the token embeddings of a text encoder.
+
+    Args:
+        max_bytes (`int`, *optional*, defaults to 64MB):
+            The maximum total size of the cached embeddings.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._versions = {}
+
+    def _model_key(self, text_encoder):
+        model_id = id(text_encoder)
+        if model_id not in self._versions:
+            self._versions[model_id] = 0
+            # the id of a garbage collected text encoder may be reused, so forget its entries with it
+            weakref.finalize(text_encoder, self._forget, model_id)
+        return model_id, self._versions[model_id]
+
+    def make_key(self, pipe: DiffusionPipeline, text: str, *args):
+        return (
+            self._model_key(pipe.text_encoder)
+            + (len(pipe.tokenizer), str(pipe.text_encoder.dtype), _amp_level(), text)
+            + args
+        )
+
+    def get(self, key):
+        embedding = self.entries.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return embedding
+
+    def put(self, key, embedding: paddle.Tensor):
+        nbytes = _tensor_nbytes(embedding)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= _tensor_nbytes(self.entries.pop(key))
+        self.entries[key] = embedding
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= _tensor_nbytes(evicted)
+            self.evictions += 1
+
+    def _remove_model_entries(self, model_id):
+        for key in [key for key in self.entries if key[0] == model_id]:
+            self.nbytes -= _tensor_nbytes(self.entries.pop(key))
+
+    def _forget(self, model_id):
+        self._remove_model_entries(model_id)
+        self._versions.pop(model_id, None)
+
+    def invalidate(self, text_encoder=None):
+        """
+        Drop the embeddings computed by `text_encoder`, or all embeddings if it is `None`.
+        """
+        if text_encoder is None:
+            self.entries.clear()
+            self.nbytes = 0
+            return
+        model_id, version = self._model_key(text_encoder)
+        self._versions[model_id] = version + 1
+        self._remove_model_entries(model_id)
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self.entries),
+            nbytes=self.nbytes,
+        )
+
+
+text_embedding_cache = TextEmbeddingCache()
+
+
 def get_weighted_text_embeddings(
     pipe: DiffusionPipeline,
     prompt: Union[str, List[str]],
@@ -284,6 +434,7 @@ def get_weighted_text_embeddings(
     no_boseos_middle: Optional[bool] = False,
     skip_parsing: Optional[bool] = False,
     skip_weighting: Optional[bool] = False,
+    cache: Optional[TextEmbeddingCache] = None,
     **kwargs
 ):
     r"""
@@ -310,6 +461,8 @@ def get_weighted_text_embeddings(
             Skip the parsing of brackets.
         skip_weighting (`bool`, *optional*, defaults to `False`):
             Skip the weighting. When the parsing is skipped, it is forced True.
+        cache (`TextEmbeddingCache`, *optional*):
+            Cache to look up the embedding of each prompt in, and to store the newly computed ones to.
     """
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
     if isinstance(prompt, str):
@@ -361,7 +514,9 @@ def get_weighted_text_embeddings(
         no_boseos_middle=no_boseos_middle,
         chunk_length=pipe.tokenizer.model_max_length,
     )
-    prompt_tokens = paddle.to_tensor(prompt_tokens)
+    texts = list(prompt)
+    tokens = prompt_tokens
+    weights = prompt_weights
     if uncond_prompt is not None:
         uncond_tokens, uncond_weights = pad_tokens_and_weights(
             uncond_tokens,
@@ -373,39 +528,827 @@ def get_weighted_text_embeddings(
             no_boseos_middle=no_boseos_middle,
             chunk_length=pipe.tokenizer.model_max_length,
         )
-        uncond_tokens = paddle.to_tensor(uncond_tokens)
-
-    # get the embeddings
-    text_embeddings = get_unweighted_text_embeddings(
-        pipe, prompt_tokens, pipe.tokenizer.model_max_length, no_boseos_middle=no_boseos_middle
-    )
-    prompt_weights = paddle.to_tensor(prompt_weights, dtype=text_embeddings.dtype)
-    if uncond_prompt is not None:
-        uncond_embeddings = get_unweighted_text_embeddings(
-            pipe, uncond_tokens, pipe.tokenizer.model_max_length, no_boseos_middle=no_boseos_middle
+        texts += uncond_prompt
+        tokens = tokens + uncond_tokens
+        weights = weights + uncond_weights
+
+    def encode(tokens, weights):
+        # get the embeddings
+        text_embeddings = get_unweighted_text_embeddings(
+            pipe, paddle.to_tensor(tokens), pipe.tokenizer.model_max_length, no_boseos_middle=no_boseos_middle
         )
-        uncond_weights = paddle.to_tensor(uncond_weights, dtype=uncond_embeddings.dtype)
-
-    # assign weights to the prompts and normalize in the sense of mean
-    # TODO: should we normalize by chunk or in a whole (current implementation)?
-    if (not skip_parsing) and (not skip_weighting):
-        previous_mean = text_embeddings.mean(axis=[-2, -1])
-        text_embeddings *= prompt_weights.unsqueeze(-1)
-        text_embeddings *= previous_mean / text_embeddings.mean(axis=[-2, -1])
-        if uncond_prompt is not None:
-            previous_mean = uncond_embeddings.mean(axis=[-2, -1])
-            uncond_embeddings *= uncond_weights.unsqueeze(-1)
-            uncond_embeddings *= previous_mean / uncond_embeddings.mean(axis=[-2, -1])
+
+        # assign weights to the prompts and normalize in the sense of mean
+        # TODO: should we normalize by chunk or in a whole (current implementation)?
+        if (not skip_parsing) and (not skip_weighting):
+            weights = paddle.to_tensor(weights, dtype=text_embeddings.dtype)
+            previous_mean = text_embeddings.mean(axis=[-2, -1])
+            text_embeddings *= weights.unsqueeze(-1)
+            text_embeddings *= (previous_mean / text_embeddings.mean(axis=[-2, -1])).reshape([-1, 1, 1])
+        return text_embeddings
+
+    if cache is None:
+        text_embeddings = encode(tokens, weights)
+    else:
+        keys = [
+            cache.make_key(
+                pipe, text, max_length, max_embeddings_multiples, no_boseos_middle, skip_parsing, skip_weighting
+            )
+            for text in texts
+        ]
+        embeddings = [cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            # encode all the missing prompts in a single forward
+            new_embeddings = encode([tokens[i] for i in missing], [weights[i] for i in missing])
+            for j, i in enumerate(missing):
+                embeddings[i] = new_embeddings[j : j + 1]
+                cache.put(keys[i], embeddings[i])
+        text_embeddings = paddle.concat(embeddings)
 
     # For classifier free guidance, we need to do two forward passes.
     # Here we concatenate the unconditional and text embeddings into a single batch
     # to avoid doing two forward passes
     if uncond_prompt is not None:
-        text_embeddings = paddle.concat([uncond_embeddings, text_embeddings])
+        text_embeddings = paddle.concat([text_embeddings[len(prompt) :], text_embeddings[: len(prompt)]])
 
     return text_embeddings
 
 
+class PerSampleNoiseGenerator:
+    r"""
+    Draws Gaussian noise for a batch from one independent NumPy stream per sample.
+
+    The noise of the i-th sample only depends on `seeds[i]`, so a batch of any size gives every image the same
+    noise as generating it alone with its own seed, on any device.
+
+    Args:
+        seeds (`List[int]`):
+            One seed per sample of the batch.
+    """
+
+    def __init__(self, seeds: List[int]):
+        self.seeds = list(seeds)
+        self.generators = [np.random.Generator(np.random.PCG64(seed)) for seed in self.seeds]
+
+    def __len__(self):
+        return len(self.generators)
+
+    def randn(self, shape, dtype="float32"):
+        """
+        Return a tensor of shape `[len(seeds)] + shape`, advancing the stream of every sample.
+        """
+        noise = np.stack([generator.standard_normal(tuple(shape), dtype=np.float32) for generator in self.generators])
+        return paddle.to_tensor(noise).cast(dtype)
+
+
+class TimestepCache:
+    r"""
+    A least-recently-used cache of the scheduler state computed by `set_timesteps`.
+
+    The timestep and sigma tables only depend on the scheduler class, its config and the number of inference steps,
+    so they are computed once and restored afterwards. Only the fields assigned by `set_timesteps` are cached, which
+    include the per-run fields it resets (e.g. the history of the multistep solvers), so every run starts from scratch
+    as before. The restored values are copies, `step` may modify them in place.
+
+    Args:
+        max_entries (`int`, *optional*, defaults to 64):
+            The maximum number of cached tables.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # scheduler -> (config, digest of the config)
+        self.config_digests = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, scheduler, num_inference_steps: int, *args):
+        config_digest = self.config_digests.get(scheduler)
+        # the config is frozen, it can only be replaced
+        if config_digest is None or config_digest[0] is not scheduler.config:
+            config = json.dumps(dict(scheduler.config), sort_keys=True, default=str)
+            config_digest = (scheduler.config, hashlib.sha1(config.encode()).hexdigest())
+            self.config_digests[scheduler] = config_digest
+        return (type(scheduler).__name__, config_digest[1], num_inference_steps) + args
+
+    @classmethod
+    def _copy_value(cls, value):
+        if isinstance(value, paddle.Tensor):
+            return value.clone()
+        if isinstance(value, np.ndarray):
+            return value.copy()
+        if isinstance(value, (list, tuple)):
+            return type(value)(cls._copy_value(item) for item in value)
+        if isinstance(value, dict):
+            return {k: cls._copy_value(v) for k, v in value.items()}
+        return value
+
+    @staticmethod
+    def _record_set_timesteps(scheduler, num_inference_steps: int):
+        # the fields assigned by `set_timesteps`, recorded by a subclass for the duration of the call
+        names = set()
+        scheduler_class = type(scheduler)
+
+        def __setattr__(self, name, value):
+            names.add(name)
+            super(recording_class, self).__setattr__(name, value)
+
+        recording_class = type(scheduler_class.__name__, (scheduler_class,), {"__setattr__": __setattr__})
+        scheduler.__class__ = recording_class
+        try:
+            scheduler.set_timesteps(num_inference_steps)
+        finally:
+            scheduler.__class__ = scheduler_class
+        return {name: vars(scheduler)[name] for name in names if name in vars(scheduler)}
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self._copy_value(value)
+
+    def put(self, key, value):
+        self.entries[key] = self._copy_value(value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set_timesteps(self, scheduler, num_inference_steps: int):
+        """
+        Same as `scheduler.set_timesteps(num_inference_steps)`, restoring the tables when they are cached.
+        """
+        key = self.make_key(scheduler, num_inference_steps)
+        state = self.get(key)
+        if state is None:
+            self.put(key, self._record_set_timesteps(scheduler, num_inference_steps))
+        else:
+            vars(scheduler).update(state)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.entries))
+
+
+timestep_cache = TimestepCache()
+
+
+def scheduler_draws_noise(scheduler, eta: float = 0.0):
+    """
+    Whether `scheduler.step` adds random noise, drawn from the global generator for the whole batch, so that an image
+    only depends on its seed when it is generated alone.
+    """
+    name = type(scheduler).__name__
+    return "Ancestral" in name or (eta > 0 and "DDIM" in name)
+
+
+class DenoisingHook:
+    r"""
+    Base class of the per-step hooks of `DenoisingLoop`. Every method returns its input unchanged by default.
+    """
+
+    def prepare_model_input(self, i, t, latent_model_input):
+        """Called on the latents before they are scaled and given to the UNet."""
+        return latent_model_input
+
+    def prepare_text_embeddings(self, i, t, text_embeddings):
+        """Called on the text embeddings given to the UNet."""
+        return text_embeddings
+
+    def process_noise_pred(self, i, t, noise_pred):
+        """Called on the output of the UNet before the scheduler step."""
+        return noise_pred
+
+    def process_latents(self, i, t, latents):
+        """Called on the latents after the scheduler step."""
+        return latents
+
+    def on_step_end(self, i, t, latents):
+        """Called once per completed step of the progress bar."""
+        pass
+
+    def should_stop(self, i, t, latents):
+        """Called after `on_step_end`, the loop stops when a hook returns `True`."""
+        return False
+
+    def process_final_latents(self, latents):
+        """Called on the estimate of the denoised latents when the loop stops early."""
+        return latents
+
+
+class ClassifierFreeGuidance(DenoisingHook):
+    r"""
+    Classifier free guidance: the unconditional and the conditional noise are predicted in one batch and combined.
+
+    Guidance can be stopped before the end of the schedule, the last steps mostly refine details and are then run on
+    the conditional half of the batch only, which halves the cost of the UNet for these steps.
+
+    Args:
+        guidance_scale (`float`):
+            The guidance weight `w` of equation (2) of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf
+        num_timesteps (`int`, *optional*):
+            The length of the schedule, required when `guidance_end < 1`.
+        guidance_end (`float`, *optional*, defaults to 1.0):
+            The fraction of the schedule during which guidance is applied.
+        guidance_schedule (`str`, *optional*, defaults to `"constant"`):
+            How the guidance scale evolves until `guidance_end`: `"constant"`, or decaying to 1 with `"linear"` or
+            `"cosine"`.
+    """
+
+    GUIDANCE_SCHEDULES = ("constant", "linear", "cosine")
+
+    def __init__(
+        self,
+        guidance_scale: float,
+        num_timesteps: Optional[int] = None,
+        guidance_end: float = 1.0,
+        guidance_schedule: str = "constant",
+    ):
+        if guidance_schedule not in self.GUIDANCE_SCHEDULES:
+            raise ValueError(f"`guidance_schedule` has to be one of {self.GUIDANCE_SCHEDULES} but is {guidance_schedule}.")
+        self.guidance_scale = guidance_scale
+        self.num_timesteps = num_timesteps
+        self.guidance_end = guidance_end
+        self.guidance_schedule = guidance_schedule
+        self._cond_text_embeddings = None
+
+    def get_guidance_scale(self, i):
+        """The guidance scale of step `i`, guidance is off when it is not greater than 1."""
+        if self.num_timesteps is None or (self.guidance_end >= 1 and self.guidance_schedule == "constant"):
+            return self.guidance_scale
+        progress = i / self.num_timesteps
+        if progress >= self.guidance_end:
+            return 1.0
+        if self.guidance_schedule == "linear":
+            weight = 1 - progress / self.guidance_end
+        elif self.guidance_schedule == "cosine":
+            weight = 0.5 * (1 + np.cos(np.pi * progress / self.guidance_end))
+        else:
+            weight = 1.0
+        return 1 + (self.guidance_scale - 1) * weight
+
+    def prepare_model_input(self, i, t, latent_model_input):
+        if self.get_guidance_scale(i) <= 1:
+            return latent_model_input
+        return paddle.concat([latent_model_input] * 2)
+
+    def prepare_text_embeddings(self, i, t, text_embeddings):
+        if self.get_guidance_scale(i) > 1:
+            return text_embeddings
+        # the embeddings are [unconditional, conditional]
+        if self._cond_text_embeddings is None:
+            self._cond_text_embeddings = text_embeddings[text_embeddings.shape[0] // 2 :]
+        return self._cond_text_embeddings
+
+    def process_noise_pred(self, i, t, noise_pred):
+        guidance_scale = self.get_guidance_scale(i)
+        if guidance_scale <= 1:
+            return noise_pred
+        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+        return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+
+class InpaintMask(DenoisingHook):
+    r"""
+    Keeps the unmasked area of the initial latents, noised to the current timestep, after every step.
+    """
+
+    def __init__(self, scheduler, init_latents_orig: paddle.Tensor, noise: paddle.Tensor, mask: paddle.Tensor):
+        self.scheduler = scheduler
+        self.init_latents_orig = init_latents_orig
+        self.noise = noise
+        self.mask = mask
+
+    def process_latents(self, i, t, latents):
+        init_latents_proper = self.scheduler.add_noise(self.init_latents_orig, self.noise, t)
+        return (init_latents_proper * self.mask) + (latents * (1 - self.mask))
+
+    def process_final_latents(self, latents):
+        return (self.init_latents_orig * self.mask) + (latents * (1 - self.mask))
+
+
+class StepCallback(DenoisingHook):
+    r"""
+    Calls `callback(i, t, latents)` every `callback_steps` steps.
+    """
+
+    def __init__(self, callback: Callable[[int, int, paddle.Tensor], None], callback_steps: int = 1):
+        self.callback = callback
+        self.callback_steps = callback_steps
+
+    def on_step_end(self, i, t, latents):
+        if i % self.callback_steps == 0:
+            self.callback(i, t, latents)
+
+
+class EarlyStoppingStats:
+    r"""
+    Counts the steps run and saved by `EarlyStopping` over all the runs, see `stats`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.runs = 0
+        self.stopped_runs = 0
+        self.steps_run = 0
+        self.steps_saved = 0
+
+    def record(self, steps_run: int, num_inference_steps: int):
+        self.runs += 1
+        self.steps_run += steps_run
+        if steps_run < num_inference_steps:
+            self.stopped_runs += 1
+            self.steps_saved += num_inference_steps - steps_run
+
+    def stats(self):
+        return dict(
+            runs=self.runs, stopped_runs=self.stopped_runs, steps_run=self.steps_run, steps_saved=self.steps_saved
+        )
+
+
+early_stopping_stats = EarlyStoppingStats()
+
+
+class EarlyStopping(DenoisingHook):
+    r"""
+    Stops the loop once the latents have converged: the relative change of the latents of every sample of the batch,
+    `|latents - previous latents| / |previous latents|`, stays below `threshold` for `patience` consecutive steps.
+
+    Args:
+        threshold (`float`):
+            The relative change under which a step is considered converged.
+        patience (`int`, *optional*, defaults to 3):
+            The number of consecutive converged steps before stopping.
+    """
+
+    def __init__(self, threshold: float, patience: int = 3):
+        self.threshold = threshold
+        self.patience = max(1, patience)
+        self.converged_steps = 0
+        self.previous_latents = None
+
+    def should_stop(self, i, t, latents):
+        previous_latents, self.previous_latents = self.previous_latents, latents
+        if previous_latents is None:
+            return False
+        batch_size = latents.shape[0]
+        previous = previous_latents.cast("float32").reshape([batch_size, -1])
+        delta = paddle.linalg.norm(latents.cast("float32").reshape([batch_size, -1]) - previous, axis=1)
+        relative_delta = delta / paddle.clip(paddle.linalg.norm(previous, axis=1), min=1e-8)
+        if float(relative_delta.max()) < self.threshold:
+            self.converged_steps += 1
+        else:
+            self.converged_steps = 0
+        return self.converged_steps >= self.patience
+
+
+def estimate_original_sample(scheduler, t, sample: paddle.Tensor, model_output: paddle.Tensor):
+    r"""
+    The estimate of the denoised sample `x_0` given the UNet output `model_output` for `sample` at timestep `t`, from
+    the `alphas_cumprod` of the scheduler. Returns `None` when the scheduler has no such table or the prediction type
+    is unknown.
+
+    The schedulers with a `sigmas` table (Euler, LMS, Heun, KDPM2...) work on `x_0 + sigma * noise`, the others (DDIM,
+    PNDM, DPMSolver...) on `sqrt(alpha) * x_0 + sqrt(1 - alpha) * noise`.
+    """
+    alphas_cumprod = getattr(scheduler, "alphas_cumprod", None)
+    if alphas_cumprod is None:
+        return None
+    if isinstance(alphas_cumprod, paddle.Tensor):
+        alphas_cumprod = alphas_cumprod.numpy()
+    alphas_cumprod = np.asarray(alphas_cumprod, dtype=np.float64)
+    prediction_type = getattr(scheduler.config, "prediction_type", "epsilon")
+    # the timesteps of the sigma schedulers can be fractional, their sigmas are interpolated the same way
+    sigma = float(np.interp(float(t), np.arange(len(alphas_cumprod)), ((1 - alphas_cumprod) / alphas_cumprod) ** 0.5))
+    if hasattr(scheduler, "sigmas"):
+        if prediction_type == "epsilon":
+            return sample - sigma * model_output
+        if prediction_type == "v_prediction":
+            return model_output * (-sigma / (sigma**2 + 1) ** 0.5) + sample / (sigma**2 + 1)
+    else:
+        alpha_prod_t = 1 / (sigma**2 + 1)
+        beta_prod_t = 1 - alpha_prod_t
+        if prediction_type == "epsilon":
+            return (sample - beta_prod_t**0.5 * model_output) / alpha_prod_t**0.5
+        if prediction_type == "v_prediction":
+            return alpha_prod_t**0.5 * sample - beta_prod_t**0.5 * model_output
+    if prediction_type == "sample":
+        return model_output
+    return None
+
+
+class DenoisingLoop:
+    r"""
+    The denoising loop shared by `text2image`, `img2img` and `inpaint`, the task specific parts being hooks.
+
+    Args:
+        pipe (`DiffusionPipeline`):
+            The pipeline whose `unet` and `scheduler` are used.
+        hooks (`List[DenoisingHook]`, *optional*):
+            The hooks, called in order at every stage of a step.
+    """
+
+    def __init__(self, pipe: DiffusionPipeline, hooks: Optional[List[DenoisingHook]] = None):
+        self.pipe = pipe
+        self.hooks = [hook for hook in hooks or [] if hook is not None]
+        # the number of steps of the progress bar run by the last call
+        self.steps_run = 0
+        self.warned_early_stop = False
+
+    def __call__(
+        self,
+        latents: paddle.Tensor,
+        timesteps: paddle.Tensor,
+        text_embeddings: paddle.Tensor,
+        num_inference_steps: int,
+        extra_step_kwargs: Optional[dict] = None,
+        start_step: int = 0,
+    ):
+        scheduler = self.pipe.scheduler
+        extra_step_kwargs = extra_step_kwargs or {}
+        num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
+        self.steps_run = 0
+        with self.pipe.progress_bar(total=num_inference_steps) as progress_bar:
+            for i, t in enumerate(timesteps):
+                if i < start_step:
+                    # resumed from a cached step
+                    if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
+                        progress_bar.update()
+                        self.steps_run += 1
+                    continue
+                latent_model_input = latents
+                for hook in self.hooks:
+                    latent_model_input = hook.prepare_model_input(i, t, latent_model_input)
+                latent_model_input = scheduler.scale_model_input(latent_model_input, t)
+                encoder_hidden_states = text_embeddings
+                for hook in self.hooks:
+                    encoder_hidden_states = hook.prepare_text_embeddings(i, t, encoder_hidden_states)
+
+                # predict the noise residual
+                noise_pred = self.pipe.unet(latent_model_input, t, encoder_hidden_states=encoder_hidden_states).sample
+                for hook in self.hooks:
+                    noise_pred = hook.process_noise_pred(i, t, noise_pred)
+
+                # compute the previous noisy sample x_t -> x_t-1
+                sample = latents
+                output = scheduler.step(noise_pred, t, latents, **extra_step_kwargs)
+                latents = output.prev_sample
+                for hook in self.hooks:
+                    latents = hook.process_latents(i, t, latents)
+
+                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
+                    progress_bar.update()
+                    self.steps_run += 1
+                    for hook in self.hooks:
+                        hook.on_step_end(i, t, latents)
+                    if i < len(timesteps) - 1 and any([hook.should_stop(i, t, latents) for hook in self.hooks]):
+                        # the remaining noise is removed at once with the estimate of the denoised sample
+                        pred_original_sample = getattr(output, "pred_original_sample", None)
+                        if pred_original_sample is None:
+                            pred_original_sample = estimate_original_sample(scheduler, t, sample, noise_pred)
+                        if pred_original_sample is None:
+                            # stopping would leave noisy latents, this scheduler can't stop early
+                            if not self.warned_early_stop:
+                                logger.warning(
+                                    f"{type(scheduler).__name__} gives no estimate of the denoised latents, "
+                                    "early stopping is disabled."
+                                )
+                                self.warned_early_stop = True
+                            continue
+                        latents = pred_original_sample
+                        for hook in self.hooks:
+                            latents = hook.process_final_latents(latents)
+                        break
+        return latents
+
+
+def _array_digest(sha1, value):
+    if isinstance(value, paddle.Tensor):
+        value = value.numpy()
+    if isinstance(value, np.ndarray):
+        sha1.update(str((value.dtype, value.shape)).encode())
+        sha1.update(np.ascontiguousarray(value))
+    else:
+        sha1.update(json.dumps(value, sort_keys=True, default=str).encode())
+
+
+_unet_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _unet_fingerprint(unet):
+    """
+    A hash of the config and of all the parameters of `unet`, computed once per unet until
+    `invalidate_unet_fingerprint` is called.
+    """
+    fingerprint = _unet_fingerprints.get(unet)
+    if fingerprint is None:
+        sha1 = hashlib.sha1()
+        _array_digest(sha1, dict(unet.config))
+        for name, parameter in unet.named_parameters():
+            sha1.update(name.encode())
+            _array_digest(sha1, parameter)
+        fingerprint = _unet_fingerprints[unet] = sha1.hexdigest()
+    return fingerprint
+
+
+def invalidate_unet_fingerprint(unet):
+    """
+    Forget the fingerprint of `unet` after its weights are modified in place, e.g. by a training, so that the latents
+    cached with the former weights are not resumed.
+    """
+    _unet_fingerprints.pop(unet, None)
+
+
+class LatentCache:
+    r"""
+    An on-disk cache of the intermediate latents of the denoising loop, so that a rerun with the same inputs resumes
+    from the deepest cached step instead of step 0.
+
+    A job is keyed on the UNet, the text embeddings, the initial latents (hence the seeds, the size and the init
+    image), the scheduler and its config and the number of steps. Every cached step also records the guidance scale
+    of the steps before it, so that changing the tail of the guidance schedule still resumes from the shared prefix.
+    The state of the scheduler (e.g. the history of the multistep solvers) is saved with the latents. Schedulers which
+    draw noise in `step` are not cached since their noise would not be reproduced.
+
+    A run with another number of steps or another sampler does not resume: its timesteps, hence the noise levels of
+    its latents, and the history of the solver differ from the first step, so resuming would not give the image of
+    its seed. Only the same run, or the same run with another tail of the guidance schedule, is resumed.
+
+    Every step is a `.npz` file, the least recently used ones are removed when the cache exceeds `max_bytes`. The index
+    of the files is written once per job, when its last step is cached or when it stops early.
+
+    Args:
+        cache_dir (`str`, *optional*):
+            Where the latents are written, defaults to `$PPDIFFUSERS_SD_CACHE/latents`.
+        max_bytes (`int`, *optional*, defaults to 1GB):
+            The disk budget of the cache.
+        save_every (`int`, *optional*, defaults to 5):
+            Cache the latents every `save_every` steps, and after the last step.
+        dtype (`str`, *optional*, defaults to `"float16"`):
+            The dtype of the intermediate latents, `"float32"` makes a run resumed from them identical to an
+            uninterrupted one. The latents of the last step are always cached in float32, so that an identical rerun
+            gives the same image.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_bytes: int = 1024 * 1024 * 1024,
+        save_every: int = 5,
+        dtype: str = "float16",
+    ):
+        if cache_dir is None:
+            cache_dir = os.path.join(CACHE_DIR, "latents")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.save_every = max(1, save_every)
+        self.dtype = dtype
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+        self.nbytes = sum(entry["bytes"] for steps in self.index.values() for entry in steps.values())
+        # the index has changes which are not written yet
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.steps_skipped = 0
+
+    @staticmethod
+    def is_cacheable(scheduler, eta: float = 0.0):
+        return not scheduler_draws_noise(scheduler, eta)
+
+    def make_job_key(self, pipe: DiffusionPipeline, num_inference_steps: int, *args):
+        scheduler = pipe.scheduler
+        sha1 = hashlib.sha1()
+        sha1.update(_unet_fingerprint(pipe.unet).encode())
+        sha1.update(type(scheduler).__name__.encode())
+        _array_digest(sha1, dict(scheduler.config))
+        _array_digest(sha1, num_inference_steps)
+        for arg in args:
+            _array_digest(sha1, arg)
+        return sha1.hexdigest()
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+
+    def flush(self):
+        """
+        Write the index if it changed since it was last written.
+        """
+        if self.dirty:
+            self._save_index()
+
+    def _remove(self, job: str, step: str):
+        entry = self.index[job].pop(step)
+        self.nbytes -= entry["bytes"]
+        self.dirty = True
+        try:
+            os.remove(os.path.join(self.cache_dir, entry["file"]))
+        except OSError:
+            pass
+        if not self.index[job]:
+            del self.index[job]
+
+    def _evict(self):
+        entries = sorted(
+            (entry["atime"], job, step) for job, steps in self.index.items() for step, entry in steps.items()
+        )
+        for _, job, step in entries:
+            if self.nbytes <= self.max_bytes:
+                break
+            self._remove(job, step)
+
+    def save(self, job: str, i: int, latents: paddle.Tensor, scheduler, guidance_scales: List[float]):
+        """
+        Cache the latents and the scheduler state after the step `i` of `job`. The index is written by `flush`.
+        """
+        # the last step in full precision, the image of an identical rerun must be the one of its seed
+        dtype = "float32" if i == len(guidance_scales) - 1 else self.dtype
+        arrays = {"latents": latents.cast(dtype).numpy()}
+        state = {}
+        for name, value in vars(scheduler).items():
+            if name == "_internal_dict":
+                continue
+            if isinstance(value, paddle.Tensor):
+                arrays[f"state.{name}"] = value.numpy()
+                state[name] = "tensor"
+            elif isinstance(value, list) and all(v is None or isinstance(v, paddle.Tensor) for v in value):
+                for j, v in enumerate(value):
+                    if v is not None:
+                        arrays[f"state.{name}.{j}"] = v.numpy()
+                state[name] = ["tensor" if v is not None else None for v in value]
+            elif isinstance(value, (bool, int, float, str, type(None), np.generic)):
+                state[name] = {"value": value.item() if isinstance(value, np.generic) else value}
+
+        file = os.path.join(job, f"{i:04d}.npz")
+        path = os.path.join(self.cache_dir, file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+        if str(i) in self.index.get(job, {}):
+            self.nbytes -= self.index[job][str(i)]["bytes"]
+        self.index.setdefault(job, {})[str(i)] = dict(
+            file=file,
+            bytes=os.path.getsize(path),
+            atime=time.time(),
+            dtype=str(latents.dtype).split(".")[-1],
+            guidance=[round(float(g), 6) for g in guidance_scales[: i + 1]],
+            state=state,
+        )
+        self.nbytes += self.index[job][str(i)]["bytes"]
+        self.dirty = True
+        if self.nbytes > self.max_bytes:
+            self._evict()
+
+    def resume(self, job: str, scheduler, guidance_scales: List[float]):
+        """
+        Restore the deepest cached step of `job` whose guidance matches `guidance_scales`. Return the index of the
+        first step to run and the latents, or `None`.
+        """
+        steps = self.index.get(job, {})
+        for step in sorted(steps, key=int, reverse=True):
+            entry = steps[step]
+            i = int(step)
+            if i >= len(guidance_scales) or entry["guidance"] != [round(float(g), 6) for g in guidance_scales[: i + 1]]:
+                continue
+            try:
+                with np.load(os.path.join(self.cache_dir, entry["file"])) as arrays:
+                    arrays = dict(arrays)
+            except (OSError, ValueError):
+                self._remove(job, step)
+                continue
+
+            for name, value in entry["state"].items():
+                if value == "tensor":
+                    value = paddle.to_tensor(arrays[f"state.{name}"])
+                elif isinstance(value, list):
+                    value = [
+                        paddle.to_tensor(arrays[f"state.{name}.{j}"]) if v is not None else None
+                        for j, v in enumerate(value)
+                    ]
+                else:
+                    value = value["value"]
+                setattr(scheduler, name, value)
+            entry["atime"] = time.time()
+            self.dirty = True
+            self.hits += 1
+            self.steps_skipped += i + 1
+            return i + 1, paddle.to_tensor(arrays["latents"]).cast(entry["dtype"])
+        self.misses += 1
+        return None
+
+    def clear(self):
+        for job in list(self.index):
+            for step in list(self.index.get(job, {})):
+                self._remove(job, step)
+        self._save_index()
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            steps_skipped=self.steps_skipped,
+            entries=sum(len(steps) for steps in self.index.values()),
+            bytes=sum(entry["bytes"] for steps in self.index.values() for entry in steps.values()),
+        )
+
+
+class LatentCacheWriter(DenoisingHook):
+    r"""
+    Writes the latents of every `cache.save_every` steps, and of the last step, to a `LatentCache`, and its index at
+    the end of the loop.
+    """
+
+    def __init__(self, cache: LatentCache, job: str, scheduler, guidance_scales: List[float], num_timesteps: int):
+        self.cache = cache
+        self.job = job
+        self.scheduler = scheduler
+        self.guidance_scales = guidance_scales
+        self.num_timesteps = num_timesteps
+        self.steps = 0
+
+    def on_step_end(self, i, t, latents):
+        self.steps += 1
+        if i == self.num_timesteps - 1 or self.steps % self.cache.save_every == 0:
+            self.cache.save(self.job, i, latents, self.scheduler, self.guidance_scales)
+        if i == self.num_timesteps - 1:
+            self.cache.flush()
+
+    def process_final_latents(self, latents):
+        # the loop stopped early
+        self.cache.flush()
+        return latents
+
+
+def _tile_starts(size: int, tile_size: int, overlap: int):
+    """The starts of the tiles of `tile_size` covering `size`, overlapping by at least `overlap`."""
+    if size <= tile_size:
+        return [0]
+    stride = max(1, tile_size - overlap)
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def _blend_ramp(length: int, start: int, end: int, size: int, overlap: int):
+    """Weights of a tile along one axis, rising over `overlap` pixels at the borders shared with other tiles."""
+    ramp = np.ones([length], dtype=np.float32)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        rise = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+        if start > 0:
+            ramp[:overlap] = rise
+        if end < size:
+            ramp[-overlap:] = rise[::-1]
+    return ramp
+
+
+def tiled_apply(fn, x: paddle.Tensor, tile_size: int, overlap: int, scale: float):
+    r"""
+    Apply `fn`, which maps a `[B, C, h, w]` tensor to a `[B, C', h * scale, w * scale]` one, tile by tile.
+
+    The tiles are `tile_size` pixels of `x` wide and overlap by `overlap` pixels, where their outputs are blended
+    linearly, so the peak memory of `fn` is the one of a single tile instead of the whole input.
+    """
+    height, width = x.shape[2], x.shape[3]
+    out_height, out_width = int(height * scale), int(width * scale)
+    out_overlap = int(overlap * scale)
+    output = None
+    weights = np.zeros([out_height, out_width], dtype=np.float32)
+    for top in _tile_starts(height, tile_size, overlap):
+        for left in _tile_starts(width, tile_size, overlap):
+            bottom, right = min(top + tile_size, height), min(left + tile_size, width)
+            tile = fn(x[:, :, top:bottom, left:right]).cast("float32")
+            out_top, out_left = int(top * scale), int(left * scale)
+            out_bottom, out_right = out_top + tile.shape[2], out_left + tile.shape[3]
+            weight = np.outer(
+                _blend_ramp(tile.shape[2], out_top, out_bottom, out_height, out_overlap),
+                _blend_ramp(tile.shape[3], out_left, out_right, out_width, out_overlap),
+            )
+            if output is None:
+                output = paddle.zeros([tile.shape[0], tile.shape[1], out_height, out_width], dtype="float32")
+            output[:, :, out_top:out_bottom, out_left:out_right] += tile * paddle.to_tensor(weight)
+            weights[out_top:out_bottom, out_left:out_right] += weight
+            del tile
+    return output / paddle.to_tensor(weights)
+
+
 def preprocess_image(image):
     w, h = image.size
     w, h = map(lambda x: x - x % 32, (w, h))  # resize to integer multiple of 32
@@ -581,6 +1524,101 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         # set slice_size = `None` to disable `attention slicing`
         self.enable_attention_slicing(None)
 
+    def enable_vae_tiling(self, tile_size: int = 64, overlap: int = 8):
+        r"""
+        Enable tiled VAE encoding and decoding.
+
+        When this option is enabled, the VAE processes the latents (and the images) in overlapping tiles which are
+        blended together, so that its peak memory is the one of a single tile whatever the size of the image. This
+        makes large images feasible on small devices, in exchange for some speed; the tiles are normalized on their
+        own, which can leave faint seams on flat areas.
+
+        Args:
+            tile_size (`int`, *optional*, defaults to 64):
+                The size of the tiles in latent pixels, i.e. `8 * tile_size` image pixels.
+            overlap (`int`, *optional*, defaults to 8):
+                The overlap of the tiles in latent pixels, over which they are blended.
+        """
+        self.vae_tiling = (tile_size, overlap)
+
+    def disable_vae_tiling(self):
+        r"""
+        Disable tiled VAE encoding and decoding. If `enable_vae_tiling` was previously invoked, this method will go
+        back to processing the whole image at once.
+        """
+        self.vae_tiling = None
+
+    def vae_encode(self, image):
+        """
+        `self.vae.encode(image).latent_dist`, tile by tile when VAE tiling is enabled and the image is larger than a
+        tile.
+        """
+        vae_tiling = getattr(self, "vae_tiling", None)
+        if vae_tiling is None or max(image.shape[2:]) <= vae_tiling[0] * 8:
+            return self.vae.encode(image).latent_dist
+        from ppdiffusers.models.vae import DiagonalGaussianDistribution
+
+        tile_size, overlap = vae_tiling
+        # blend the moments (mean and log variance) of the posterior of the tiles
+        parameters = tiled_apply(
+            lambda tile: self.vae.encode(tile).latent_dist.parameters, image, tile_size * 8, overlap * 8, 1 / 8
+        )
+        return DiagonalGaussianDistribution(parameters.cast(image.dtype))
+
+    def vae_decode(self, latents):
+        """
+        `self.vae.decode(latents).sample`, tile by tile when VAE tiling is enabled and the latents are larger than a
+        tile.
+        """
+        vae_tiling = getattr(self, "vae_tiling", None)
+        if vae_tiling is None or max(latents.shape[2:]) <= vae_tiling[0]:
+            return self.vae.decode(latents).sample
+        tile_size, overlap = vae_tiling
+        image = tiled_apply(lambda tile: self.vae.decode(tile).sample, latents, tile_size, overlap, 8)
+        return image.cast(latents.dtype)
+
+    def enable_latent_cache(
+        self,
+        cache_dir: Optional[str] = None,
+        max_bytes: int = 1024 * 1024 * 1024,
+        save_every: int = 5,
+        dtype: str = "float16",
+    ):
+        r"""
+        Cache the intermediate latents on disk, so that rerunning the same seed and prompt resumes from the deepest
+        cached step, e.g. after changing only the tail of the guidance schedule. Changing the number of steps or the
+        sampler starts from step 0. See [`LatentCache`] for the arguments.
+        """
+        self.latent_cache = LatentCache(cache_dir, max_bytes=max_bytes, save_every=save_every, dtype=dtype)
+
+    def disable_latent_cache(self):
+        r"""
+        Disable the latent cache enabled by `enable_latent_cache`. The cached files are kept.
+        """
+        self.latent_cache = None
+
+    def prepare_latent_cache(self, hooks, latents, timesteps, num_inference_steps, eta, *args):
+        """
+        Resume `latents` from the latent cache if it is enabled, and add the hook writing the new steps to `hooks`.
+        `args` are the inputs of the loop, besides the UNet and the scheduler, which determine the latents.
+        Return the latents and the index of the first step to run.
+        """
+        latent_cache = getattr(self, "latent_cache", None)
+        if latent_cache is None or not latent_cache.is_cacheable(self.scheduler, eta):
+            return latents, 0
+        guidance = next((hook for hook in hooks if isinstance(hook, ClassifierFreeGuidance)), None)
+        guidance_scales = [1.0 if guidance is None else guidance.get_guidance_scale(i) for i in range(len(timesteps))]
+        job = latent_cache.make_job_key(self, num_inference_steps, latents, eta, *args)
+        start_step = 0
+        resumed = latent_cache.resume(job, self.scheduler, guidance_scales)
+        if resumed is not None:
+            start_step, latents = resumed
+            if start_step >= len(timesteps):
+                # no step runs, which would write the index
+                latent_cache.flush()
+        hooks.append(LatentCacheWriter(latent_cache, job, self.scheduler, guidance_scales, len(timesteps)))
+        return latents, start_step
+
     def __call__(self, *args, **kwargs):
         return self.text2image(*args, **kwargs)
 
@@ -601,7 +1639,14 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         if do_classifier_free_guidance and negative_prompt is None:
             negative_prompt = ""
         text_embeddings = get_weighted_text_embeddings(
-            self, prompt, negative_prompt, max_embeddings_multiples, no_boseos_middle, skip_parsing, skip_weighting
+            self,
+            prompt,
+            negative_prompt,
+            max_embeddings_multiples,
+            no_boseos_middle,
+            skip_parsing,
+            skip_weighting,
+            cache=text_embedding_cache,
         )
 
         bs_embed, seq_len, _ = text_embeddings.shape
@@ -621,7 +1666,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
 
     def decode_latents(self, latents):
         latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents).sample
+        image = self.vae_decode(latents)
         image = (image / 2 + 0.5).clip(0, 1)
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
         image = image.transpose([0, 2, 3, 1]).cast("float32").numpy()
@@ -670,9 +1715,27 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
                 f" {type(callback_steps)}."
             )
 
-    def prepare_latents_text2img(self, batch_size, num_channels_latents, height, width, dtype, latents=None):
+    def prepare_seeds(self, seed, batch_size):
+        """
+        Expand `seed` to one seed per generated image, so that each image of a batch can be regenerated alone.
+        """
+        if seed is None:
+            return [random.randint(0, 2**32) for _ in range(batch_size)]
+        if isinstance(seed, (list, tuple)):
+            if len(seed) != batch_size:
+                raise ValueError(f"Expected {batch_size} seeds but got {len(seed)}.")
+            return list(seed)
+        return [seed + i for i in range(batch_size)]
+
+    def prepare_latents_text2img(
+        self, batch_size, num_channels_latents, height, width, dtype, latents=None, generator=None
+    ):
         shape = [batch_size, num_channels_latents, height // 8, width // 8]
-        if latents is None:
+        if latents is None and generator is not None:
+            if len(generator) != batch_size:
+                raise ValueError(f"Expected a generator for {batch_size} samples, got {len(generator)}.")
+            latents = generator.randn(shape[1:], dtype=dtype)
+        elif latents is None:
             latents = paddle.randn(shape, dtype=dtype)
         else:
             if latents.shape != shape:
@@ -682,18 +1745,37 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         latents = latents * self.scheduler.init_noise_sigma
         return latents
 
-    def prepare_latents_img2img(self, image, timestep, num_images_per_prompt, dtype):
-        image = image.cast(dtype=dtype)
-        init_latent_dist = self.vae.encode(image).latent_dist
-        init_latents = init_latent_dist.sample()
-        init_latents = 0.18215 * init_latents
+    def sample_init_latents(self, image, num_images_per_prompt, dtype, generator=None):
+        """
+        Encode `image` into latents, repeated `num_images_per_prompt` times, and draw the noise to be added.
+        When a `PerSampleNoiseGenerator` is given, both the posterior sample and the noise of each image come
+        from its own stream.
+        """
+        init_latent_dist = self.vae_encode(image)
+        if generator is None:
+            init_latents = init_latent_dist.sample()
+        else:
+            init_latents = init_latent_dist.mean
 
         b, c, h, w = init_latents.shape
         init_latents = init_latents.tile([1, num_images_per_prompt, 1, 1])
         init_latents = init_latents.reshape([b * num_images_per_prompt, c, h, w])
 
+        if generator is None:
+            noise = paddle.randn(init_latents.shape, dtype=dtype)
+        else:
+            std = init_latent_dist.std.tile([1, num_images_per_prompt, 1, 1])
+            std = std.reshape([b * num_images_per_prompt, c, h, w])
+            init_latents = init_latents + std * generator.randn([c, h, w], dtype=init_latents.dtype)
+            noise = generator.randn([c, h, w], dtype=dtype)
+
+        init_latents = 0.18215 * init_latents
+        return init_latents, noise
+
+    def prepare_latents_img2img(self, image, timestep, num_images_per_prompt, dtype, generator=None):
+        image = image.cast(dtype=dtype)
         # add noise to latents using the timesteps
-        noise = paddle.randn(init_latents.shape, dtype=dtype)
+        init_latents, noise = self.sample_init_latents(image, num_images_per_prompt, dtype, generator)
 
         # get latents
         init_latents = self.scheduler.add_noise(init_latents, noise, timestep)
@@ -701,7 +1783,15 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
 
         return latents
 
+    def set_timesteps(self, num_inference_steps):
+        timestep_cache.set_timesteps(self.scheduler, num_inference_steps)
+
     def get_timesteps(self, num_inference_steps, strength):
+        key = timestep_cache.make_key(self.scheduler, num_inference_steps, strength)
+        cached = timestep_cache.get(key)
+        if cached is not None:
+            return cached
+
         # get the original timestep using init_timestep
         offset = self.scheduler.config.get("steps_offset", 0)
         init_timestep = int(num_inference_steps * strength) + offset
@@ -710,22 +1800,16 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         t_start = max(num_inference_steps - init_timestep + offset, 0)
         timesteps = self.scheduler.timesteps[t_start:]
 
+        timestep_cache.put(key, (timesteps, num_inference_steps - t_start))
         return timesteps, num_inference_steps - t_start
 
-    def prepare_latents_inpaint(self, image, timestep, num_images_per_prompt, dtype):
+    def prepare_latents_inpaint(self, image, timestep, num_images_per_prompt, dtype, generator=None):
         image = image.cast(dtype)
-        init_latent_dist = self.vae.encode(image).latent_dist
-        init_latents = init_latent_dist.sample()
-        init_latents = 0.18215 * init_latents
-
-        b, c, h, w = init_latents.shape
-        init_latents = init_latents.tile([1, num_images_per_prompt, 1, 1])
-        init_latents = init_latents.reshape([b * num_images_per_prompt, c, h, w])
+        init_latents, noise = self.sample_init_latents(image, num_images_per_prompt, dtype, generator)
 
         init_latents_orig = init_latents
 
         # add noise to latents using the timesteps
-        noise = paddle.randn(init_latents.shape, dtype=dtype)
         init_latents = self.scheduler.add_noise(init_latents, noise, timestep)
         latents = init_latents
         return latents, init_latents_orig, noise
@@ -741,7 +1825,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_images_per_prompt: Optional[int] = 1,
         eta: float = 0.0,
-        seed: Optional[int] = None,
+        seed: Optional[Union[int, List[int]]] = None,
         latents: Optional[paddle.Tensor] = None,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
@@ -752,6 +1836,10 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         no_boseos_middle: Optional[bool] = False,
         skip_parsing: Optional[bool] = False,
         skip_weighting: Optional[bool] = False,
+        guidance_end: Optional[float] = 1.0,
+        guidance_schedule: Optional[str] = "constant",
+        early_stop_threshold: Optional[float] = None,
+        early_stop_patience: Optional[int] = 3,
         **kwargs,
     ):
         r"""
@@ -781,8 +1869,9 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             eta (`float`, *optional*, defaults to 0.0):
                 Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
                 [`schedulers.DDIMScheduler`], will be ignored for others.
-            seed (`int`, *optional*):
-                Random number seed.
+            seed (`int` or `List[int]`, *optional*):
+                Random number seed. A list gives one seed per generated image; an `int` seeds the images with
+                `seed`, `seed + 1`, ...
             latents (`paddle.Tensor`, *optional*):
                 Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -799,6 +1888,18 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            guidance_end (`float`, *optional*, defaults to 1.0):
+                The fraction of the denoising steps during which classifier free guidance is applied. The later steps
+                only run the conditional half of the batch, which makes them up to twice as fast.
+            guidance_schedule (`str`, *optional*, defaults to `"constant"`):
+                How the guidance scale evolves until `guidance_end`: `"constant"`, or decaying from `guidance_scale`
+                to 1 with `"linear"` or `"cosine"`.
+            early_stop_threshold (`float`, *optional*):
+                Stop denoising once the relative change of the latents of every image stays below this threshold for
+                `early_stop_patience` consecutive steps. The number of steps actually run is recorded as `steps_used`
+                in the image arguments. Disabled by default.
+            early_stop_patience (`int`, *optional*, defaults to 3):
+                The number of consecutive converged steps before stopping.
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -807,7 +1908,9 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             list of `bool`s denoting whether the corresponding generated image likely represents "not-safe-for-work"
             (nsfw) content, according to the `safety_checker`.
         """
-        seed = random.randint(0, 2**32) if seed is None else seed
+        seeds = self.prepare_seeds(seed, (1 if isinstance(prompt, str) else len(prompt)) * num_images_per_prompt)
+        seed = seeds[0]
+        generator = PerSampleNoiseGenerator(seeds)
         argument = dict(
             prompt=prompt,
             negative_prompt=negative_prompt,
@@ -823,8 +1926,13 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             no_boseos_middle=no_boseos_middle,
             skip_parsing=skip_parsing,
             skip_weighting=skip_weighting,
+            guidance_end=guidance_end,
+            guidance_schedule=guidance_schedule,
+            early_stop_threshold=early_stop_threshold,
             epoch_time=time.time(),
         )
+        # the initial noise comes from `generator`; the global seed only drives the noise that ancestral
+        # schedulers draw inside `scheduler.step`, which depends on the batch (see `scheduler_draws_noise`)
         paddle.seed(seed)
         # 1. Check inputs. Raise error if not correct
         self.check_inputs_text2img(prompt, height, width, callback_steps)
@@ -849,7 +1957,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         )
 
         # 4. Prepare timesteps
-        self.scheduler.set_timesteps(num_inference_steps)
+        self.set_timesteps(num_inference_steps)
         timesteps = self.scheduler.timesteps
 
         # 5. Prepare latent variables
@@ -861,35 +1969,28 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             width,
             text_embeddings.dtype,
             latents,
+            generator,
         )
 
         # 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(eta)
 
         # 7. Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = paddle.concat([latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                # predict the noise residual
-                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
-
-                # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-                # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
-                    progress_bar.update()
-                    if callback is not None and i % callback_steps == 0:
-                        callback(i, t, latents)
+        hooks = [
+            ClassifierFreeGuidance(guidance_scale, len(timesteps), guidance_end, guidance_schedule)
+            if do_classifier_free_guidance
+            else None,
+            StepCallback(callback, callback_steps) if callback is not None else None,
+            EarlyStopping(early_stop_threshold, early_stop_patience) if early_stop_threshold else None,
+        ]
+        latents, start_step = self.prepare_latent_cache(
+            hooks, latents, timesteps, num_inference_steps, eta, text_embeddings
+        )
+        loop = DenoisingLoop(self, hooks)
+        latents = loop(latents, timesteps, text_embeddings, num_inference_steps, extra_step_kwargs, start_step)
+        if early_stop_threshold:
+            early_stopping_stats.record(loop.steps_run, num_inference_steps)
+            argument["steps_used"] = loop.steps_run
 
         # 8. Post-processing
         image = self.decode_latents(latents)
@@ -899,7 +2000,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
 
         # 10. Convert to PIL
         if output_type == "pil":
-            image = self.numpy_to_pil(image, argument=argument)
+            image = self.numpy_to_pil(image, argument=[dict(argument, seed=s) for s in seeds])
 
         if not return_dict:
             return (image, has_nsfw_concept)
@@ -919,7 +2020,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_images_per_prompt: Optional[int] = 1,
         eta: Optional[float] = 0.0,
-        seed: Optional[int] = None,
+        seed: Optional[Union[int, List[int]]] = None,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
         callback: Optional[Callable[[int, int, paddle.Tensor], None]] = None,
@@ -929,6 +2030,10 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         no_boseos_middle: Optional[bool] = False,
         skip_parsing: Optional[bool] = False,
         skip_weighting: Optional[bool] = False,
+        guidance_end: Optional[float] = 1.0,
+        guidance_schedule: Optional[str] = "constant",
+        early_stop_threshold: Optional[float] = None,
+        early_stop_patience: Optional[int] = 3,
         **kwargs,
     ):
         r"""
@@ -963,8 +2068,9 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             eta (`float`, *optional*, defaults to 0.0):
                 Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
                 [`schedulers.DDIMScheduler`], will be ignored for others.
-            seed (`int`, *optional*):
-                A random seed.
+            seed (`int` or `List[int]`, *optional*):
+                A random seed. A list gives one seed per generated image; an `int` seeds the images with
+                `seed`, `seed + 1`, ...
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
                 [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
@@ -977,6 +2083,18 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            guidance_end (`float`, *optional*, defaults to 1.0):
+                The fraction of the denoising steps during which classifier free guidance is applied. The later steps
+                only run the conditional half of the batch, which makes them up to twice as fast.
+            guidance_schedule (`str`, *optional*, defaults to `"constant"`):
+                How the guidance scale evolves until `guidance_end`: `"constant"`, or decaying from `guidance_scale`
+                to 1 with `"linear"` or `"cosine"`.
+            early_stop_threshold (`float`, *optional*):
+                Stop denoising once the relative change of the latents of every image stays below this threshold for
+                `early_stop_patience` consecutive steps. The number of steps actually run is recorded as `steps_used`
+                in the image arguments. Disabled by default.
+            early_stop_patience (`int`, *optional*, defaults to 3):
+                The number of consecutive converged steps before stopping.
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -985,7 +2103,9 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             list of `bool`s denoting whether the corresponding generated image likely represents "not-safe-for-work"
             (nsfw) content, according to the `safety_checker`.
         """
-        seed = random.randint(0, 2**32) if seed is None else seed
+        seeds = self.prepare_seeds(seed, (1 if isinstance(prompt, str) else len(prompt)) * num_images_per_prompt)
+        seed = seeds[0]
+        generator = PerSampleNoiseGenerator(seeds)
         image_str = image
         if isinstance(image_str, str):
             image = load_image(image_str)
@@ -1017,8 +2137,13 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             no_boseos_middle=no_boseos_middle,
             skip_parsing=skip_parsing,
             skip_weighting=skip_weighting,
+            guidance_end=guidance_end,
+            guidance_schedule=guidance_schedule,
+            early_stop_threshold=early_stop_threshold,
             epoch_time=time.time(),
         )
+        # the initial noise comes from `generator`; the global seed only drives the noise that ancestral
+        # schedulers draw inside `scheduler.step`, which depends on the batch (see `scheduler_draws_noise`)
         paddle.seed(seed)
 
         # 1. Check inputs
@@ -1049,40 +2174,34 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             image = preprocess_image(image)
 
         # 5. set timesteps
-        self.scheduler.set_timesteps(num_inference_steps)
+        self.set_timesteps(num_inference_steps)
         timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, strength)
         latent_timestep = timesteps[:1].tile([batch_size * num_images_per_prompt])
 
         # 6. Prepare latent variables
-        latents = self.prepare_latents_img2img(image, latent_timestep, num_images_per_prompt, text_embeddings.dtype)
+        latents = self.prepare_latents_img2img(
+            image, latent_timestep, num_images_per_prompt, text_embeddings.dtype, generator
+        )
 
         # 7. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(eta)
 
         # 8. Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = paddle.concat([latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                # predict the noise residual
-                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
-
-                # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-                # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
-                    progress_bar.update()
-                    if callback is not None and i % callback_steps == 0:
-                        callback(i, t, latents)
+        hooks = [
+            ClassifierFreeGuidance(guidance_scale, len(timesteps), guidance_end, guidance_schedule)
+            if do_classifier_free_guidance
+            else None,
+            StepCallback(callback, callback_steps) if callback is not None else None,
+            EarlyStopping(early_stop_threshold, early_stop_patience) if early_stop_threshold else None,
+        ]
+        latents, start_step = self.prepare_latent_cache(
+            hooks, latents, timesteps, num_inference_steps, eta, text_embeddings
+        )
+        loop = DenoisingLoop(self, hooks)
+        latents = loop(latents, timesteps, text_embeddings, num_inference_steps, extra_step_kwargs, start_step)
+        if early_stop_threshold:
+            early_stopping_stats.record(loop.steps_run, num_inference_steps)
+            argument["steps_used"] = loop.steps_run
 
         # 9. Post-processing
         image = self.decode_latents(latents)
@@ -1092,7 +2211,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
 
         # 11. Convert to PIL
         if output_type == "pil":
-            image = self.numpy_to_pil(image, argument=argument)
+            image = self.numpy_to_pil(image, argument=[dict(argument, seed=s) for s in seeds])
 
         if not return_dict:
             return (image, has_nsfw_concept)
@@ -1113,7 +2232,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_images_per_prompt: Optional[int] = 1,
         eta: Optional[float] = 0.0,
-        seed: Optional[int] = None,
+        seed: Optional[Union[int, List[int]]] = None,
         output_type: Optional[str] = "pil",
         return_dict: bool = True,
         callback: Optional[Callable[[int, int, paddle.Tensor], None]] = None,
@@ -1123,6 +2242,10 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         no_boseos_middle: Optional[bool] = False,
         skip_parsing: Optional[bool] = False,
         skip_weighting: Optional[bool] = False,
+        guidance_end: Optional[float] = 1.0,
+        guidance_schedule: Optional[str] = "constant",
+        early_stop_threshold: Optional[float] = None,
+        early_stop_patience: Optional[int] = 3,
         **kwargs,
     ):
         r"""
@@ -1161,8 +2284,9 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             eta (`float`, *optional*, defaults to 0.0):
                 Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
                 [`schedulers.DDIMScheduler`], will be ignored for others.
-            seed (`int`, *optional*):
-                A random seed.
+            seed (`int` or `List[int]`, *optional*):
+                A random seed. A list gives one seed per generated image; an `int` seeds the images with
+                `seed`, `seed + 1`, ...
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
                 [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
@@ -1175,6 +2299,18 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            guidance_end (`float`, *optional*, defaults to 1.0):
+                The fraction of the denoising steps during which classifier free guidance is applied. The later steps
+                only run the conditional half of the batch, which makes them up to twice as fast.
+            guidance_schedule (`str`, *optional*, defaults to `"constant"`):
+                How the guidance scale evolves until `guidance_end`: `"constant"`, or decaying from `guidance_scale`
+                to 1 with `"linear"` or `"cosine"`.
+            early_stop_threshold (`float`, *optional*):
+                Stop denoising once the relative change of the latents of every image stays below this threshold for
+                `early_stop_patience` consecutive steps. The number of steps actually run is recorded as `steps_used`
+                in the image arguments. Disabled by default.
+            early_stop_patience (`int`, *optional*, defaults to 3):
+                The number of consecutive converged steps before stopping.
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -1183,7 +2319,9 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             list of `bool`s denoting whether the corresponding generated image likely represents "not-safe-for-work"
             (nsfw) content, according to the `safety_checker`.
         """
-        seed = random.randint(0, 2**32) if seed is None else seed
+        seeds = self.prepare_seeds(seed, (1 if isinstance(prompt, str) else len(prompt)) * num_images_per_prompt)
+        seed = seeds[0]
+        generator = PerSampleNoiseGenerator(seeds)
         image_str = image
         mask_image_str = mask_image
 
@@ -1220,8 +2358,13 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             no_boseos_middle=no_boseos_middle,
             skip_parsing=skip_parsing,
             skip_weighting=skip_weighting,
+            guidance_end=guidance_end,
+            guidance_schedule=guidance_schedule,
+            early_stop_threshold=early_stop_threshold,
             epoch_time=time.time(),
         )
+        # the initial noise comes from `generator`; the global seed only drives the noise that ancestral
+        # schedulers draw inside `scheduler.step`, which depends on the batch (see `scheduler_draws_noise`)
         paddle.seed(seed)
 
         # 1. Check inputs
@@ -1255,14 +2398,14 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
             mask_image = preprocess_mask(mask_image)
 
         # 5. set timesteps
-        self.scheduler.set_timesteps(num_inference_steps)
+        self.set_timesteps(num_inference_steps)
         timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, strength)
         latent_timestep = timesteps[:1].tile([batch_size * num_images_per_prompt])
 
         # 6. Prepare latent variables
         # encode the init image into latents and scale the latents
         latents, init_latents_orig, noise = self.prepare_latents_inpaint(
-            image, latent_timestep, num_images_per_prompt, text_embeddings.dtype
+            image, latent_timestep, num_images_per_prompt, text_embeddings.dtype, generator
         )
 
         # 7. Prepare mask latent
@@ -1273,33 +2416,22 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         extra_step_kwargs = self.prepare_extra_step_kwargs(eta)
 
         # 9. Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = paddle.concat([latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                # predict the noise residual
-                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
-
-                # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-                # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-                # masking
-                init_latents_proper = self.scheduler.add_noise(init_latents_orig, noise, t)
-
-                latents = (init_latents_proper * mask) + (latents * (1 - mask))
-
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
-                    progress_bar.update()
-                    if callback is not None and i % callback_steps == 0:
-                        callback(i, t, latents)
+        hooks = [
+            ClassifierFreeGuidance(guidance_scale, len(timesteps), guidance_end, guidance_schedule)
+            if do_classifier_free_guidance
+            else None,
+            InpaintMask(self.scheduler, init_latents_orig, noise, mask),
+            StepCallback(callback, callback_steps) if callback is not None else None,
+            EarlyStopping(early_stop_threshold, early_stop_patience) if early_stop_threshold else None,
+        ]
+        latents, start_step = self.prepare_latent_cache(
+            hooks, latents, timesteps, num_inference_steps, eta, text_embeddings, init_latents_orig, noise, mask
+        )
+        loop = DenoisingLoop(self, hooks)
+        latents = loop(latents, timesteps, text_embeddings, num_inference_steps, extra_step_kwargs, start_step)
+        if early_stop_threshold:
+            early_stopping_stats.record(loop.steps_run, num_inference_steps)
+            argument["steps_used"] = loop.steps_run
 
         # 10. Post-processing
         image = self.decode_latents(latents)
@@ -1309,7 +2441,7 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
 
         # 12. Convert to PIL
         if output_type == "pil":
-            image = self.numpy_to_pil(image, argument=argument)
+            image = self.numpy_to_pil(image, argument=[dict(argument, seed=s) for s in seeds])
 
         if not return_dict:
             return (image, has_nsfw_concept)
@@ -1326,9 +2458,11 @@ class StableDiffusionPipelineAllinOne(DiffusionPipeline):
         images = (images * 255).round().astype("uint8")
         pil_images = []
         argument = kwargs.pop("argument", None)
-        for image in images:
+        for i, image in enumerate(images):
             image = PIL.Image.fromarray(image)
-            if argument is not None:
+            if isinstance(argument, (list, tuple)):
+                image.argument = argument[i]
+            elif argument is not None:
                 image.argument = argument
             pil_images.append(image)
 
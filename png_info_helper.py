@@ -38,6 +38,10 @@ PRAM_NAME_LIST = (
     'no_boseos_middle',
     'skip_parsing',
     'skip_weighting',
+    'guidance_end',
+    'guidance_schedule',
+    'early_stop_threshold',
+    'steps_used',
     'epoch_time',
     'sampler',
     'superres_model_name',
@@ -52,8 +56,11 @@ MAP_PARAM_TO_LABEL = {
     'prompt': '',
     'negative_prompt': 'Negative prompt: ', #用于与webui保持一致
     'num_inference_steps': 'Steps: ', #用于与webui保持一致
+    'steps_used': 'Steps used: ',
     'sampler': 'Sampler: ',
     'guidance_scale': 'CFG scale: ',
+    'guidance_end': 'CFG end: ',
+    'guidance_schedule': 'CFG schedule: ',
     'strength': 'Strength: ',
     'seed': 'Seed: ',
     'width':'width: ',
@@ -64,9 +71,12 @@ MAP_LAEBL_TO_PARAM = {
     'Prompt': 'prompt',
     'Negative prompt': 'negative_prompt',
     'Steps': 'num_inference_steps',
+    'Steps used': 'steps_used',
     'Sampler': 'sampler',
     'CFG Scale': 'guidance_scale',
     'CFG scale': 'guidance_scale',
+    'CFG end': 'guidance_end',
+    'CFG schedule': 'guidance_schedule',
     'Strength': 'strength',
     'Seed': 'seed',
     'Width':'width',
@@ -0,0 +1,181 @@
+"""
+`DenoisingLoop` must give bit-identical latents to the inline loops it replaced in text2image, img2img and inpaint.
+
+Runs on CPU with a tiny randomly initialized UNet.
+"""
+import contextlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+paddle = pytest.importorskip("paddle")
+pytest.importorskip("ppdiffusers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ppdiffusers.models import UNet2DConditionModel  # noqa: E402
+from ppdiffusers.schedulers import (  # noqa: E402
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+)
+
+from pipeline_stable_diffusion_all_in_one import (  # noqa: E402
+    ClassifierFreeGuidance,
+    DenoisingLoop,
+    InpaintMask,
+    StepCallback,
+)
+
+SCHEDULER_KWARGS = dict(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+SCHEDULERS = {
+    "ddim": lambda: DDIMScheduler(clip_sample=False, set_alpha_to_one=False, steps_offset=1, **SCHEDULER_KWARGS),
+    "pndm": lambda: PNDMScheduler(skip_prk_steps=True, steps_offset=1, **SCHEDULER_KWARGS),
+    "lms": lambda: LMSDiscreteScheduler(**SCHEDULER_KWARGS),
+    "euler": lambda: EulerDiscreteScheduler(**SCHEDULER_KWARGS),
+    "euler-ancestral": lambda: EulerAncestralDiscreteScheduler(**SCHEDULER_KWARGS),
+    "dpm-solver": lambda: DPMSolverMultistepScheduler(**SCHEDULER_KWARGS),
+}
+NUM_INFERENCE_STEPS = 6
+GUIDANCE_SCALE = 7.5
+SEED = 42
+
+
+class _ProgressBar:
+    def update(self):
+        pass
+
+
+class _Pipe:
+    """The parts of the pipeline used by `DenoisingLoop`."""
+
+    def __init__(self, unet, scheduler):
+        self.unet = unet
+        self.scheduler = scheduler
+
+    @contextlib.contextmanager
+    def progress_bar(self, total=None):
+        yield _ProgressBar()
+
+
+@pytest.fixture(scope="module")
+def unet():
+    paddle.set_device("cpu")
+    paddle.seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=16,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    unet.eval()
+    return unet
+
+
+def _inputs(batch_size=2):
+    rng = np.random.default_rng(SEED)
+    latents = paddle.to_tensor(rng.standard_normal((batch_size, 4, 16, 16), dtype=np.float32))
+    # [unconditional, conditional]
+    text_embeddings = paddle.to_tensor(rng.standard_normal((2 * batch_size, 7, 32), dtype=np.float32))
+    init_latents = paddle.to_tensor(rng.standard_normal((batch_size, 4, 16, 16), dtype=np.float32))
+    noise = paddle.to_tensor(rng.standard_normal((batch_size, 4, 16, 16), dtype=np.float32))
+    mask = paddle.to_tensor((rng.random((batch_size, 4, 16, 16)) > 0.5).astype(np.float32))
+    return latents, text_embeddings, init_latents, noise, mask
+
+
+def _timesteps(scheduler, strength):
+    """`set_timesteps` and `get_timesteps` of the pipeline."""
+    scheduler.set_timesteps(NUM_INFERENCE_STEPS)
+    if strength is None:
+        return scheduler.timesteps, NUM_INFERENCE_STEPS
+    offset = scheduler.config.get("steps_offset", 0)
+    init_timestep = min(int(NUM_INFERENCE_STEPS * strength) + offset, NUM_INFERENCE_STEPS)
+    t_start = max(NUM_INFERENCE_STEPS - init_timestep + offset, 0)
+    return scheduler.timesteps[t_start:], NUM_INFERENCE_STEPS - t_start
+
+
+def inline_loop(unet, scheduler, latents, timesteps, text_embeddings, num_inference_steps, callback, inpaint=None):
+    """The loop of text2image and img2img before `DenoisingLoop`, with the masking of inpaint."""
+    do_classifier_free_guidance = GUIDANCE_SCALE > 1.0
+    num_warmup_steps = len(timesteps) - num_inference_steps * scheduler.order
+    for i, t in enumerate(timesteps):
+        # expand the latents if we are doing classifier free guidance
+        latent_model_input = paddle.concat([latents] * 2) if do_classifier_free_guidance else latents
+        latent_model_input = scheduler.scale_model_input(latent_model_input, t)
+
+        # predict the noise residual
+        noise_pred = unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+
+        # perform guidance
+        if do_classifier_free_guidance:
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            noise_pred = noise_pred_uncond + GUIDANCE_SCALE * (noise_pred_text - noise_pred_uncond)
+
+        # compute the previous noisy sample x_t -> x_t-1
+        latents = scheduler.step(noise_pred, t, latents).prev_sample
+        if inpaint is not None:
+            # masking
+            init_latents_orig, noise, mask = inpaint
+            init_latents_proper = scheduler.add_noise(init_latents_orig, noise, t)
+
+            latents = (init_latents_proper * mask) + (latents * (1 - mask))
+
+        # call the callback, if provided
+        if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
+            callback(i, t, latents)
+    return latents
+
+
+def _run(unet, scheduler_name, task, use_loop):
+    scheduler = SCHEDULERS[scheduler_name]()
+    latents, text_embeddings, init_latents, noise, mask = _inputs()
+    timesteps, num_inference_steps = _timesteps(scheduler, None if task == "text2image" else 0.75)
+    if task != "text2image":
+        latents = scheduler.add_noise(init_latents, noise, timesteps[:1].tile([latents.shape[0]]))
+    inpaint = (init_latents, noise, mask) if task == "inpaint" else None
+
+    steps = []
+
+    def callback(i, t, latents):
+        steps.append((i, float(t), latents.numpy()))
+
+    # the ancestral schedulers draw their step noise from the global generator
+    paddle.seed(SEED)
+    with paddle.no_grad():
+        if use_loop:
+            hooks = [
+                ClassifierFreeGuidance(GUIDANCE_SCALE, len(timesteps)),
+                InpaintMask(scheduler, *inpaint) if inpaint is not None else None,
+                StepCallback(callback),
+            ]
+            latents = DenoisingLoop(_Pipe(unet, scheduler), hooks)(
+                latents, timesteps, text_embeddings, num_inference_steps
+            )
+        else:
+            latents = inline_loop(
+                unet, scheduler, latents, timesteps, text_embeddings, num_inference_steps, callback, inpaint
+            )
+    return latents.numpy(), steps
+
+
+@pytest.mark.parametrize("scheduler_name", sorted(SCHEDULERS))
+@pytest.mark.parametrize("task", ["text2image", "img2img", "inpaint"])
+def test_denoising_loop_is_bit_identical(unet, scheduler_name, task):
+    if task == "inpaint" and scheduler_name in ("euler", "euler-ancestral", "lms") and paddle.ones([2])[0].ndim == 0:
+        pytest.skip("the sigma schedulers of ppdiffusers 0.9 can't add noise at the 0-D timesteps of paddle >= 2.5")
+    expected, expected_steps = _run(unet, scheduler_name, task, use_loop=False)
+    latents, steps = _run(unet, scheduler_name, task, use_loop=True)
+
+    np.testing.assert_array_equal(latents, expected)
+    assert [step[:2] for step in steps] == [step[:2] for step in expected_steps]
+    for (_, _, step_latents), (_, _, expected_latents) in zip(steps, expected_steps):
+        np.testing.assert_array_equal(step_latents, expected_latents)
@@ -0,0 +1,79 @@
+"""
+A scheduler whose tables are restored by `TimestepCache` must step exactly as after its own `set_timesteps`, also
+after runs with other step counts and once `step` has modified its state.
+
+Runs on CPU with a fixed function of the sample in place of the UNet.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+paddle = pytest.importorskip("paddle")
+pytest.importorskip("ppdiffusers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ppdiffusers.schedulers import (  # noqa: E402
+    DPMSolverMultistepScheduler,
+    HeunDiscreteScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+)
+
+from pipeline_stable_diffusion_all_in_one import TimestepCache  # noqa: E402
+
+SCHEDULER_KWARGS = dict(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+SCHEDULERS = {
+    "dpm-solver": lambda: DPMSolverMultistepScheduler(**SCHEDULER_KWARGS),
+    "pndm": lambda: PNDMScheduler(skip_prk_steps=True, steps_offset=1, **SCHEDULER_KWARGS),
+    "lms": lambda: LMSDiscreteScheduler(**SCHEDULER_KWARGS),
+    "heun": lambda: HeunDiscreteScheduler(**SCHEDULER_KWARGS),
+}
+NUM_INFERENCE_STEPS = 6
+SEED = 42
+
+
+def _model(sample, t):
+    """A deterministic stand-in for the noise prediction of the UNet."""
+    return paddle.sin(sample * 0.5 + float(t) / 1000.0)
+
+
+def run(scheduler):
+    """The denoising loop, after `set_timesteps`, returning the latents after every `step`."""
+    rng = np.random.default_rng(SEED)
+    latents = paddle.to_tensor(rng.standard_normal((1, 4, 8, 8), dtype=np.float32)) * scheduler.init_noise_sigma
+    outputs = []
+    for t in scheduler.timesteps:
+        model_input = scheduler.scale_model_input(latents, t)
+        latents = scheduler.step(_model(model_input, t), t, latents).prev_sample
+        outputs.append(latents.numpy())
+    return outputs
+
+
+@pytest.mark.parametrize("scheduler_name", list(SCHEDULERS))
+def test_cached_step_is_identical(scheduler_name):
+    paddle.set_device("cpu")
+    scheduler = SCHEDULERS[scheduler_name]()
+    scheduler.set_timesteps(NUM_INFERENCE_STEPS)
+    expected = run(scheduler)
+
+    cache = TimestepCache()
+    scheduler = SCHEDULERS[scheduler_name]()
+    # a miss, then hits after runs with another step count which left their own tables and history
+    for num_inference_steps in (NUM_INFERENCE_STEPS, NUM_INFERENCE_STEPS + 3, NUM_INFERENCE_STEPS, NUM_INFERENCE_STEPS):
+        cache.set_timesteps(scheduler, num_inference_steps)
+        outputs = run(scheduler)
+        if num_inference_steps == NUM_INFERENCE_STEPS:
+            assert len(outputs) == len(expected)
+            for output, expected_output in zip(outputs, expected):
+                np.testing.assert_array_equal(output, expected_output)
+    assert cache.stats() == dict(hits=2, misses=2, entries=2)
+
+    # another instance with the same config shares the tables
+    scheduler = SCHEDULERS[scheduler_name]()
+    cache.set_timesteps(scheduler, NUM_INFERENCE_STEPS)
+    for output, expected_output in zip(run(scheduler), expected):
+        np.testing.assert_array_equal(output, expected_output)
+    assert cache.stats()["hits"] == 3
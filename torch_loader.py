@@ -0,0 +1,256 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Read the zip-based pytorch weight files with numpy only, without torch.
+"""
+from __future__ import annotations
+
+import io
+import mmap
+import pickle
+import struct
+import zipfile
+from functools import lru_cache
+
+import numpy as np
+
+MZ_ZIP_LOCAL_DIR_HEADER_SIZE = 30
+
+
+class TensorMeta:
+    """
+    metadata of tensor
+    """
+
+    def __init__(self, key: str, n_bytes: int, dtype: str):
+        self.key = key
+        self.nbytes = n_bytes
+        self.dtype = dtype
+        self.size = None
+
+    def __repr__(self):
+        return f"size: {self.size} key: {self.key}, nbytes: {self.nbytes}, dtype: {self.dtype}"
+
+
+class SerializationError(Exception):
+    """Exception for serialization"""
+
+    pass
+
+
+@lru_cache(maxsize=None)
+def _storage_type_to_dtype_to_map():
+    """convert storage type to numpy dtype"""
+    return {
+        "DoubleStorage": np.double,
+        "FloatStorage": np.float32,
+        "HalfStorage": np.half,
+        "LongStorage": np.int64,
+        "IntStorage": np.int32,
+        "ShortStorage": np.int16,
+        "CharStorage": np.int8,
+        "ByteStorage": np.uint8,
+        "BoolStorage": np.bool_,
+        "ComplexDoubleStorage": np.cdouble,
+        "ComplexFloatStorage": np.complex64,
+    }
+
+
+class StorageType:
+    """Temp Class for Storage Type"""
+
+    def __init__(self, name):
+        self.dtype = _storage_type_to_dtype_to_map()[name]
+
+    def __str__(self):
+        return f"StorageType(dtype={self.dtype})"
+
+
+def _element_size(dtype: str) -> int:
+    """
+    Returns the element size for a dtype, in bytes
+    """
+    if dtype in [np.float16, np.float32, np.float64]:
+        return np.finfo(dtype).bits >> 3
+    elif dtype == np.bool_:
+        return 1
+    else:
+        return np.iinfo(dtype).bits >> 3
+
+
+class UnpicklerWrapperStage(pickle.Unpickler):
+    def find_class(self, mod_name, name):
+        if type(name) is str and "Storage" in name:
+            try:
+                return StorageType(name)
+            except KeyError:
+                pass
+
+        # pure torch tensor builder
+        if mod_name == "torch._utils":
+            if name.startswith("_rebuild_parameter"):
+                return _rebuild_parameter_stage
+            return _rebuild_tensor_stage
+
+        # pytorch_lightning tensor builder
+        if "pytorch_lightning" in mod_name:
+            return dumpy
+        return super().find_class(mod_name, name)
+
+
+def _rebuild_tensor_stage(storage, storage_offset, size, stride, requires_grad, backward_hooks, *args):
+    if isinstance(storage, TensorMeta):
+        storage.size = size
+    elif isinstance(storage, np.ndarray) and (storage_offset or storage.shape != tuple(size)):
+        # a view into a larger storage, e.g. a row of an embedding matrix
+        storage = storage.reshape(-1)
+        return np.lib.stride_tricks.as_strided(
+            storage[storage_offset:], shape=tuple(size), strides=tuple(s * storage.itemsize for s in stride), writeable=False
+        )
+    return storage
+
+
+def _rebuild_parameter_stage(data, requires_grad, backward_hooks, *args):
+    return data
+
+
+def dumpy(*args, **kwarsg):
+    return None
+
+
+def read_zip_index(path: str) -> dict:
+    """read the central directory of the zip file once to locate the data of every entry
+
+    Args:
+        path (str): the path of pytorch weight file
+
+    Returns:
+        dict: entry name -> (offset of the data in the file, size of the data)
+    """
+    index = {}
+    try:
+        with zipfile.ZipFile(path) as zip_file, open(path, "rb") as file_handler:
+            for info in zip_file.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise SerializationError(f"the entry<{info.filename}> of the weight file is compressed")
+                # the extra field of the local header (the padding of the data) differs from the central directory one
+                file_handler.seek(info.header_offset)
+                header = file_handler.read(MZ_ZIP_LOCAL_DIR_HEADER_SIZE)
+                if header[:4] != b"PK\x03\x04":
+                    raise SerializationError(f"can't find the local header of the entry<{info.filename}>")
+                name_length, extra_length = struct.unpack("<HH", header[26:30])
+                offset = info.header_offset + MZ_ZIP_LOCAL_DIR_HEADER_SIZE + name_length + extra_length
+                index[info.filename] = (offset, info.file_size)
+    except zipfile.BadZipFile as e:
+        raise SerializationError(f"{path} is not a zip-based pytorch weight file") from e
+    return index
+
+
+def load_torch(path: str, use_mmap: bool = False, **pickle_load_args):
+    """
+    load torch weight file with the following steps:
+
+    1. load the structure of pytorch weight file
+    2. read the tensor data and re-construct the state-dict
+
+    Args:
+        path: the path of pytorch weight file
+        use_mmap: memory-map the file and return numpy views into the mapping instead of reading every tensor,
+            so that only the tensors actually used are loaded in memory. The views are copy-on-write.
+        **pickle_load_args: args of pickle module
+
+    Returns:
+
+    """
+    pickle_load_args.update({"encoding": "utf-8"})
+
+    # 1. load the structure of pytorch weight file
+    def persistent_load_stage1(saved_id):
+        assert isinstance(saved_id, tuple)
+        data = saved_id[1:]
+        storage_type, key, _, numel = data
+        dtype = storage_type.dtype
+        n_bytes = numel * _element_size(dtype)
+        return TensorMeta(key, n_bytes, dtype)
+
+    zip_index = read_zip_index(path)
+    pkl_names = [name for name in zip_index if name == "data.pkl" or name.endswith("/data.pkl")]
+    if len(pkl_names) == 0:
+        raise SerializationError(f"can't find data.pkl in {path}")
+    prefix = pkl_names[0][: -len("data.pkl")]
+    pkl_offset, pkl_size = zip_index[pkl_names[0]]
+    with open(path, "rb") as file_handler:
+        file_handler.seek(pkl_offset)
+        data_iostream = file_handler.read(pkl_size)
+    # 1. read the structure of storage
+    unpickler_stage1 = UnpicklerWrapperStage(io.BytesIO(data_iostream), **pickle_load_args)
+    unpickler_stage1.persistent_load = persistent_load_stage1
+    result_stage1 = unpickler_stage1.load()
+
+    # 2. get the metadata of weight file
+    metadata = {}
+
+    def extract_maybe_dict(result):
+        if isinstance(result, dict):
+            for k, v in result.items():
+                extract_maybe_dict(v)
+        elif isinstance(result, (list, tuple)):
+            for res in result:
+                extract_maybe_dict(res)
+        elif isinstance(result, TensorMeta):
+            metadata[result.key] = result
+
+    extract_maybe_dict(result_stage1)
+    metadata = list(metadata.values())
+    metadata = sorted(metadata, key=lambda x: x.key)
+    # 3. parse the tensor of pytorch weight file
+    stage1_key_to_tensor = {}
+    with open(path, "rb") as file_handler:
+        # the views keep the mapping alive after the file is closed
+        mapping = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_COPY) if use_mmap else None
+        for tensor_meta in metadata:
+            key = tensor_meta.key
+            name = f"{prefix}data/{key}"
+            if name not in zip_index:
+                raise SerializationError(f"can't find the target entry<{name}> in the file")
+            offset, _ = zip_index[name]
+
+            if mapping is not None:
+                # the pages are only read when the tensor is used
+                array = np.frombuffer(
+                    mapping,
+                    dtype=tensor_meta.dtype,
+                    count=tensor_meta.nbytes // _element_size(tensor_meta.dtype),
+                    offset=offset,
+                )
+            else:
+                # save the tensor info in result to re-use memory
+                file_handler.seek(offset)
+                array = np.frombuffer(file_handler.read(tensor_meta.nbytes), dtype=tensor_meta.dtype)
+            # the views into a larger storage are rebuilt by `_rebuild_tensor_stage`
+            if tensor_meta.size is not None and int(np.prod(tensor_meta.size)) == array.size:
+                array = array.reshape(tensor_meta.size)
+            stage1_key_to_tensor[key] = array
+
+    def persistent_load_stage2(saved_id):
+        assert isinstance(saved_id, tuple)
+        key = saved_id[2]
+        return stage1_key_to_tensor[key]
+
+    # 4. read the structure of storage
+    unpickler_stage2 = UnpicklerWrapperStage(io.BytesIO(data_iostream), **pickle_load_args)
+    unpickler_stage2.persistent_load = persistent_load_stage2
+    result_stage2 = unpickler_stage2.load()
+
+    return result_stage2
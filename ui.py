@@ -24,6 +24,7 @@ from .png_info_helper import serialize_to_pnginfo, imageinfo_to_pnginfo
 
 
 from .env import DEBUG_UI
+from .config import config
 
 if not DEBUG_UI:
 
@@ -51,7 +52,7 @@ if not DEBUG_UI:
         os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
     pipeline_superres = SuperResolutionPipeline()
-    pipeline = StableDiffusionFriendlyPipeline(superres_pipeline = pipeline_superres)
+    pipeline = StableDiffusionFriendlyPipeline(superres_pipeline = pipeline_superres, **config['pipeline'])
 else:
     pipeline_superres = None
     pipeline = None
@@ -172,6 +173,8 @@ class StableDiffusionTrainUI():
             args.image_logging_prompt = args.placeholder_token
         ## done
 
+        # the training updates the text encoder in place, the other resident models must keep theirs
+        self.pipeline.make_text_encoder_private()
         args.text_encoder = self.pipeline.pipe.text_encoder
         args.unet         = self.pipeline.pipe.unet
         args.vae          = self.pipeline.pipe.vae
@@ -196,6 +199,10 @@ class StableDiffusionTrainUI():
         args.logging_dir  = os.path.join(args.output_dir, 'logs', name)
 
         self.main(args)
+        # the training has updated the text encoder in place, and may have updated the unet
+        from .pipeline_stable_diffusion_all_in_one import text_embedding_cache, invalidate_unet_fingerprint
+        text_embedding_cache.invalidate(self.pipeline.pipe.text_encoder)
+        invalidate_unet_fingerprint(self.pipeline.pipe.unet)
         empty_cache()
         
     def on_run_button_click(self, b):
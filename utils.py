@@ -1,15 +1,19 @@
 #pt加载功能基于群内@作者版本修改 
 import os 
 import time
+import random
 from contextlib import nullcontext, contextmanager
 from IPython.display import clear_output, display
 from pathlib import Path
 from PIL import Image
 from .png_info_helper import serialize_to_text, serialize_to_pnginfo
+from .flat_weights import FLAT_WEIGHTS_NAME, convert_pdparams_to_flat, load_flat_weights, save_flat_weights
+from .env import CACHE_DIR, compute_peak_rss
 import paddle
 
 _VAE_SIZE_THRESHOLD_ = 300000000       # vae should not be smaller than this
 _MODEL_SIZE_THRESHOLD_ = 3000000000    # model should not be smaller than this
+_UNET_FP16_SIZE_THRESHOLD_ = 2500000000 # float32 unet weights are larger than this
 
 def compute_gpu_memory():
     import pynvml
@@ -18,60 +22,392 @@ def compute_gpu_memory():
     meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
     return round(meminfo.total / 1024 / 1024 / 1024, 2)
 
+def compute_available_memory():
+    """Return the free memory in bytes of the device used for inference, or None if it is unknown."""
+    if paddle.device.get_device() != 'cpu':
+        try:
+            import pynvml
+            pynvml.nvmlInit()
+            handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+            return pynvml.nvmlDeviceGetMemoryInfo(handle).free
+        except Exception:
+            return None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def estimate_image_memory(width, height, fp16 = False, do_classifier_free_guidance = True):
+    """Roughly estimate the activation memory in bytes the UNet needs for one image of size (width, height)."""
+    tokens = (width // 8) * (height // 8)
+    bytes_per_element = 2 if fp16 else 4
+    # the self-attention map of the outermost UNet blocks dominates and grows quadratically
+    attention = tokens * tokens * 8 * bytes_per_element
+    # the other activations grow linearly with the number of latent pixels
+    activations = tokens * 320 * 64 * bytes_per_element
+    per_sample = attention + activations
+    return per_sample * (2 if do_classifier_free_guidance else 1)
+
+def compute_batch_size(width, height, num_images, fp16 = False, do_classifier_free_guidance = True, max_batch_size = 8):
+    """Choose how many images to generate in one forward pass so that they fit in the available memory."""
+    available = compute_available_memory()
+    if available is None:
+        return 1
+    # keep some headroom for the VAE decoder and memory fragmentation
+    per_image = estimate_image_memory(width, height, fp16, do_classifier_free_guidance)
+    batch_size = int(available * 0.7 // per_image)
+    return max(1, min(batch_size, max_batch_size, num_images))
+
 def empty_cache():
     """Empty CUDA cache. Essential in stable diffusion pipeline."""
     import gc
     gc.collect()
 
+class ModelCatalog():
+    """
+    Persistent index of the local models and model files, so that the model stores are not walked again every time.
+
+    The listing of a directory is cached with its mtime, so only the directories which changed are listed again, and
+    the metadata of a model (size, dtype, weight files) with the mtime of the model directory and the size and mtime of
+    each weight file. The hashes of the files are cached with their own size and mtime too, as a file replaced in place
+    does not change the mtime of its directory.
+    Incomplete models are checked again until they are complete.
+    """
+    WEIGHT_NAMES = ('model_state.pdparams', FLAT_WEIGHTS_NAME)
+
+    def __init__(self, path = None):
+        self.path = path or os.path.join(CACHE_DIR, 'model_catalog.json')
+        self.dirs = {}
+        self.models = {}
+        # path -> {'size', 'mtime', 'hash'}
+        self.files = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            import json
+            try:
+                with open(self.path, 'r', encoding = 'utf-8') as f:
+                    data = json.load(f)
+                self.dirs = data.get('dirs', {})
+                self.models = data.get('models', {})
+                self.files = data.get('files', {})
+            except (OSError, ValueError):
+                pass
+
+    def save(self):
+        if not self.dirty: return
+        import json
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding = 'utf-8') as f:
+                json.dump({'dirs': self.dirs, 'models': self.models, 'files': self.files}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError:
+            pass
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def list_dir(self, path):
+        """Return {name: is_dir} for the entries of `path`."""
+        path = os.path.abspath(path)
+        mtime = self._mtime(path)
+        if mtime is None: return {}
+        entry = self.dirs.get(path)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry['entries']
+        entries = {}
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        entries[e.name] = e.is_dir()
+                    except OSError:
+                        pass
+        except OSError:
+            return {}
+        self.dirs[path] = {'mtime': mtime, 'entries': entries}
+        self.dirty = True
+        return entries
+
+    def walk(self, base_path):
+        """Same as os.walk, from the cached listings."""
+        entries = self.list_dir(base_path)
+        dirs = [name for name, is_dir in entries.items() if is_dir]
+        files = [name for name, is_dir in entries.items() if not is_dir]
+        yield base_path, dirs, files
+        for name in dirs:
+            yield from self.walk(os.path.join(base_path, name))
+
+    def _weight_stats(self, path):
+        """Return {'component/weight name': [size, mtime]} for the weight files of the model in `path`."""
+        stats = {}
+        for name in ('unet', 'vae', 'text_encoder'):
+            for weight_name in self.WEIGHT_NAMES:
+                try:
+                    stat = os.stat(os.path.join(path, name, weight_name))
+                except OSError:
+                    continue
+                stats[f'{name}/{weight_name}'] = [stat.st_size, stat.st_mtime]
+        return stats
+
+    def _probe_model(self, path, weight_stats):
+        entries = self.list_dir(path)
+        if not entries.get('vae', False) or not entries.get('unet', False) or 'model_index.json' not in entries:
+            return None
+        if not os.path.isfile(os.path.join(path, 'vae', 'config.json')):
+            return None
+        components = {}
+        for name in ('unet', 'vae', 'text_encoder'):
+            for weight_name in self.WEIGHT_NAMES:
+                stat = weight_stats.get(f'{name}/{weight_name}')
+                if stat is None:
+                    continue
+                components[name] = {'file': weight_name, 'size': stat[0], 'mtime': stat[1]}
+                break
+        if 'unet' not in components:
+            return None
+        unet = components['unet']
+        if unet['file'] == FLAT_WEIGHTS_NAME:
+            header = load_flat_weights(os.path.join(path, 'unet', unet['file'])).header
+            dtype = next((info['dtype'] for info in header.values() if info['dtype'] in ('float32', 'float16', 'bfloat16')), 'float32')
+        else:
+            # the pickle would have to be loaded, the size tells the precision
+            dtype = 'float16' if unet['size'] < _UNET_FP16_SIZE_THRESHOLD_ else 'float32'
+        return {
+            'size': sum(component['size'] for component in components.values()),
+            'dtype': dtype,
+            'components': components,
+        }
+
+    def _is_complete(self, info, check_vae_size = _VAE_SIZE_THRESHOLD_):
+        vae = info['components'].get('vae')
+        if vae is None: return False
+        return vae['size'] > (check_vae_size // 2 if vae['file'] == FLAT_WEIGHTS_NAME else check_vae_size)
+
+    def get_model(self, path, with_hashes = False):
+        """Return the metadata of the model in `path`, or None if it is not a model."""
+        path = os.path.abspath(path)
+        mtime = self._mtime(path)
+        if mtime is None: return None
+        # a weight file replaced or added changes the mtime of its component directory, not of the model directory
+        weight_stats = self._weight_stats(path)
+        entry = self.models.get(path)
+        if entry is None or entry['mtime'] != mtime or entry.get('weights') != weight_stats \
+                or entry['info'] is None and 'model_index.json' in self.list_dir(path) \
+                or entry['info'] is not None and not self._is_complete(entry['info']):
+            entry = {'mtime': mtime, 'weights': weight_stats, 'info': self._probe_model(path, weight_stats)}
+            self.models[path] = entry
+            self.dirty = True
+        info = entry['info']
+        if info is not None and with_hashes:
+            for name, component in info['components'].items():
+                component['hash'] = self.get_file_hash(os.path.join(path, name, component['file']))
+        return info
+
+    def get_file_hash(self, path):
+        """Return the hash of the content of a file, computed again only when its size or mtime changed, or None."""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = self.files.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': compute_file_hash(path)}
+            self.files[path] = entry
+            self.dirty = True
+        return entry['hash']
+
+    def is_complete(self, path, check_vae_size = _VAE_SIZE_THRESHOLD_):
+        info = self.get_model(path)
+        return info is not None and self._is_complete(info, check_vae_size)
+
+def compute_file_hash(path, chunk_size = 16 * 1024 * 1024):
+    """SHA-1 of the whole content of a file, read by chunks."""
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+model_catalog = ModelCatalog()
+
 def check_is_model_complete(path = None, check_vae_size=_VAE_SIZE_THRESHOLD_):
     """Auto check whether a model is complete by checking the size of vae > check_vae_size.
-    The vae of the model should be named by model_state.pdparams."""
+    The vae of the model should be named by model_state.pdparams, or model_state.flat in half precision."""
     path = path or os.path.join('./',os.path.basename(model_get_default())).rstrip('.zip')
+    if os.path.exists(os.path.join(path, 'vae', FLAT_WEIGHTS_NAME)):
+        return os.path.getsize(os.path.join(path, 'vae', FLAT_WEIGHTS_NAME)) > check_vae_size // 2
     return os.path.exists(os.path.join(path,'vae/model_state.pdparams')) and\
          os.path.getsize(os.path.join(path,'vae/model_state.pdparams')) > check_vae_size
 
 def model_get_default(base_path = '/home/aistudio/data'):
     """Return an absolute path of model zip file in the `base_path`."""
     available_models = []
-    for folder in os.walk(base_path):
+    for folder in model_catalog.walk(base_path):
         for filename_ in folder[2]:
             filename = os.path.join(folder[0], filename_)
             if filename.endswith('.zip') and os.path.isfile(filename) and os.path.getsize(filename) > _MODEL_SIZE_THRESHOLD_:
                 available_models.append((os.path.getsize(filename), filename, filename_))
+    model_catalog.save()
     available_models.sort()
     # use the model with smallest size to save computation
     return available_models[0][1]
 
 def model_vae_get_default(base_path = 'data'):
     """Return an absolute path of extra vae if there is any."""
-    for folder in os.walk(base_path):
+    for folder in model_catalog.walk(base_path):
         for filename_ in folder[2]:
             filename = os.path.join(folder[0], filename_)
-            if filename.endswith('vae.pdparams'):
+            if filename.endswith('vae.pdparams') and os.path.isfile(filename):
+                model_catalog.save()
                 return filename
+    model_catalog.save()
     return None
 
-def model_unzip(abs_path = None, name = None, dest_path = './', verbose = True):
-    """Unzip a model from `abs_path`, `name` is the model name after unzipping."""
+def _file_crc32(path, chunk_size = 16 * 1024 * 1024):
+    import zlib
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _member_path(dest_path, member_name):
+    """Where `member_name` is extracted, None if it would escape `dest_path`."""
+    parts = [part for part in member_name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or os.path.isabs(member_name) or ':' in parts[0]:
+        return None
+    return os.path.join(dest_path, *parts)
+
+def unzip_resumable(abs_path, dest_path = './', manifest_path = None, num_workers = 4, verbose = True,
+        flush_every = 64, flush_interval = 5.0):
+    """
+    Extract the zip file `abs_path` into `dest_path`, only the members which are missing or corrupt.
+
+    Members are extracted by `num_workers` threads and checked against the CRC of the zip file. The extracted members
+    are recorded in a manifest (with the size and the mtime of the extracted file), so that an interrupted extraction
+    is resumed where it stopped. The manifest is written every `flush_every` members or `flush_interval` seconds,
+    and at the end. Return the number of members which were extracted.
+    """
+    import json
+    import threading
+    from zipfile import ZipFile
+    from concurrent.futures import ThreadPoolExecutor
+
+    manifest_path = manifest_path or os.path.join(dest_path, '.' + os.path.basename(abs_path) + '.manifest.json')
+    zip_stat = os.stat(abs_path)
+    zip_key = f'{os.path.abspath(abs_path)}:{zip_stat.st_size}:{zip_stat.st_mtime}'
+    manifest = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding = 'utf-8') as f:
+                data = json.load(f)
+            if data.get('zip') == zip_key:
+                manifest = data.get('members', {})
+        except (OSError, ValueError):
+            pass
+
+    with ZipFile(abs_path, 'r') as f:
+        members = [info for info in f.infolist() if not info.is_dir()]
+
+    lock = threading.Lock()
+    flush_state = {'pending': 0, 'time': time.monotonic()}
+    def save_manifest():
+        tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump({'zip': zip_key, 'members': manifest}, f)
+        os.replace(tmp_path, manifest_path)
+        flush_state['pending'] = 0
+        flush_state['time'] = time.monotonic()
+
+    def record(info, path):
+        stat = os.stat(path)
+        with lock:
+            manifest[info.filename] = [info.CRC, stat.st_size, stat.st_mtime]
+            flush_state['pending'] += 1
+            # a member missing from the manifest is only checked again, so the manifest can lag behind
+            if flush_state['pending'] >= flush_every or time.monotonic() - flush_state['time'] >= flush_interval:
+                save_manifest()
+
+    def is_intact(info, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != info.file_size:
+            return False
+        if manifest.get(info.filename) == [info.CRC, stat.st_size, stat.st_mtime]:
+            return True
+        # extracted without a manifest, or modified since
+        if _file_crc32(path) == info.CRC:
+            record(info, path)
+            return True
+        return False
+
+    local = threading.local()
+    def extract(info):
+        path = _member_path(dest_path, info.filename)
+        if path is None or is_intact(info, path):
+            return False
+        if not hasattr(local, 'zip_file'):
+            # one handle per thread, so that the members are read concurrently
+            local.zip_file = ZipFile(abs_path, 'r')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        tmp_path = f'{path}.{threading.get_ident()}.part'
+        try:
+            # the CRC is checked by zipfile when the member is read to the end
+            with local.zip_file.open(info, 'r') as src, open(tmp_path, 'wb') as dst:
+                for chunk in iter(lambda: src.read(16 * 1024 * 1024), b''):
+                    dst.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        record(info, path)
+        return True
+
+    os.makedirs(dest_path, exist_ok = True)
+    with ThreadPoolExecutor(max_workers = max(1, num_workers)) as executor:
+        extracted = sum(executor.map(extract, members))
+    with lock:
+        save_manifest()
+    if verbose and extracted: print(f'已解压 {extracted}/{len(members)} 个文件')
+    return extracted
+
+def model_unzip(abs_path = None, name = None, dest_path = './', verbose = True, num_workers = 4):
+    """Unzip a model from `abs_path`, `name` is the model name after unzipping.
+    Only the missing or corrupt files are extracted again, see `unzip_resumable`."""
     if abs_path is None:
         abs_path = model_get_default()
     if name is None:
         name = os.path.basename(abs_path)
 
-    from zipfile import ZipFile
+    from zipfile import BadZipFile
     dest = os.path.join(dest_path, name).rstrip('.zip')
-    if not check_is_model_complete(dest):
-        if os.path.exists(dest):
-            # clear the incomplete zipfile
-            if verbose: print('检测到模型文件破损, 正在删除......')
-            import shutil
-            shutil.rmtree(dest)
-        
-        if verbose: print('正在解压模型......')
-        with ZipFile(abs_path, 'r') as f:
-            f.extractall(dest_path)
-    else:
+    if verbose: print('正在检查模型......')
+    try:
+        extracted = unzip_resumable(abs_path, dest_path, num_workers = num_workers, verbose = verbose)
+    except BadZipFile as e:
+        print(f'模型压缩包损坏: {e}')
+        raise
+    if not extracted:
         print('模型已存在')
+    elif not check_is_model_complete(dest):
+        print('解压完成, 但未检测到完整的模型, 请检查压缩包')
 
 def package_install(verbose = True):
     try:
@@ -91,12 +427,11 @@ def diffusers_auto_update(verbose = True):
     package_install(verbose=verbose)
 
 def try_get_catched_model(model_name):
-    path = os.path.join('./models/', model_name)
-    if check_is_model_complete(path):
-        return path
-    path = os.path.join('./', model_name)
-    if check_is_model_complete(path):
-        return path
+    for path in (os.path.join('./models/', model_name), os.path.join('./', model_name)):
+        if model_catalog.is_complete(path):
+            model_catalog.save()
+            return path
+    model_catalog.save()
     return model_name
     
 @contextmanager
@@ -151,49 +486,274 @@ def ReadImage(image, height = None, width = None):
         image = image.resize((width, height), Image.ANTIALIAS)
     return image
     
+def read_pt_embedding(path):
+    """Return the name and the float32 vectors (n, dim) of a textual inversion .pt embedding."""
+    import numpy as np
+    from .torch_loader import load_torch
+    data = load_torch(str(path))
+    if not isinstance(data, dict):
+        raise ValueError(f'{path} is not an embedding file')
+    name = data.get('name')
+    if 'string_to_param' in data:
+        # webui embedding: {'string_to_param': {'*': tensor}, 'name': ...}
+        vectors = next(iter(data['string_to_param'].values()))
+    elif 'emb_params' in data:
+        vectors = data['emb_params']
+    elif len(data) == 1:
+        # {token: tensor}
+        name, vectors = next(iter(data.items()))
+    else:
+        raise ValueError(f'{path} is not an embedding file')
+    if not isinstance(name, str) or not name:
+        name = Path(path).stem
+    vectors = np.asarray(vectors, dtype = np.float32)
+    return name, vectors.reshape((-1, vectors.shape[-1]))
+
 def convert_pt_to_pdparams(path, dim = 768, save = True):
-    """Unsafe .pt embedding to .pdparams."""
+    """.pt embedding to .pdparams."""
     path = str(path)
     assert path.endswith('.pt'), 'Only support conversion of .pt files.'
 
-    import struct
-    with open(path, 'rb') as f:
-        data = f.read()
-    data = ''.join(chr(i) for i in data)
-
-    # locate the tensor in the file
-    tensors = []
-    for chunk in data.split('ZZZZ'):
-        chunk = chunk.strip('Z').split('PK')
-        if len(chunk) == 0:
-            continue
-
-        tensor = ''
-        for i in range(len(chunk)):
-            # extract the string with length 768 * (4k)
-            tensor += 'PK' + chunk[i]
-            if len(tensor) > 2 and len(tensor) % (dim * 4) == 2:
-                # remove the leading 'PK'
-                tensors.append(tensor[2:])
-
-    tensor = max(tensors, key = lambda x: len(x))
-
-    # convert back to binary representation
-    tensor = tensor.encode('latin')
-
-    # every four chars represent a float32
-    tensor = [struct.unpack('f', tensor[i:i+4])[0] for i in range(0, len(tensor), 4)]
-    tensor = paddle.to_tensor(tensor).reshape((-1, dim))
+    name, vectors = read_pt_embedding(path)
+    if vectors.shape[-1] != dim:
+        raise ValueError(f'{path} 的维度为 {vectors.shape[-1]}, 与模型的 {dim} 不符')
+    tensor = paddle.to_tensor(vectors)
     if tensor.shape[0] == 1:
         tensor = tensor.flatten()
 
     if save:
-        # locate the name of embedding
-        name = ''.join(filter(lambda x: ord(x) > 20, data.split('nameq\x12X')[1].split('q\x13X')[0]))
         paddle.save({name: tensor}, path[:-3] + '.pdparams')
 
     return tensor
 
+def convert_pt_dir_to_pdparams(path, dim = 768, verbose = True):
+    """
+    Convert the .pt embeddings of the directory `path` to .pdparams, in a single pass.
+
+    The files already converted, or which failed to convert, are skipped until they are modified, according to a
+    cache of their size and mtime. Return the paths of the converted files.
+    """
+    import json
+    cache_path = os.path.join(CACHE_DIR, 'pt_embeddings.json')
+    try:
+        with open(cache_path, 'r', encoding = 'utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    converted = []
+    updated = False
+    for pt_file in sorted(Path(path).glob('*.pt')):
+        pt_file = os.path.abspath(pt_file)
+        pdparams_file = pt_file[:-3] + '.pdparams'
+        stat = os.stat(pt_file)
+        key = [stat.st_size, stat.st_mtime, dim]
+        entry = cache.get(pt_file)
+        if entry is not None and entry['key'] == key and (not entry['ok'] or os.path.exists(pdparams_file)):
+            continue
+        try:
+            convert_pt_to_pdparams(pt_file, dim = dim, save = True)
+            converted.append(pdparams_file)
+            cache[pt_file] = {'key': key, 'ok': True}
+        except Exception as e:
+            if verbose: print(f'[导入训练文件] 无法转换 {os.path.basename(pt_file)}: {e}')
+            cache[pt_file] = {'key': key, 'ok': False}
+        updated = True
+
+    if updated:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok = True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding = 'utf-8') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return converted
+
+_WEIGHTS_CACHE_DIR_ = os.path.join(CACHE_DIR, 'weights')
+
+def has_flat_weights(model_path):
+    return os.path.isfile(os.path.join(model_path, 'unet', FLAT_WEIGHTS_NAME))
+
+def get_flat_weights_cache_path(path):
+    """The path of the flat copy of the model_state.pdparams `path` in the weights cache, which may not exist yet."""
+    import hashlib
+    stat = os.stat(path)
+    key = hashlib.sha1(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime}'.encode()).hexdigest()[:32]
+    name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return os.path.join(_WEIGHTS_CACHE_DIR_, f'{name}-{key}.flat')
+
+_STALE_TMP_SECONDS_ = 60 * 60
+
+def evict_flat_weights_cache(max_cache_bytes, keep = ()):
+    """Remove the temporary files left by the copies which were interrupted (e.g. by the exit of the process while
+    writing in the background), then the least recently used flat copies until the cache holds at most
+    `max_cache_bytes`, except `keep`.
+    A copy memory mapped by another process stays readable by it until it is unmapped (on Windows it can't be removed)."""
+    if not os.path.isdir(_WEIGHTS_CACHE_DIR_):
+        return
+    now = time.time()
+    for entry in os.scandir(_WEIGHTS_CACHE_DIR_):
+        # the temporary files being written are modified all the time
+        if entry.is_file() and entry.name.endswith('.tmp'):
+            try:
+                if now - entry.stat().st_mtime > _STALE_TMP_SECONDS_:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+    if max_cache_bytes is None:
+        return
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    for entry in os.scandir(_WEIGHTS_CACHE_DIR_):
+        if entry.is_file() and entry.name.endswith('.flat'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, os.path.abspath(entry.path)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def get_cached_flat_weights(path):
+    """Return a flat float32 copy of the model_state.pdparams `path`, written on first use.
+    Unlike the pickle, it is memory mapped, so the page cache is shared by the processes loading the model."""
+    cache_path = get_flat_weights_cache_path(path)
+    if os.path.exists(cache_path):
+        # the modification time orders the copies by last use for the eviction
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+    else:
+        os.makedirs(_WEIGHTS_CACHE_DIR_, exist_ok = True)
+        # written atomically, several workers may load the model at once
+        import threading
+        tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            try:
+                # one tensor in memory at a time, rather than a second float32 copy of the model
+                convert_pdparams_to_flat(path, tmp_path, dtype = 'float32')
+            except ValueError:
+                import numpy as np
+                state_dict = paddle.load(path, return_numpy = True)
+                state_dict = {k: v for k, v in state_dict.items() if isinstance(v, np.ndarray)}
+                save_flat_weights(state_dict, tmp_path, dtype = 'float32')
+                del state_dict
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return cache_path
+
+_FLAT_COMPONENTS_ = ('unet', 'vae', 'text_encoder')
+
+def has_cached_flat_weights(model_path):
+    """Whether every component of `model_path` has flat weights, shipped with the model or in the weights cache."""
+    for name in _FLAT_COMPONENTS_:
+        if os.path.isfile(os.path.join(model_path, name, FLAT_WEIGHTS_NAME)):
+            continue
+        pdparams_path = os.path.join(model_path, name, 'model_state.pdparams')
+        if not os.path.isfile(pdparams_path) or not os.path.exists(get_flat_weights_cache_path(pdparams_path)):
+            return False
+    return True
+
+def cache_flat_weights(model_path, max_cache_bytes = None, background = True):
+    """Write the flat copies of the components of `model_path` missing from the weights cache, one at a time.
+    In the background by default, so that the first load of a model is not slowed down by it."""
+    def task():
+        paths = []
+        for name in _FLAT_COMPONENTS_:
+            pdparams_path = os.path.join(model_path, name, 'model_state.pdparams')
+            if os.path.isfile(pdparams_path) and not os.path.isfile(os.path.join(model_path, name, FLAT_WEIGHTS_NAME)):
+                try:
+                    paths.append(get_cached_flat_weights(pdparams_path))
+                except Exception as e:
+                    print(f'!!!!!无法缓存 {pdparams_path} ({e})')
+                    return
+        # evicted at the end, not to remove the copies of the other components of this model
+        evict_flat_weights_cache(max_cache_bytes, keep = paths)
+
+    if not background:
+        return task()
+    import threading
+    thread = threading.Thread(target = task, name = 'cache_flat_weights', daemon = True)
+    thread.start()
+    return thread
+
+def assign_weights(model, state_dict):
+    """Copy the weights into the parameters one at a time, converting each of them to the parameter dtype."""
+    missing_keys = []
+    for key, param in model.state_dict().items():
+        if key not in state_dict:
+            missing_keys.append(key)
+            continue
+        array = state_dict[key]
+        dtype = str(param.dtype).split('.')[-1]
+        if str(array.dtype) != dtype:
+            array = array.astype(dtype)
+        param.set_value(array)
+    if len(missing_keys):
+        print(f"{model.__class__.__name__} 缺少权重: {', '.join(missing_keys)}")
+
+def load_flat_component(model_path, name, weights_path = None):
+    """Build a unet, vae or text_encoder from its config and its memory mapped flat weights."""
+    path = os.path.join(model_path, name)
+    if name == 'text_encoder':
+        import json
+        from paddlenlp.transformers import CLIPTextModel
+        with open(os.path.join(path, 'model_config.json'), 'r', encoding = 'utf-8') as f:
+            config = json.load(f)
+        config.pop('init_class', None)
+        config.pop('init_args', None)
+        model = CLIPTextModel(**config)
+    else:
+        from ppdiffusers import AutoencoderKL, UNet2DConditionModel
+        model_class = UNet2DConditionModel if name == 'unet' else AutoencoderKL
+        model = model_class.from_config(model_class.load_config(path))
+    assign_weights(model, load_flat_weights(weights_path or os.path.join(path, FLAT_WEIGHTS_NAME)))
+    model.eval()
+    return model
+
+def load_flat_pipeline(model_path, pipeline_class, verbose = True, max_cache_bytes = None):
+    """Load a pipeline from memory mapped weights: the model_state.flat written by `convert.py --output_format flat`,
+    or else flat copies of the model_state.pdparams cached on first use."""
+    import json
+    import ppdiffusers
+    from paddlenlp.transformers import CLIPTokenizer
+    with open(os.path.join(model_path, 'model_index.json'), 'r', encoding = 'utf-8') as f:
+        scheduler_class = getattr(ppdiffusers, json.load(f)['scheduler'][1])
+
+    components = {}
+    cache_paths = []
+    for name in _FLAT_COMPONENTS_:
+        tic = time.perf_counter()
+        weights_path = os.path.join(model_path, name, FLAT_WEIGHTS_NAME)
+        if not os.path.isfile(weights_path):
+            weights_path = get_cached_flat_weights(os.path.join(model_path, name, 'model_state.pdparams'))
+            cache_paths.append(weights_path)
+        components[name] = load_flat_component(model_path, name, weights_path)
+        if verbose: print(f'{name} 加载用时 {time.perf_counter() - tic:.2f}s')
+    evict_flat_weights_cache(max_cache_bytes, keep = cache_paths)
+    peak_rss = compute_peak_rss()
+    if verbose and peak_rss is not None: print(f'加载模型的内存峰值为 {peak_rss / 1024 ** 3:.2f} GB')
+
+    return pipeline_class(
+        tokenizer = CLIPTokenizer.from_pretrained(os.path.join(model_path, 'tokenizer')),
+        scheduler = scheduler_class.from_pretrained(model_path, subfolder = 'scheduler'),
+        safety_checker = None,
+        feature_extractor = None,
+        requires_safety_checker = False,
+        **components,
+    )
+
 def get_multiple_tokens(token, num = 1, ret_list = True):
     """Parse a single token to multiple tokens."""
     tokens = ['%s_EMB_TOKEN_%d'%(token, i) for i in range(num)]
@@ -212,58 +772,406 @@ def collect_local_module_names(base_paths = None):
         else (base_paths,) if isinstance(base_paths, str) \
         else base_paths
     
-    is_model = lambda base, name: (os.path.isfile(
-            os.path.join(base, name,'model_index.json')
-        )) and (os.path.isfile(
-            os.path.join(base, name,'vae', 'config.json')
-        )) and (os.path.isfile(
-            os.path.join(base, name,'unet', 'model_state.pdparams')
-        ))
+    is_model = lambda base, name: model_catalog.get_model(os.path.join(base, name)) is not None
         
     models = []
     for base_path in base_paths:
-        if not os.path.isdir(base_path): continue
-        for name in os.listdir(base_path):
+        entries = model_catalog.list_dir(base_path)
+        for name, is_dir in entries.items():
             if name.startswith('.'): continue
             
             path = os.path.join(base_path, name)
             
             if path in base_paths: continue
-            if not os.path.isdir(path): continue
+            if not is_dir: continue
             
             if is_model(base_path, name):
                 models.append(name)
                 continue
             
-            for name2 in os.listdir(path):
-                if name.startswith('.'): continue
-                path2 = os.path.join(path, name2)
-                if os.path.isdir(path2) and is_model(path, name2):
+            for name2, is_dir2 in model_catalog.list_dir(path).items():
+                if name2.startswith('.'): continue
+                if is_dir2 and is_model(path, name2):
                     models.append(f'{name}/{name2}')
                     continue
     
+    model_catalog.save()
     sorted(models)
     return models
 
+
+def _layer_nbytes(layer):
+    import numpy as np
+    return sum(int(np.prod(p.shape)) * (2 if p.dtype in (paddle.float16, paddle.bfloat16) else 4) for p in layer.parameters())
+
+def get_model_dir(model_name):
+    """Return the local directory of a model given by its path or by the name it was downloaded under, or None."""
+    if os.path.isdir(model_name):
+        return model_name
+    from ppdiffusers.utils import PPDIFFUSERS_CACHE
+    path = os.path.join(PPDIFFUSERS_CACHE, model_name)
+    return path if os.path.isdir(path) else None
+
+def _component_fingerprint(model_dir, name):
+    """Hash of the weight file of a component of a local model, or of the files of its tokenizer, None if missing."""
+    if name == 'tokenizer':
+        import hashlib
+        folder = os.path.join(model_dir, name)
+        filenames = sorted(filename for filename, is_dir in model_catalog.list_dir(folder).items() if not is_dir)
+        if not filenames: return None
+        h = hashlib.sha1()
+        for filename in filenames:
+            h.update(f'{filename}:{model_catalog.get_file_hash(os.path.join(folder, filename))}'.encode())
+        return h.hexdigest()
+    info = model_catalog.get_model(model_dir)
+    component = None if info is None else info['components'].get(name)
+    if component is None: return None
+    return model_catalog.get_file_hash(os.path.join(model_dir, name, component['file']))
+
+class ModelResidencyManager():
+    """
+    Keep the least recently used pipelines in memory, so that switching back to a model does not reload it from disk.
+
+    At most `max_models` pipelines are kept, and their weights should not exceed `max_bytes` (half of the memory
+    available when the manager is created by default). The VAE and the tokenizer / text encoder pair are shared
+    between the pipelines when they are loaded from identical files, as is often the case for fine-tuned models. A
+    pipeline must get its own copy with `make_private` before modifying a shared component in place.
+    """
+    # components shared together, the text encoder is only valid with its own tokenizer
+    SHAREABLE_COMPONENTS = (('vae',), ('tokenizer', 'text_encoder'))
+
+    def __init__(self, max_models = 2, max_bytes = None):
+        from collections import OrderedDict
+        import weakref
+        self.max_models = max(1, max_models)
+        if max_bytes is None:
+            available = compute_available_memory()
+            max_bytes = None if available is None else available // 2
+        self.max_bytes = max_bytes
+        # model name -> (pipe, schedulers)
+        self.models = OrderedDict()
+        # (component name, fingerprint) -> component, alive as long as a pipeline uses it
+        self.shared_components = weakref.WeakValueDictionary()
+
+    def get(self, model_name):
+        resident = self.models.get(model_name)
+        if resident is not None:
+            self.models.move_to_end(model_name)
+        return resident
+
+    def add(self, model_name, pipe, schedulers):
+        # nothing to share with when a single model is kept
+        if self.max_models > 1:
+            model_dir = get_model_dir(model_name)
+            if model_dir is not None:
+                self.share_components(pipe, model_dir)
+            model_catalog.save()
+        self.models[model_name] = (pipe, schedulers)
+        self.models.move_to_end(model_name)
+        while len(self.models) > self.max_models:
+            self.evict()
+
+    def remove(self, model_name):
+        if self.models.pop(model_name, None) is not None:
+            empty_cache()
+
+    def share_components(self, pipe, model_dir):
+        """Replace the components of `pipe` by those of the resident pipelines loaded from the same files."""
+        for names in self.SHAREABLE_COMPONENTS:
+            components = [getattr(pipe, name, None) for name in names]
+            if any(component is None for component in components):
+                continue
+            fingerprints = [_component_fingerprint(model_dir, name) for name in names]
+            if any(fingerprint is None for fingerprint in fingerprints):
+                continue
+            fingerprint = '-'.join(fingerprints)
+            shared = [self.shared_components.get((name, fingerprint)) for name in names]
+            if all(component is not None for component in shared):
+                pipe.register_modules(**dict(zip(names, shared)))
+            else:
+                for name, component in zip(names, components):
+                    self.shared_components[(name, fingerprint)] = component
+
+    def make_private(self, pipe, names):
+        """
+        Give `pipe` its own copy of the components `names` if another resident pipeline uses them, before they are
+        modified in place. They are not shared with the pipelines loaded afterwards either, as they differ from their
+        files. Return whether they were copied.
+        """
+        import copy
+        components = [getattr(pipe, name) for name in names]
+        if any(getattr(other, name, None) is component
+               for other, _ in self.models.values() if other is not pipe
+               for name, component in zip(names, components)):
+            # the copies are never shared, the others keep the components as loaded
+            pipe.register_modules(**{name: copy.deepcopy(component) for name, component in zip(names, components)})
+            return True
+        for key, component in list(self.shared_components.items()):
+            if any(component is c for c in components):
+                del self.shared_components[key]
+        return False
+
+    def nbytes(self):
+        """Size of the weights of the resident pipelines, counting the shared components once."""
+        seen = set()
+        total = 0
+        for pipe, _ in self.models.values():
+            for name in ('unet', 'vae', 'text_encoder'):
+                layer = getattr(pipe, name, None)
+                if layer is None or id(layer) in seen:
+                    continue
+                seen.add(id(layer))
+                total += _layer_nbytes(layer)
+        return total
+
+    def evict(self):
+        model_name, _ = self.models.popitem(last = False)
+        print(f'模型 {model_name} 长时间未使用, 已从内存中移除')
+        empty_cache()
+
+    def make_room(self):
+        """Evict pipelines before loading a new one, assuming it is as large as the resident ones on average."""
+        while len(self.models) >= self.max_models:
+            self.evict()
+        if self.max_bytes is not None:
+            while len(self.models) > 0 and self.nbytes() * (len(self.models) + 1) / len(self.models) > self.max_bytes:
+                self.evict()
+
+# sampler name -> (scheduler class name, extra arguments of from_config)
+_SCHEDULER_SPECS = {
+    'DPMSolver': ('DPMSolverMultistepScheduler', dict(
+        thresholding = False,
+        algorithm_type = "dpmsolver++",
+        solver_type = "midpoint",
+        lower_order_final = True,
+    )),
+    'EulerDiscrete': ('EulerDiscreteScheduler', {}),
+    'EulerAncestralDiscrete': ('EulerAncestralDiscreteScheduler', {}),
+    'PNDM': ('PNDMScheduler', {}),
+    'DDIM': ('DDIMScheduler', dict(clip_sample = False)),
+    'LMSDiscrete': ('LMSDiscreteScheduler', {}),
+    'HeunDiscrete': ('HeunDiscreteScheduler', {}),
+    'KDPM2AncestralDiscrete': ('KDPM2AncestralDiscreteScheduler', {}),
+    'KDPM2Discrete': ('KDPM2DiscreteScheduler', {}),
+}
+
+class SchedulerRegistry():
+    """
+    Samplers of one model, built on first use from the scheduler config already loaded with the pipeline.
+
+    Schedulers only depend on their config, so the instances are shared by every model whose
+    scheduler config (beta schedule, number of train timesteps, ...) is identical.
+    """
+    # (sampler name, config key) -> scheduler, shared by all the registries
+    _shared_schedulers = {}
+    # sampler name -> seconds spent in from_config
+    construction_times = {}
+
+    def __init__(self, default_scheduler, config = None, verbose = True):
+        self.default_scheduler = default_scheduler
+        self.config = dict(default_scheduler.config if config is None else config)
+        self.config_key = self.make_config_key(self.config)
+        self.verbose = verbose
+
+    @staticmethod
+    def make_config_key(config):
+        import json
+        # private entries such as _class_name or _diffusers_version do not change the schedule
+        return json.dumps({k: v for k, v in config.items() if not k.startswith('_')}, sort_keys = True, default = str)
+
+    def __getitem__(self, name):
+        if name == 'default':
+            return self.default_scheduler
+        if name not in _SCHEDULER_SPECS:
+            raise KeyError(name)
+
+        key = (name, self.config_key)
+        scheduler = self._shared_schedulers.get(key)
+        if scheduler is None:
+            import ppdiffusers
+            class_name, kwargs = _SCHEDULER_SPECS[name]
+            tic = time.perf_counter()
+            scheduler = getattr(ppdiffusers, class_name).from_config(self.config, **kwargs)
+            self.construction_times[name] = time.perf_counter() - tic
+            self._shared_schedulers[key] = scheduler
+            if self.verbose: print(f'采样器 {name} 初始化完毕, 用时 {self.construction_times[name] * 1000:.1f}ms')
+        return scheduler
+
+    def __contains__(self, name):
+        return name == 'default' or name in _SCHEDULER_SPECS
+
+    def keys(self):
+        return ['default'] + list(_SCHEDULER_SPECS)
+
+class ConceptRegistry():
+    """
+    Concepts (textual inversion embeddings) loaded into the text encoders, so that a concept library is only loaded
+    again when its files change.
+
+    The files are tracked by size and mtime for every text encoder. The tokens of the changed files are added to the
+    tokenizer at once, the embedding matrix is resized a single time and the vectors are written with one scatter.
+    """
+
+    def __init__(self):
+        import weakref
+        # text encoder -> {'signature', 'files': {path: (size, mtime)}, 'tokens': {path: [(token, tokens)]}}
+        self.states = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def list_files(library_dir):
+        """Return the .pdparams concepts of `library_dir`, which can also be a single .pdparams file."""
+        if library_dir.endswith('.pdparams') and os.path.isfile(library_dir):
+            return [library_dir]
+        if not os.path.isdir(library_dir):
+            return []
+        return sorted(os.path.join(library_dir, name) for name in os.listdir(library_dir) if name.endswith('.pdparams'))
+
+    @staticmethod
+    def make_signature(library_dir):
+        """(name, size, mtime) of the concept files and of the .pt files to convert."""
+        if os.path.isfile(library_dir):
+            paths = [library_dir]
+        elif os.path.isdir(library_dir):
+            paths = [os.path.join(library_dir, name) for name in os.listdir(library_dir) if name.endswith(('.pdparams', '.pt'))]
+        else:
+            return ()
+        signature = []
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, stat.st_size, stat.st_mtime))
+        return tuple(signature)
+
+    def may_update(self, pipe, library_dir):
+        """Whether `load` may modify the tokenizer and the text encoder of `pipe`."""
+        state = self.states.get(pipe.text_encoder)
+        signature = self.make_signature(library_dir)
+        return len(signature) > 0 if state is None else state['signature'] != signature
+
+    def load(self, pipe, library_dir):
+        """
+        Load the concepts of `library_dir` into `pipe`, return the names of the concepts which were added or updated,
+        or None if nothing changed since the last call.
+        """
+        import numpy as np
+        state = self.states.get(pipe.text_encoder)
+        signature = self.make_signature(library_dir)
+        if state is not None and state['signature'] == signature:
+            return None
+        if state is None:
+            state = self.states[pipe.text_encoder] = {'signature': None, 'files': {}, 'tokens': {}}
+
+        dim = pipe.text_encoder.get_input_embeddings().weight.shape[1]
+        if os.path.isdir(library_dir):
+            # conversion of .pt -> .pdparams embedding
+            convert_pt_dir_to_pdparams(library_dir, dim = dim)
+            signature = self.make_signature(library_dir)
+
+        files = {}
+        for path in self.list_files(library_dir):
+            stat = os.stat(path)
+            files[path] = (stat.st_size, stat.st_mtime)
+        for path in list(state['tokens']):
+            if path not in files:
+                del state['tokens'][path]
+
+        # a file is only recorded once its vectors are written, the files of another width are skipped and tried again
+        # when the library changes
+        loaded_files = {}
+        file_tokens = {}
+        names, tokens, vectors = [], [], []
+        for path, file_key in files.items():
+            if state['files'].get(path) == file_key:
+                loaded_files[path] = file_key
+                continue
+            concepts = []
+            for name, embeds in paddle.load(path, return_numpy = True).items():
+                embeds = np.asarray(embeds, dtype = np.float32).reshape((-1, np.shape(embeds)[-1]))
+                if embeds.shape[1] != dim:
+                    print(f'[导入训练文件] {os.path.basename(path)} 的维度为 {embeds.shape[1]}, 与模型的 {dim} 不符, 跳过加载！')
+                    concepts = None
+                    break
+                concepts.append((name, embeds))
+            if concepts is None:
+                continue
+            file_tokens[path] = []
+            for name, embeds in concepts:
+                multiple_tokens = get_multiple_tokens(name, embeds.shape[0], ret_list = True)
+                file_tokens[path].append((name, ' '.join(multiple_tokens)))
+                names.append(name)
+                tokens.extend(multiple_tokens)
+                vectors.append(embeds)
+            loaded_files[path] = file_key
+        if tokens:
+            names = self._write_vectors(pipe, tokens, np.concatenate(vectors), names)
+        state['files'] = loaded_files
+        state['tokens'].update(file_tokens)
+        state['signature'] = signature
+        return names
+
+    @staticmethod
+    def _write_vectors(pipe, tokens, vectors, names):
+        """Add the tokens to the tokenizer and write their vectors, return `names` or [] if they were already loaded."""
+        tokenizer, text_encoder = pipe.tokenizer, pipe.text_encoder
+        vocab = tokenizer.get_vocab()
+        new_tokens = [token for token in tokens if token not in vocab]
+        if new_tokens:
+            tokenizer.add_tokens(new_tokens)
+            text_encoder.resize_token_embeddings(len(tokenizer))
+        weight = text_encoder.get_input_embeddings().weight
+
+        # the last file wins when a token is defined twice
+        ids = {}
+        for i, token in enumerate(tokens):
+            ids[tokenizer.convert_tokens_to_ids(token)] = i
+        index = paddle.to_tensor(list(ids), dtype = 'int64')
+        with paddle.no_grad():
+            updates = paddle.to_tensor(vectors[list(ids.values())]).astype(weight.dtype)
+            # the embeddings are already loaded, e.g. after the tokenizer was shared with another model
+            if bool(paddle.all(paddle.gather(weight, index) == updates)):
+                return []
+            weight.set_value(paddle.scatter(weight, index, updates, overwrite = True))
+        return names
+
+    def added_tokens(self, pipe):
+        """(concept, tokens) of the concepts loaded into `pipe`."""
+        state = self.states.get(pipe.text_encoder)
+        if state is None:
+            return []
+        return [token for tokens in state['tokens'].values() for token in tokens]
+
     
 class StableDiffusionFriendlyPipeline():
-    def __init__(self, model_name = "runwayml/stable-diffusion-v1-5", superres_pipeline = None):
+    def __init__(self, model_name = "runwayml/stable-diffusion-v1-5", superres_pipeline = None, max_resident_models = 2, max_resident_bytes = None, lazy_load = False, max_weights_cache_bytes = 20 * 1024 ** 3):
         self.pipe = None
+        # load local models from memory mapped copies of their weights
+        self.lazy_load = lazy_load
+        # the size limit of these copies, the least recently used ones are removed
+        self.max_weights_cache_bytes = max_weights_cache_bytes
+        # the copies being written in the background
+        self.caching_threads = {}
 
         # model
         self.model = model_name
+        # models kept in memory to switch back quickly
+        self.resident_models = ModelResidencyManager(max_resident_models, max_resident_bytes)
         # vae
         self.vae = None
 
         # schedulers
-        self.available_schedulers = {}
+        self.available_schedulers = None
 
         # super-resolution
         self.superres_pipeline = superres_pipeline
 
+        # concepts
+        self.concepts = ConceptRegistry()
         self.added_tokens = []
                 
     def from_pretrained(self, verbose = True, force = False, model_name=None):
+        switched = False
         if model_name is not None:
             if len(model_name.strip()) == 0:
                 print("!!!!!检测出模型名称为空，我们将默认使用 MoososCap/NOVEL-MODEL")
@@ -271,125 +1179,112 @@ class StableDiffusionFriendlyPipeline():
             if model_name != self.model.strip():
                 print(f"!!!!!正在切换新模型, {model_name}")
                 self.model = model_name.strip()
-                force=True
+                switched = True
 
         model = self.model
 
-        if (not force) and self.pipe is not None:
+        if (not force) and (not switched) and self.pipe is not None:
             return
 
+        if force:
+            # reload from the disk
+            self.resident_models.remove(model)
+        else:
+            resident = self.resident_models.get(model)
+            if resident is not None:
+                self.pipe, self.available_schedulers = resident
+                if verbose: print(f'模型 {model} 已在内存中, 无需重新加载')
+                return
+
+        self.pipe = None
+        self.resident_models.make_room()
+
         if verbose: print('!!!!!正在加载模型, 请耐心等待, 如果出现两行红字是正常的, 不要惊慌!!!!!')
         _ = paddle.zeros((1,)) # activate the paddle on CUDA
 
         with context_nologging():
             from .pipeline_stable_diffusion_all_in_one import StableDiffusionPipelineAllinOne
-            self.pipe = StableDiffusionPipelineAllinOne.from_pretrained(model, safety_checker = None, requires_safety_checker=False)
+            cache_weights = False
+            if has_flat_weights(model):
+                self.pipe = load_flat_pipeline(model, StableDiffusionPipelineAllinOne, verbose = verbose)
+            elif self.lazy_load and os.path.isfile(os.path.join(model, 'unet', 'model_state.pdparams')):
+                if has_cached_flat_weights(model):
+                    try:
+                        self.pipe = load_flat_pipeline(model, StableDiffusionPipelineAllinOne, verbose = verbose, max_cache_bytes = self.max_weights_cache_bytes)
+                    except Exception as e:
+                        print(f'!!!!!快速加载失败 ({e}), 将使用普通方式加载')
+                else:
+                    # writing the copies would slow down this first load
+                    cache_weights = True
+            if self.pipe is None:
+                tic = time.perf_counter()
+                self.pipe = StableDiffusionPipelineAllinOne.from_pretrained(model, safety_checker = None, requires_safety_checker=False)
+                if verbose: print(f'模型加载用时 {time.perf_counter() - tic:.2f}s')
+            thread = self.caching_threads.get(model)
+            if cache_weights and (thread is None or not thread.is_alive()):
+                if verbose: print('正在后台缓存模型权重, 下次加载将更快')
+                self.caching_threads[model] = cache_flat_weights(model, self.max_weights_cache_bytes)
 
         # update scheduler
         scheduler = self.pipe.scheduler
+        # the other samplers are built lazily from the config as shipped with the model
+        scheduler_config = dict(scheduler.config)
         if hasattr(scheduler.config, "steps_offset") and scheduler.config.steps_offset != 1:
             new_config = dict(scheduler.config)
             new_config["steps_offset"] = 1
             from ppdiffusers.configuration_utils import FrozenDict
             scheduler._internal_dict = FrozenDict(new_config)
             self.pipe.register_modules(scheduler=scheduler)
-        self.available_schedulers = {}
-        self.available_schedulers['default'] = scheduler
-        # schedulers
-        from ppdiffusers import KDPM2AncestralDiscreteScheduler, KDPM2DiscreteScheduler, PNDMScheduler, DDIMScheduler, LMSDiscreteScheduler, EulerAncestralDiscreteScheduler, EulerDiscreteScheduler, DPMSolverMultistepScheduler, HeunDiscreteScheduler
-        self.available_schedulers.update({
-            "DPMSolver": DPMSolverMultistepScheduler.from_pretrained(
-                model_name,
-                subfolder="scheduler",
-                thresholding=False,
-                algorithm_type="dpmsolver++",
-                solver_type="midpoint",
-                lower_order_final=True,
-            ),
-            "EulerDiscrete": EulerDiscreteScheduler.from_config(model_name, subfolder="scheduler"), 
-            'EulerAncestralDiscrete': EulerAncestralDiscreteScheduler.from_pretrained(model_name, subfolder="scheduler"), 
-            'PNDM': PNDMScheduler.from_pretrained(model_name, subfolder="scheduler"), 
-            'DDIM': DDIMScheduler.from_pretrained(model_name, subfolder="scheduler", clip_sample=False), 
-            'LMSDiscrete' : LMSDiscreteScheduler.from_pretrained(model_name, subfolder="scheduler"), 
-            'HeunDiscrete': HeunDiscreteScheduler.from_pretrained(model_name, subfolder="scheduler"), 
-            'KDPM2AncestralDiscrete': KDPM2AncestralDiscreteScheduler.from_pretrained(model_name, subfolder="scheduler"), 
-            'KDPM2Discrete': KDPM2DiscreteScheduler.from_pretrained(model_name, subfolder="scheduler"), 
-        })
+        self.available_schedulers = SchedulerRegistry(scheduler, scheduler_config, verbose = verbose)
+        self.resident_models.add(model, self.pipe, self.available_schedulers)
 
         if verbose: print('成功加载完毕, 若默认设置无法生成, 请停止项目等待保存完毕选择GPU重新进入')
 
+    def make_text_encoder_private(self):
+        """Copy the tokenizer and the text encoder before modifying them, if other resident models share them."""
+        text_encoder = self.pipe.text_encoder
+        if self.resident_models.make_private(self.pipe, ('tokenizer', 'text_encoder')):
+            state = self.concepts.states.get(text_encoder)
+            if state is not None:
+                import copy
+                self.concepts.states[self.pipe.text_encoder] = copy.deepcopy(state)
+
     def load_concepts(self, opt):
-        added_tokens = []
-        is_exist_concepts_library_dir = False
-        original_dtype = None
-        has_updated = False
-
-        if opt.concepts_library_dir is not None:
-            file_paths = None
-
-            path = Path(opt.concepts_library_dir)
-            if path.exists():
-                #file_paths = path.glob("*.pdparams")
-                file_paths = [p for p in path.glob("*.pdparams")]
-
-                # conversion of .pt -> .pdparams embedding
-                pt_files = path.glob("*.pt")
-                for pt_file in pt_files:
-                    try:
-                        convert_pt_to_pdparams(pt_file, dim = 768, save = True)
-                    except:
-                        pass
-            
-            if opt.concepts_library_dir.endswith('.pdparams') and os.path.exists(opt.concepts_library_dir): 
-                # load single file
-                file_paths = [opt.concepts_library_dir]                
+        if opt.concepts_library_dir is None:
+            return
+        if self.concepts.may_update(self.pipe, opt.concepts_library_dir):
+            self.make_text_encoder_private()
+        is_first_load = self.pipe.text_encoder not in self.concepts.states
+        updated = self.concepts.load(self.pipe, opt.concepts_library_dir)
+        # the model may have been switched
+        self.added_tokens = self.concepts.added_tokens(self.pipe)
+        if updated is None:
+            # nothing changed since the last run
+            return
 
-            if file_paths is not None and len(file_paths)>0:
-                is_exist_concepts_library_dir = True
-                
-                # load the token safely in float32
-                original_dtype = self.pipe.text_encoder.dtype
-                self.pipe.text_encoder = self.pipe.text_encoder.to(dtype = 'float32')
-                self.added_tokens = []
-                for p in file_paths:
-                    for token, embeds in paddle.load(str(p)).items():
-                        added_tokens.append(token)
-                        if embeds.dim() == 1:
-                            embeds = embeds.reshape((1, -1))
-                        tokens = get_multiple_tokens(token, embeds.shape[0], ret_list = True)
-                        self.added_tokens.append((token, ' '.join(tokens)))
-
-                        for token, embed in zip(tokens, embeds):
-                            self.pipe.tokenizer.add_tokens(token)
-                            self.pipe.text_encoder.resize_token_embeddings(len(self.pipe.tokenizer))
-                            token_id = self.pipe.tokenizer.convert_tokens_to_ids(token)
-                            with paddle.no_grad():
-                                if paddle.max(paddle.abs(self.pipe.text_encoder.get_input_embeddings().weight[token_id] - embed)) > 1e-4:
-                                    # only add / update new token if it has changed
-                                    has_updated = True
-                                    self.pipe.text_encoder.get_input_embeddings().weight[token_id] = embed
-                            
+        if updated:
+            # the cached prompt embeddings were computed with the old token embeddings
+            from .pipeline_stable_diffusion_all_in_one import text_embedding_cache
+            text_embedding_cache.invalidate(self.pipe.text_encoder)
+            str_added_tokens = ", ".join(updated)
+            print(f"[导入训练文件] 成功加载了这些新词: {str_added_tokens} ")
 
-        if is_exist_concepts_library_dir:
-            if has_updated and len(added_tokens):
-                str_added_tokens = ", ".join(added_tokens)
-                print(f"[导入训练文件] 成功加载了这些新词: {str_added_tokens} ")
-        else:
-            print(f"[导入训练文件] {opt.concepts_library_dir} 文件夹下没有发现任何文件，跳过加载！")
-        
         if self.added_tokens:
-            #self_str_added_tokens = ", ".join((self.added_tokens))
-            str_added_tokens = ", ".join(added_tokens)
+            str_added_tokens = ", ".join(token for token, _ in self.added_tokens)
             print(f"[支持的'风格'或'人物'单词]: {str_added_tokens} ")
-        if original_dtype is not None:
-            self.pipe.text_encoder = self.pipe.text_encoder.to(dtype = original_dtype)
+        elif is_first_load:
+            print(f"[导入训练文件] {opt.concepts_library_dir} 文件夹下没有发现任何文件，跳过加载！")
     
     def run(self, opt, task = 'txt2img', on_image_generated = None):
         model_name = try_get_catched_model(opt.model_name)
         self.from_pretrained(model_name=model_name)
         self.load_concepts(opt)
 
-        seed = None if opt.seed == -1 else opt.seed
+        # one seed per image, so that every image can be regenerated alone from its seed
+        if opt.seed == -1:
+            seeds = [random.randint(0, 2**32) for _ in range(opt.num_return_images)]
+        else:
+            seeds = [opt.seed + i for i in range(opt.num_return_images)]
 
         # switch scheduler
         self.pipe.scheduler = self.available_schedulers[opt.sampler]
@@ -411,97 +1306,159 @@ class StableDiffusionFriendlyPipeline():
             negative_prompt = negative_prompt.replace(token[0], token[1])
         
         
+        # classifier free guidance only for the first part of the schedule
+        guidance_end = getattr(opt, 'guidance_end', None)
+        guidance_end = 1.0 if guidance_end is None else float(guidance_end)
+        guidance_schedule = getattr(opt, 'guidance_schedule', None) or 'constant'
+        # stop once the latents have converged
+        early_stop_threshold = getattr(opt, 'early_stop_threshold', None) or None
+        early_stop_patience = getattr(opt, 'early_stop_patience', None) or 3
+        if early_stop_threshold:
+            from .pipeline_stable_diffusion_all_in_one import early_stopping_stats
+            early_stopping_stats.reset()
+        # encode / decode large images tile by tile to bound the memory of the vae
+        if getattr(opt, 'vae_tiling', None):
+            self.pipe.enable_vae_tiling(tile_size = getattr(opt, 'vae_tile_size', None) or 64)
+        else:
+            self.pipe.disable_vae_tiling()
+        # resume from the latents cached by a previous run with the same inputs
+        if getattr(opt, 'enable_latent_cache', None):
+            if getattr(self.pipe, 'latent_cache', None) is None:
+                self.pipe.enable_latent_cache(max_bytes = getattr(opt, 'latent_cache_bytes', None) or 1024 * 1024 * 1024)
+        elif getattr(self.pipe, 'latent_cache', None) is not None:
+            self.pipe.disable_latent_cache()
+        
         init_image = None
         mask_image = None
         if task == 'txt2img':
-            def task_func():
+            def task_func(seeds):
                 return self.pipe.text2image(
-                                    prompt, seed=seed, 
+                                    prompt, seed=seeds, 
                                     width=opt.width, 
                                     height=opt.height, 
                                     guidance_scale=opt.guidance_scale, 
+                                    guidance_end=guidance_end, 
+                                    guidance_schedule=guidance_schedule, 
+                                    early_stop_threshold=early_stop_threshold, 
+                                    early_stop_patience=early_stop_patience, 
                                     num_inference_steps=opt.num_inference_steps, 
                                     negative_prompt=negative_prompt,
+                                    num_images_per_prompt=len(seeds),
                                     max_embeddings_multiples=int(opt.max_embeddings_multiples),
                                     skip_parsing=(not enable_parsing)
-                                ).images[0]
+                                ).images
         elif task == 'img2img':
             init_image = ReadImage(opt.image_path, height=opt.height, width=opt.width)
-            def task_func():
+            def task_func(seeds):
                 return self.pipe.img2img(
-                                    prompt, seed=seed, 
+                                    prompt, seed=seeds, 
                                     image=init_image, 
                                     num_inference_steps=opt.num_inference_steps, 
                                     strength=opt.strength, 
                                     guidance_scale=opt.guidance_scale, 
+                                    guidance_end=guidance_end, 
+                                    guidance_schedule=guidance_schedule, 
+                                    early_stop_threshold=early_stop_threshold, 
+                                    early_stop_patience=early_stop_patience, 
                                     negative_prompt=negative_prompt,
+                                    num_images_per_prompt=len(seeds),
                                     max_embeddings_multiples=int(opt.max_embeddings_multiples),
                                     skip_parsing=(not enable_parsing)
-                                )[0][0]
+                                )[0]
         elif task == 'inpaint':
             init_image = ReadImage(opt.image_path, height=opt.height, width=opt.width)
             mask_image = ReadImage(opt.mask_path, height=opt.height, width=opt.width)
-            def task_func():
+            def task_func(seeds):
                 return self.pipe.inpaint(
-                                    prompt, seed=seed, 
+                                    prompt, seed=seeds, 
                                     image=init_image, 
                                     mask_image=mask_image, 
                                     num_inference_steps=opt.num_inference_steps, 
                                     strength=opt.strength, 
                                     guidance_scale=opt.guidance_scale, 
+                                    guidance_end=guidance_end, 
+                                    guidance_schedule=guidance_schedule, 
+                                    early_stop_threshold=early_stop_threshold, 
+                                    early_stop_patience=early_stop_patience, 
                                     negative_prompt=negative_prompt,
+                                    num_images_per_prompt=len(seeds),
                                     max_embeddings_multiples=int(opt.max_embeddings_multiples),
                                     skip_parsing=(not enable_parsing)
-                                )[0][0]
+                                )[0]
             
         if opt.fp16 == 'float16' and opt.sampler != "LMSDiscrete":
             context = paddle.amp.auto_cast(True, level = 'O2') # level = 'O2' # seems to have BUG if enable O2
         else:
             context = nullcontext()
 
+        # generate several images per forward pass, as many as the memory allows
+        batch_size = getattr(opt, 'batch_size', None)
+        if not batch_size:
+            width, height = init_image.size if init_image is not None else (opt.width, opt.height)
+            batch_size = compute_batch_size(
+                width, height, 
+                opt.num_return_images, 
+                fp16 = (opt.fp16 == 'float16'), 
+                do_classifier_free_guidance = (opt.guidance_scale > 1.0),
+            )
+
+        # the noise of the ancestral samplers is drawn for the whole batch, the seed of an image only reproduces it
+        # when it is generated alone
+        from .pipeline_stable_diffusion_all_in_one import scheduler_draws_noise
+        if batch_size > 1 and opt.num_return_images > 1 and scheduler_draws_noise(self.pipe.scheduler):
+            print(f'采样器 {opt.sampler} 每一步都会加入随机噪声, 将逐张生成图片, 以便每张图片都能用其种子复现')
+            batch_size = 1
+
         image_info = init_image.info if init_image is not None else None
+        i = -1
         with context:
-            for i in range(opt.num_return_images):
+            for start in range(0, opt.num_return_images, batch_size):
                 empty_cache()
-                image = task_func()
-                image.argument['sampler'] = opt.sampler
-                
-                # super resolution
-                if (self.superres_pipeline is not None):
-                    argument = image.argument
-                    argument['superres_model_name'] = opt.superres_model_name
+                images = task_func(seeds[start:start + batch_size])
+                for image in images:
+                    i += 1
+                    image.argument['sampler'] = opt.sampler
                     
-                    image = self.superres_pipeline.run(opt, image = image, end_to_end = False)
-                    image.argument = argument
-
-                if task == 'img2img':
-                    image.argument['init_image'] = opt.image_path
-                elif task == 'inpaint':
-                    image.argument['init_image'] = opt.image_path
-                    image.argument['mask_path'] = opt.mask_path
+                    # super resolution
+                    if (self.superres_pipeline is not None):
+                        argument = image.argument
+                        argument['superres_model_name'] = opt.superres_model_name
                         
+                        image = self.superres_pipeline.run(opt, image = image, end_to_end = False)
+                        image.argument = argument
 
-                image.argument['model_name'] = opt.model_name
-                
-                if on_image_generated is not None:
-                    on_image_generated(
-                        image = image,
-                        options = opt,
-                        count = i,
-                        total = opt.num_return_images,
-                        image_info = image_info,
-                    )
-                    continue
-                
-                save_image_info(image, opt.output_dir,image_info)
-                
-                if i % 50 == 0:
-                    clear_output()
-                
-                display(image)
-                
-                print('Seed = ', image.argument['seed'], 
-                    '    (%d / %d ... %.2f%%)'%(i + 1, opt.num_return_images, (i + 1.) / opt.num_return_images * 100))
+                    if task == 'img2img':
+                        image.argument['init_image'] = opt.image_path
+                    elif task == 'inpaint':
+                        image.argument['init_image'] = opt.image_path
+                        image.argument['mask_path'] = opt.mask_path
+                            
+
+                    image.argument['model_name'] = opt.model_name
+                    
+                    if on_image_generated is not None:
+                        on_image_generated(
+                            image = image,
+                            options = opt,
+                            count = i,
+                            total = opt.num_return_images,
+                            image_info = image_info,
+                        )
+                        continue
+                    
+                    save_image_info(image, opt.output_dir,image_info)
+                    
+                    if i % 50 == 0:
+                        clear_output()
+                    
+                    display(image)
+                    
+                    print('Seed = ', image.argument['seed'], 
+                        '    (%d / %d ... %.2f%%)'%(i + 1, opt.num_return_images, (i + 1.) / opt.num_return_images * 100))
+
+        if early_stop_threshold:
+            stats = early_stopping_stats.stats()
+            print(f"[提前停止] {stats['stopped_runs']}/{stats['runs']} 批次提前收敛, 共节省 {stats['steps_saved']} 步")
 
 class SuperResolutionPipeline():
     def __init__(self):
@@ -168,6 +168,16 @@ _Views = {
         "max": 100,
         "step": 1,
     },
+    "batch_size": {
+        "__type": 'Dropdown',
+        "class_name": 'batch_size',
+        "layout_name": 'col04',
+        "style": _description_style,
+        "description": '批量大小',
+        "description_tooltip": '每次推理同时生成的图片数量。“自动”会根据可用内存选择，数值越大越快，但占用的内存也越多。',
+        "value": 0,
+        "options": [('自动', 0), ('1', 1), ('2', 2), ('4', 4), ('8', 8)],
+    },
     "guidance_scale": {
         "__type": 'BoundedFloatText',
         "class_name": 'guidance_scale',
@@ -179,6 +189,18 @@ _Views = {
         "max": 50,
         "value": 7.5,
     },
+    "guidance_end": {
+        "__type": 'BoundedFloatText',
+        "class_name": 'guidance_end',
+        "layout_name": 'col04',
+        "style": _description_style,
+        "description": 'CFG截止',
+        "description_tooltip": '只在前面这一比例的步数中使用引导度（CFG），之后的步数只计算一半，速度更快。1表示全程使用。',
+        "min": 0,
+        "max": 1,
+        "step": 0.05,
+        "value": 1.0,
+    },
     
     # Dropdown 
     "enable_parsing": {